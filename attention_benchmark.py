@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+### Exact against approximate attention (setting.attention_backend) on the O'Neil synergy data.
+### For every attention length (setting.d_model_j) and backend a model is trained for a few epochs on the
+### training part of the first fold and evaluated on its test part, reporting training and inference throughput
+### and test pearson / mse. 'performer' has the parameters of the exact model, so the exact model trained at the
+### same length is also evaluated with performer attention as a drop-in approximation.
+###     python ./attention_benchmark.py --lengths 512 1024 2048 --backends sdpa performer lowrank --epochs 1
+
+import argparse
+import numpy as np
+import pandas as pd
+from time import time
+import torch
+import torch.nn.functional as F
+from scipy.stats import pearsonr
+from sklearn.metrics import mean_squared_error
+from sklearn.preprocessing import StandardScaler
+from attention_main import get_final_index, prepare_data, persist_data_as_feature_store, set_seed
+from src import attention_model, drug_drug, setting, my_data, logger, device2
+
+exact_backends = ('math', 'sdpa', 'chunked')
+
+
+def reordered_batch(local_batch, slice_indices, reorder_tensor):
+
+    local_batch = local_batch.float().to(device2)
+    local_batch = local_batch.contiguous().view(-1, 1, sum(slice_indices) + setting.single_repsonse_feature_length)
+    reorder_tensor.load_raw_tensor(local_batch)
+    return reorder_tensor.get_reordered_narrow_tensor()
+
+def train(model, generator, slice_indices, reorder_tensor, epochs, max_batches):
+
+    optimizer = torch.optim.Adam(model.parameters(), lr=setting.start_lr, weight_decay=setting.lr_decay,
+                                 betas=(0.9, 0.98), eps=1e-9)
+    n_samples, seconds = 0, 0.
+    for epoch in range(epochs):
+        model.train()
+        for i, ((local_batch, _, _), local_labels) in enumerate(generator):
+            if max_batches is not None and i >= max_batches:
+                break
+            start = time()
+            preds = model(*reordered_batch(local_batch, slice_indices, reorder_tensor)).contiguous().view(-1)
+            loss = F.mse_loss(preds, local_labels.float().to(device2).contiguous().view(-1))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            seconds += time() - start
+            n_samples += len(local_labels)
+    return n_samples / max(seconds, 1e-6)
+
+def evaluate(model, generator, slice_indices, reorder_tensor, std_scaler, max_batches):
+
+    model.eval()
+    all_preds, all_ys = [], []
+    n_samples, seconds = 0, 0.
+    with torch.no_grad():
+        for i, ((local_batch, _, _), local_labels) in enumerate(generator):
+            if max_batches is not None and i >= max_batches:
+                break
+            start = time()
+            preds = model(*reordered_batch(local_batch, slice_indices, reorder_tensor)).contiguous().view(-1)
+            seconds += time() - start
+            n_samples += len(local_labels)
+            all_preds.append(preds.cpu().numpy().reshape(-1))
+            all_ys.append(np.array(local_labels).reshape(-1))
+    all_preds, all_ys = np.concatenate(all_preds), np.concatenate(all_ys)
+    if setting.y_transform:
+        all_preds = std_scaler.inverse_transform(all_preds.reshape(-1, 1) / 100).reshape(-1)
+        all_ys = std_scaler.inverse_transform(all_ys.reshape(-1, 1) / 100).reshape(-1)
+    return all_preds, all_ys, n_samples / max(seconds, 1e-6)
+
+def get_model(backend, length, slice_indices_layout):
+
+    ### the models read the attention length and backend from setting when they are built
+    setting.d_model_j = length
+    setting.d_model = setting.d_model_i * length
+    setting.attention_backend = backend
+    set_seed()
+    return attention_model.get_multi_models(slice_indices_layout).to(device2)
+
+def run(lengths, backends, epochs, max_batches):
+
+    final_index = get_final_index()
+    X, Y, drug_features_length, cellline_features_length = prepare_data()
+    slice_indices = drug_features_length + drug_features_length + cellline_features_length
+    reorder_tensor = drug_drug.reorganize_tensor(slice_indices, setting.arrangement, 2)
+
+    train_index, test_index, _, evaluation_index, _ = \
+        next(iter(my_data.DataPreprocessor.reg_train_eval_test_split(fold='fold', test_fold=4)))
+    std_scaler = StandardScaler()
+    std_scaler.fit(Y[train_index])
+    if setting.y_transform:
+        Y = std_scaler.transform(Y) * 100
+    persist_data_as_feature_store(X, final_index)
+    labels = np.asarray(Y).reshape(-1)
+    training_generator = my_data.get_batch_generator(train_index.tolist(), labels, setting.batch_size, shuffle=True)
+    test_generator = my_data.get_batch_generator(test_index.tolist(), labels, setting.batch_size)
+
+    results = []
+    for length in lengths:
+        exact_model = None
+        for backend in backends:
+            logger.debug("Benchmarking {!r} attention over {!r} positions".format(backend, length))
+            try:
+                model = get_model(backend, length, reorder_tensor.get_reordered_slice_indices())
+                train_speed = train(model, training_generator, slice_indices, reorder_tensor, epochs, max_batches)
+                preds, ys, test_speed = evaluate(model, test_generator, slice_indices, reorder_tensor, std_scaler,
+                                                 max_batches)
+            except RuntimeError as err:
+                ### exact attention runs out of memory first at long lengths
+                logger.debug("{!r} attention over {!r} positions failed: {!r}".format(backend, length, err))
+                results.append({'length': length, 'backend': backend, 'error': str(err).split('\n')[0]})
+                continue
+            results.append({'length': length, 'backend': backend, 'train_samples_per_s': train_speed,
+                            'test_samples_per_s': test_speed, 'test_pearson': pearsonr(preds, ys)[0],
+                            'test_mse': mean_squared_error(ys, preds)})
+            if backend in exact_backends and exact_model is None:
+                exact_model, exact_preds = model, preds
+
+        if exact_model is not None and 'performer' in backends:
+            ### exact weights with performer attention, no retraining
+            drop_in = get_model('performer', length, reorder_tensor.get_reordered_slice_indices())
+            drop_in.load_state_dict(exact_model.state_dict())
+            preds, ys, test_speed = evaluate(drop_in, test_generator, slice_indices, reorder_tensor, std_scaler,
+                                             max_batches)
+            results.append({'length': length, 'backend': 'performer (exact weights)', 'test_samples_per_s': test_speed,
+                            'test_pearson': pearsonr(preds, ys)[0], 'test_mse': mean_squared_error(ys, preds),
+                            'relative_error_to_exact': np.linalg.norm(preds - exact_preds) / np.linalg.norm(exact_preds)})
+
+    results = pd.DataFrame(results)
+    logger.debug("Attention benchmark:\n{}".format(results.to_string()))
+    print(results.to_string())
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="exact against approximate attention on the O'Neil data")
+    parser.add_argument('--lengths', type=int, nargs='+', default=[512, 1024, 2048, 4096],
+                        help="attention lengths (setting.d_model_j)")
+    parser.add_argument('--backends', nargs='+', default=['sdpa', 'performer', 'lowrank'],
+                        help="setting.attention_backend values, the first exact one is the reference")
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--max_batches', type=int, default=None, help="batches per epoch and for the test set")
+    args = parser.parse_args()
+    run(args.lengths, args.backends, args.epochs, args.max_batches)
@@ -10,7 +10,7 @@ from time import time
 import torch
 from torch import save, load
 from torch.utils import data
-from src import attention_model, drug_drug, setting, my_data, logger, device2
+from src import attention_model, drug_drug, setting, my_data, logger, device2, pipeline_cache
 import torch.nn.functional as F
 from scipy.stats import pearsonr, spearmanr
 from sklearn.metrics import mean_squared_error
@@ -35,34 +35,57 @@ def set_seed(seed=random_seed):
     np.random.seed(seed)
     random.seed(seed)
 
+def use_downloaded_data():
+
+    ### the x.npy, old_x_lengths.pkl and y.pkl downloaded from zenodo (README) are used whenever they exist,
+    ### the preprocessing stages need the network and L1000 files which are not part of the download
+    return setting.use_downloaded_x and not setting.update_xy and \
+           all(path.exists(file_path) for file_path in (setting.old_x, setting.old_x_lengths, setting.old_y))
+
 def get_final_index():
 
     ## get the index of synergy score database
     if not setting.update_final_index and path.exists(setting.final_index):
         final_index = pd.read_csv(setting.final_index, header=None)[0]
+    elif setting.use_preprocessing_cache and not use_downloaded_data():
+        final_index = pipeline_cache.PreprocessingDAG.run('final_index')
     else:
         final_index = my_data.SynergyDataReader.get_final_index()
     return final_index
 
 def prepare_data():
 
-    if not setting.update_xy:
-        assert (path.exists(setting.old_x) and path.exists(setting.old_y)), "Data need to be downloaded from zenodo follow instruction in README"
-        X = np.load(setting.old_x)
+    if use_downloaded_data():
+        X = np.load(setting.old_x, mmap_mode='r')
         with open(setting.old_x_lengths, 'rb') as old_x_lengths:
             drug_features_length, cellline_features_length = pickle.load(old_x_lengths)
         with open(setting.old_y, 'rb') as old_y:
             Y = pickle.load(old_y)
+    elif setting.use_preprocessing_cache:
+        if setting.use_downloaded_x and not setting.update_xy:
+            logger.debug("{!r} or {!r} not found, X and Y are built by the preprocessing stages".format(
+                setting.old_x, setting.old_y))
+        ### only the preprocessing stages whose inputs or settings changed are recomputed
+        X, drug_features_length, cellline_features_length, Y = pipeline_cache.PreprocessingDAG.run('raw_x')
     else:
         X, drug_features_length, cellline_features_length = \
             my_data.SamplesDataLoader.Raw_X_features_prep(methods='flexible_attn')
-        np.save(setting.old_x, X)
-        with open(setting.old_x_lengths, 'wb+') as old_x_lengths:
-            pickle.dump((drug_features_length,cellline_features_length), old_x_lengths)
+        if isinstance(X, my_data.DrugSwappedView):
+            ### only the first drug order is saved, the switched drug order is generated at gather time
+            np.save(setting.old_x, X.base)
+            with open(setting.old_x_lengths, 'wb+') as old_x_lengths:
+                pickle.dump((drug_features_length,cellline_features_length), old_x_lengths)
+        else:
+            ### factorized entity tables are used as they are, writing x.npy would materialize every data point
+            logger.debug("Factorized features, {!r} is not written".format(setting.old_x))
 
         Y = my_data.SamplesDataLoader.Y_features_prep()
         with open(setting.old_y, 'wb+') as old_y:
             pickle.dump(Y, old_y)
+
+    ### x.npy from zenodo still has both drug orders, newer ones only keep the first half
+    if len(X) * 2 == len(Y):
+        X = my_data.DrugSwappedView(X, sum(drug_features_length))
     return X, Y, drug_features_length, cellline_features_length
 
 
@@ -85,22 +108,17 @@ def prepare_model(reorder_tensor, entrez_set):
             best_m.register_forward_hook(drug_drug.input_hook)
     drug_model = drug_model.to(device2)
     best_drug_model = best_drug_model.to(device2)
+    ### only the trained model is compiled, the best model is saved and explained as a plain module
+    drug_model = attention_model.compile_model(drug_model)
     if USE_wandb:
         wandb.watch(drug_model, log="all")
     return drug_model, best_drug_model
 
 
-def persist_data_as_data_point_file(local_X, final_index_for_X):
+def persist_data_as_feature_store(X, final_index):
 
-    ### prepare files for dataloader
-    for i, combin_drug_feature_array in enumerate(local_X):
-        if setting.unit_test:
-            if i <= 501:  # and not path.exists(path.join('datas', str(final_index_for_X.iloc[i]) + '.pt')):
-                save(combin_drug_feature_array, path.join(setting.data_folder, str(final_index_for_X.iloc[i]) + '.pt'))
-        else:
-            if setting.update_features or not path.exists(
-                    path.join(setting.data_folder, str(final_index_for_X.iloc[i]) + '.pt')):
-                save(combin_drug_feature_array, path.join(setting.data_folder, str(final_index_for_X.iloc[i]) + '.pt'))
+    ### prepare the feature store for dataloader, one float32 matrix with rows in final_index order
+    my_data.FeatureStore.persist(X, list(final_index))
 
 
 def prepare_splitted_dataset(partition, labels):
@@ -108,44 +126,27 @@ def prepare_splitted_dataset(partition, labels):
     ### prepare train, test, evaluation data generator
 
     logger.debug("Preparing datasets ... ")
-    # training_set = my_data.MyDataset(partition['train'] + partition['eval1'] + partition['eval2'], labels)
-    training_set = my_data.MyDataset(partition['train'], labels)
-    train_params = {'batch_size': setting.batch_size,
-                    'shuffle': True}
-    training_generator = data.DataLoader(training_set, **train_params)
+    # training_generator = my_data.get_batch_generator(partition['train'] + partition['eval1'] + partition['eval2'], labels, ...)
+    training_generator = my_data.get_batch_generator(partition['train'], labels, setting.batch_size, shuffle=True)
 
-    eval_train_set = my_data.MyDataset(partition['train'] + partition['eval1'] + partition['eval2'], labels)
     training_index_list = partition['train'] + partition['eval1'] + partition['eval2']
     logger.debug("Training data length: {!r}".format(len(training_index_list)))
-    eval_train_params = {'batch_size': setting.batch_size,
-                         'shuffle': False}
-    eval_train_generator = data.DataLoader(eval_train_set, **eval_train_params)
+    eval_train_generator = my_data.get_batch_generator(training_index_list, labels, setting.batch_size)
 
-    # validation_set = my_data.MyDataset(partition['test1'], labels)
-    validation_set = my_data.MyDataset(partition['eval1'], labels)
-    eval_params = {'batch_size': len(partition['test1'])//4,
-                   'shuffle': False}
-    validation_generator = data.DataLoader(validation_set, **eval_params)
+    # validation_generator = my_data.get_batch_generator(partition['test1'], labels, ...)
+    validation_generator = my_data.get_batch_generator(partition['eval1'], labels, len(partition['test1'])//4)
 
-    test_set = my_data.MyDataset(partition['test1'], labels)
     test_index_list = partition['test1']
     logger.debug("Test data length: {!r}".format(len(test_index_list)))
     pickle.dump(test_index_list, open("test_index_list", "wb+"))
-    test_params = {'batch_size': len(test_index_list) // 4,
-                   'shuffle': False}
-    test_generator = data.DataLoader(test_set, **test_params)
+    test_generator = my_data.get_batch_generator(test_index_list, labels, len(test_index_list) // 4)
 
     all_index_list = partition['train'][:len(partition['train']) // 2] + partition['eval1'] + partition['test1']
-    all_set = my_data.MyDataset(all_index_list, labels)
     logger.debug("All data length: {!r}".format(len(set(all_index_list))))
     pickle.dump(all_index_list, open("all_index_list", "wb+"))
-    all_set_params = {'batch_size': len(all_index_list) // 8,
-                      'shuffle': False}
-    all_data_generator = data.DataLoader(all_set, **all_set_params)
+    all_data_generator = my_data.get_batch_generator(all_index_list, labels, len(all_index_list) // 8)
     ### generate all the data in one iteration because the batch size is bigger than all_data_generator
-    all_set_params_total = {'batch_size': len(all_index_list),
-                            'shuffle': False}
-    all_data_generator_total = data.DataLoader(all_set, **all_set_params_total)
+    all_data_generator_total = my_data.get_batch_generator(all_index_list, labels, len(all_index_list))
     return training_generator, eval_train_generator, validation_generator, test_generator, all_data_generator, all_data_generator_total
 
 def run():
@@ -183,26 +184,24 @@ def run():
 
     for train_index, test_index, test_index_2, evaluation_index, evaluation_index_2 in split_func(fold='fold', test_fold = 4):
 
-        local_X = X[np.concatenate((train_index, test_index, test_index_2, evaluation_index, evaluation_index_2))]
-        final_index_for_X = final_index.iloc[np.concatenate((train_index, test_index,
-                                                             test_index_2, evaluation_index, evaluation_index_2))]
-
         ori_Y = Y
         std_scaler.fit(Y[train_index])
         if setting.y_transform:
             Y = std_scaler.transform(Y) * 100
 
-        persist_data_as_data_point_file(local_X, final_index_for_X)
+        persist_data_as_feature_store(X, final_index)
 
-        partition = {'train': list(final_index.iloc[train_index]),
-                     'test1': list(final_index.iloc[test_index]), 'test2': list(final_index.iloc[test_index_2]),
-                     'eval1': list(final_index.iloc[evaluation_index]),
-                     'eval2': list(final_index.iloc[evaluation_index_2])}
+        ### data points are addressed by IdCatalog combination ids (= rows of final_index, X and Y),
+        ### names are only resolved in reports through the saved catalog
+        assert len(final_index) == len(my_data.IdCatalog.get_combinations()), "final index does not match id catalog"
+        my_data.IdCatalog.save(setting.id_catalog)
+        partition = {'train': train_index.tolist(),
+                     'test1': test_index.tolist(), 'test2': test_index_2.tolist(),
+                     'eval1': evaluation_index.tolist(),
+                     'eval2': evaluation_index_2.tolist()}
 
-        labels = {key: value for key, value in zip(list(final_index),
-                                                   list(Y.reshape(-1)))}
-        ori_labels = {key: value for key, value in zip(list(final_index),
-                                                   list(ori_Y.reshape(-1)))}
+        labels = np.asarray(Y).reshape(-1)
+        ori_labels = np.asarray(ori_Y).reshape(-1)
         save(ori_labels, setting.y_labels_file)
 
         training_generator, eval_train_generator, validation_generator, test_generator, \
@@ -219,6 +218,7 @@ def run():
             cur_epoch_train_loss = []
             train_total_loss = 0
             train_i = 0
+            n_train_samples = 0
             all_preds = []
             all_ys = []
 
@@ -242,6 +242,7 @@ def run():
                 pre_local_labels = cur_local_labels
                 local_labels_on_cpu = np.array(pre_local_labels).reshape(-1)
                 sample_size = local_labels_on_cpu.shape[-1]
+                n_train_samples += sample_size
                 local_labels_on_cpu = local_labels_on_cpu[:sample_size]
                 local_batch, local_labels = pre_local_batch.float().to(device2), pre_local_labels.float().to(device2)
                 local_batch = local_batch.contiguous().view(-1, 1, sum(slice_indices) + setting.single_repsonse_feature_length)
@@ -295,6 +296,7 @@ def run():
                     train_total_loss = 0
                     cur_epoch_train_loss.append(avg_loss)
 
+            logger.debug("epoch %d: %.1f training samples/sec" % (epoch, n_train_samples / max(time() - start, 1e-6)))
             all_preds = np.concatenate(all_preds)
             all_ys = np.concatenate(all_ys)
 
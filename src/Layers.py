@@ -1,19 +1,20 @@
 import torch.nn as nn
 from src.Sublayers import FeedForward, MultiHeadAttention, Norm, attention
 import torch
+from typing import Optional
 
 
 class EncoderLayer(nn.Module):
-    def __init__(self, d_model, heads, dropout=0.1):
+    def __init__(self, d_model, heads, dropout=0.1, attention_backend=None):
         super().__init__()
         self.norm_1 = Norm(d_model)
         self.norm_2 = Norm(d_model)
-        self.attn = MultiHeadAttention(heads, d_model, dropout=dropout)
+        self.attn = MultiHeadAttention(heads, d_model, dropout=dropout, backend=attention_backend)
         self.ff = FeedForward(d_model, d_ff=d_model, dropout=dropout)
         self.dropout_1 = nn.Dropout(dropout)
         self.dropout_2 = nn.Dropout(dropout)
 
-    def forward(self, x, mask=None, low_dim = False):
+    def forward(self, x, mask: Optional[torch.Tensor] = None, low_dim: bool = False):
 
         x2 = x if low_dim else self.norm_1(x)
         x = x + self.dropout_1(self.attn(x2, x2, x2, mask))
@@ -57,7 +58,7 @@ class MulAttentionLayer(nn.Module):
 # build a decoder layer with two multi-head attention layers and
 # one feed-forward layer
 class DecoderLayer(nn.Module):
-    def __init__(self, d_model, heads, dropout=0.1):
+    def __init__(self, d_model, heads, dropout=0.1, attention_backend=None):
         super().__init__()
         self.norm_1 = Norm(d_model)
         self.norm_2 = Norm(d_model)
@@ -67,11 +68,12 @@ class DecoderLayer(nn.Module):
         self.dropout_2 = nn.Dropout(dropout)
         self.dropout_3 = nn.Dropout(dropout)
 
-        self.attn_1 = MultiHeadAttention(heads, d_model, dropout=dropout)
-        self.attn_2 = MultiHeadAttention(heads, d_model, dropout=dropout)
+        self.attn_1 = MultiHeadAttention(heads, d_model, dropout=dropout, backend=attention_backend)
+        self.attn_2 = MultiHeadAttention(heads, d_model, dropout=dropout, backend=attention_backend)
         self.ff = FeedForward(d_model, d_ff=d_model, dropout=dropout)
 
-    def forward(self, x, e_outputs, src_mask=None, trg_mask=None, low_dim = False):
+    def forward(self, x, e_outputs, src_mask: Optional[torch.Tensor] = None, trg_mask: Optional[torch.Tensor] = None,
+                low_dim: bool = False):
         x2 = x if low_dim else self.norm_1(x)
         x = x + self.dropout_1(self.attn_1(x2, x2, x2, trg_mask))
         x2 = x if low_dim else self.norm_2(x)
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import math
+from typing import Optional
+from src import setting
 
 class Norm(nn.Module):
     def __init__(self, d_model, eps=1e-6):
@@ -16,12 +18,16 @@ class Norm(nn.Module):
         self.eps = eps
 
     def forward(self, x):
-        norm = self.alpha * (x - x.mean(dim=-1, keepdim=True)) \
-               / (x.std(dim=-1, keepdim=True) + self.eps) + self.bias
+        ### mean and (unbiased) standard deviation in one fused reduction, same result as x.mean and x.std. Its
+        ### gradient is 0 for constant rows (e.g. all relu outputs 0), var.sqrt() and a scripted x.std give nan
+        std, mean = torch.std_mean(x, dim=-1, unbiased=True, keepdim=True)
+        norm = self.alpha * (x - mean) / (std + self.eps) + self.bias
         return norm
 
 
-def attention(q, k, v, d_k = 1, mask=None, dropout=None):
+### the attention functions are TorchScript compatible, dropout on the attention weights is given as its rate
+### and the training flag of the calling module
+def attention(q, k, v, d_k: int = 1, mask: Optional[torch.Tensor] = None, dropout_p: float = 0., training: bool = False):
     scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(d_k)
 
     if mask is not None:
@@ -30,21 +36,108 @@ def attention(q, k, v, d_k = 1, mask=None, dropout=None):
 
     scores = F.softmax(scores, dim=-1)
 
-    if dropout is not None:
-        scores = dropout(scores)
+    if dropout_p > 0:
+        scores = F.dropout(scores, dropout_p, training)
 
     output = torch.matmul(scores, v)
     return output
 
+def chunked_attention(q, k, v, d_k: int = 1, mask: Optional[torch.Tensor] = None, dropout_p: float = 0.,
+                      training: bool = False, chunk_size: int = 64):
+
+    ### same result as attention, but keys and values are visited chunk_size positions at a time with an online
+    ### softmax (running row max and normalizer), so only q_len x chunk_size scores exist at any time
+    if mask is not None:
+        mask = mask.unsqueeze(1)
+    row_max = torch.full_like(q[..., :1], float('-inf'))
+    normalizer = torch.zeros_like(q[..., :1])
+    output = q.new_zeros(q.shape[:-1] + v.shape[-1:])
+    for start in range(0, k.size(-2), chunk_size):
+        scores = torch.matmul(q, k[..., start:start + chunk_size, :].transpose(-2, -1)) / math.sqrt(d_k)
+        if mask is not None:
+            if mask.size(-1) == 1:
+                scores = scores.masked_fill(mask == 0, -1e9)
+            else:
+                scores = scores.masked_fill(mask[..., start:start + chunk_size] == 0, -1e9)
+        new_max = torch.maximum(row_max, scores.max(dim=-1, keepdim=True)[0])
+        correction = torch.exp(row_max - new_max)
+        scores = torch.exp(scores - new_max)
+        normalizer = normalizer * correction + scores.sum(dim=-1, keepdim=True)
+        ### dropout of the softmax output only scales the numerator, the normalizer sums the undropped weights
+        if dropout_p > 0:
+            scores = F.dropout(scores, dropout_p, training)
+        output = output * correction + torch.matmul(scores, v[..., start:start + chunk_size, :])
+        row_max = new_max
+    return output / normalizer
+
+def fused_attention(q, k, v, mask: Optional[torch.Tensor] = None, dropout_p: float = 0., training: bool = False):
+
+    ### torch >= 2.0 scaled_dot_product_attention (flash / memory efficient kernels), default scale 1 / sqrt(d_k)
+    attn_mask: Optional[torch.Tensor] = None
+    if mask is not None:
+        attn_mask = torch.zeros(mask.unsqueeze(1).shape, dtype=q.dtype, device=q.device).masked_fill(mask.unsqueeze(1) == 0, -1e9)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p if training else 0.)
+
+
+def performer_attention(q, k, v, projection, mask: Optional[torch.Tensor] = None):
+
+    ### Performer (FAVOR+) approximation of attention with positive random features
+    ### phi(x) = exp(w x - |x|^2 / 2), x scaled by d_k^-1/4 and w the rows of projection (features x d_k):
+    ### softmax(q k^T / sqrt(d_k)) v ~ phi(q) (phi(k)^T v) / phi(q) (phi(k)^T 1), linear in the number of positions.
+    ### Only key masks (batch x 1 x k_len) are supported and there is no dropout on the implicit attention weights
+    q = q * q.size(-1) ** -0.25
+    k = k * k.size(-1) ** -0.25
+    q_proj = torch.matmul(q, projection.t())
+    k_proj = torch.matmul(k, projection.t())
+    ### the max shifts are constant per query row and per key set, they cancel in the ratio
+    q_feat = torch.exp(q_proj - q.pow(2).sum(dim=-1, keepdim=True) / 2 - q_proj.max(dim=-1, keepdim=True)[0].detach())
+    k_feat = torch.exp(k_proj - k.pow(2).sum(dim=-1, keepdim=True) / 2 - k_proj.amax(dim=[-2, -1], keepdim=True).detach())
+    if mask is not None:
+        assert mask.size(-2) == 1, "performer attention supports key masks only"
+        k_feat = k_feat * (mask.unsqueeze(1).transpose(-2, -1) != 0)
+    kv = torch.matmul(k_feat.transpose(-2, -1), v)
+    normalizer = torch.matmul(q_feat, k_feat.sum(dim=-2).unsqueeze(-1))
+    ### float32 tiny, keeps fully masked rows finite
+    return torch.matmul(q_feat, kv) / normalizer.clamp_min(1.1754944e-38)
+
+def orthogonal_random_features(n_features, d_k, generator=None):
+
+    ### blocks of d_k orthogonal gaussian directions with chi distributed norms, as in FAVOR+
+    blocks = []
+    for _ in range((n_features + d_k - 1) // d_k):
+        q, r = torch.linalg.qr(torch.randn(d_k, d_k, generator=generator))
+        ### the sign correction makes q uniformly (Haar) distributed, plain QR favours one orientation
+        blocks.append((q * torch.sign(torch.diagonal(r))).t())
+    norms = torch.randn(n_features, d_k, generator=generator).norm(dim=1, keepdim=True)
+    return torch.cat(blocks)[:n_features] * norms
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, heads, d_model, dropout=0.1):
+    def __init__(self, heads, d_model, dropout=0.1, backend=None):
         super().__init__()
 
         self.d_model = d_model
         self.d_k = d_model // heads
         self.h = heads
 
+        ### 'math': attention, 'sdpa': fused_attention, 'chunked': chunked_attention, exact
+        ### 'performer': performer_attention, 'lowrank': keys and values projected from setting.d_model_j positions
+        ### to setting.lowrank_attention_k learned positions (Linformer), approximate
+        self.backend = setting.attention_backend if backend is None else backend
+        assert self.backend in ('math', 'sdpa', 'chunked', 'performer', 'lowrank'), \
+            "unknown attention backend {!r}".format(self.backend)
+        if self.backend == 'sdpa' and not hasattr(F, 'scaled_dot_product_attention'):
+            self.backend = 'chunked'
+        if self.backend == 'performer':
+            ### fixed features from their own generator, not saved in the state dict, so exact and performer
+            ### models initialize and load the same parameters
+            generator = torch.Generator().manual_seed(setting.performer_seed)
+            self.register_buffer('projection', orthogonal_random_features(setting.performer_features, self.d_k, generator),
+                                 persistent=False)
+        if self.backend == 'lowrank':
+            ### one projection shared by keys and values
+            self.seq_projection = nn.Linear(setting.d_model_j, setting.lowrank_attention_k, bias=False)
+        self.chunk_size = setting.attention_chunk_size
+
         self.q_linear = nn.Linear(d_model, d_model)
         self.v_linear = nn.Linear(d_model, d_model)
         self.k_linear = nn.Linear(d_model, d_model)
@@ -52,7 +145,7 @@ class MultiHeadAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.out = nn.Linear(d_model, d_model)
 
-    def forward(self, q, k, v, mask=None):
+    def forward(self, q, k, v, mask: Optional[torch.Tensor] = None):
         bs = q.size(0)
 
         # perform linear operation and split into N heads
@@ -65,8 +158,27 @@ class MultiHeadAttention(nn.Module):
         q = q.transpose(1, 2)
         v = v.transpose(1, 2)
 
+        ### hasattr on the optional submodules is resolved when the module is scripted
+        if hasattr(self, 'seq_projection'):
+            ### masked keys and values are zeroed before they are mixed into the projected positions
+            if mask is not None:
+                assert mask.size(-2) == 1, "lowrank attention supports key masks only"
+                k = k * (mask.unsqueeze(1).transpose(-2, -1) != 0)
+                v = v * (mask.unsqueeze(1).transpose(-2, -1) != 0)
+                mask = None
+            k = self.seq_projection(k.transpose(-2, -1)).transpose(-2, -1)
+            v = self.seq_projection(v.transpose(-2, -1)).transpose(-2, -1)
+
         # calculate attention using function we will define next
-        scores = attention(q, k, v, self.d_k, mask, self.dropout)
+        if hasattr(self, 'projection'):
+            scores = performer_attention(q, k, v, self.projection, mask)
+        elif self.backend == 'sdpa':
+            scores = fused_attention(q, k, v, mask, self.dropout.p, self.training)
+        elif self.backend == 'chunked':
+            scores = chunked_attention(q, k, v, self.d_k, mask, self.dropout.p, self.training, self.chunk_size)
+        else:
+            ### 'math', and 'lowrank' on its projected keys and values
+            scores = attention(q, k, v, self.d_k, mask, self.dropout.p, self.training)
         # concatenate heads and put through final linear layer
         concat = scores.transpose(1, 2).contiguous() \
             .view(bs, -1, self.d_model)
@@ -85,7 +197,7 @@ class FeedForward(nn.Module):
         self.norm = Norm(d_ff)
         self.linear_2 = nn.Linear(d_ff, d_model)
 
-    def forward(self, x, low_dim = False):
+    def forward(self, x, low_dim: bool = False):
         x = F.relu(self.linear_1(x))
         x = x if low_dim else self.norm(x)
         x = self.dropout(x)
@@ -4,7 +4,7 @@ from torch import cuda, device
 import torch
 import logging
 
-if not setting.ml_train:
+if not setting.ml_train and cuda.is_available():
     #os.environ["CUDA_VISIBLE_DEVICES"] = "2"
     dev_numb = setting.dev_numb
     torch.cuda.set_device(dev_numb)
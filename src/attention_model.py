@@ -11,49 +11,53 @@ from src.CustomizedLinear import CustomizedLinear
 from neural_fingerprint import NeuralFingerprint
 from torch import device
 import pandas as pd
+from typing import Optional
 
 
 def get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
 
 class Encoder(nn.Module):
-    def __init__(self, d_model, N, heads, dropout):
+    def __init__(self, d_model, N, heads, dropout, attention_backend=None):
         super().__init__()
         self.N = N
-        self.layers = get_clones(EncoderLayer(d_model, heads, dropout), N)
+        self.layers = get_clones(EncoderLayer(d_model, heads, dropout, attention_backend=attention_backend), N)
         self.norm = Norm(d_model)
 
-    def forward(self, src, mask=None, low_dim=False):
+    def forward(self, src, mask: Optional[torch.Tensor] = None, low_dim: bool = False):
         x = src
-        for i in range(self.N):
-            x = self.layers[i](x, mask, low_dim=low_dim)
+        for layer in self.layers:
+            x = layer(x, mask, low_dim=low_dim)
         return x if low_dim else self.norm(x)
 
 class Decoder(nn.Module):
-    def __init__(self, d_model, N, heads, dropout):
+    def __init__(self, d_model, N, heads, dropout, attention_backend=None):
         super().__init__()
         self.N = N
-        self.layers = get_clones(DecoderLayer(d_model, heads, dropout), N)
+        self.layers = get_clones(DecoderLayer(d_model, heads, dropout, attention_backend=attention_backend), N)
         self.norm = Norm(d_model)
 
-    def forward(self, trg, e_outputs, src_mask=None, trg_mask=None, low_dim = False):
+    def forward(self, trg, e_outputs, src_mask: Optional[torch.Tensor] = None, trg_mask: Optional[torch.Tensor] = None,
+                low_dim: bool = False):
         x = trg
-        for i in range(self.N):
-            x = self.layers[i](x, e_outputs, src_mask, trg_mask, low_dim=low_dim)
+        for layer in self.layers:
+            x = layer(x, e_outputs, src_mask, trg_mask, low_dim=low_dim)
         return x if low_dim else self.norm(x)
 
 class Transformer(nn.Module):
-    def __init__(self, d_model, N, heads, dropout):
+    def __init__(self, d_model, N, heads, dropout, attention_backend=None):
         super().__init__()
         self.d_model = d_model
-        self.encoder = Encoder(self.d_model, N, heads, dropout)
-        self.decoder = Decoder(self.d_model, N, heads, dropout)
+        ### attention_backend None: setting.attention_backend
+        self.encoder = Encoder(self.d_model, N, heads, dropout, attention_backend=attention_backend)
+        self.decoder = Decoder(self.d_model, N, heads, dropout, attention_backend=attention_backend)
 
         # self.expand_dim_linear = nn.Linear(d_model, 16)
         # self.attn = MultiheadAttention(16, num_heads = heads, dropout = dropout)
         # self.shrink_dim_linear = nn.Linear(16, d_model)
 
-    def forward(self, src, trg, src_mask=None, trg_mask=None, low_dim = False):
+    def forward(self, src, trg, src_mask: Optional[torch.Tensor] = None, trg_mask: Optional[torch.Tensor] = None,
+                low_dim: bool = False):
         # src = self.expand_dim_linear(src)
         # trg = self.expand_dim_linear(trg)
         e_outputs = self.encoder(src, src_mask, low_dim = low_dim)
@@ -90,18 +94,28 @@ class FlexibleTransformer(Transformer):
 
 class TransposeMultiTransformers(nn.Module):
 
-    def __init__(self,  d_input_list, d_model_list, n_feature_type_list, N, heads, dropout, masks = None, linear_only = False):
+    def __init__(self,  d_input_list, d_model_list, n_feature_type_list, N, heads, dropout, masks = None, linear_only = False,
+                 d_model_i = None):
         super().__init__()
 
         assert len(d_input_list) == len(n_feature_type_list) and len(d_input_list) == len(d_model_list),\
             "claimed inconsistent number of transformers"
         self.linear_only = linear_only
+        ### every projected feature type is reshaped to d_model_i x d_model_j, all shapes are fixed here so that
+        ### forward does not read setting
+        self.d_model_i = setting.d_model_i if d_model_i is None else d_model_i
+        self.d_model_j_list = [d_model // self.d_model_i for d_model in d_model_list]
+        self.grouped_projection = setting.grouped_projection
         self.linear_layers = nn.ModuleList()
         self.norms = nn.ModuleList()
         self.dropouts = nn.ModuleList()
+        ### first linear layer and number of linear layers of every transformer, the per feature type
+        ### nn.Linear layers of one transformer can be run as one grouped matmul
+        self.linear_groups = []
         for i in range(len(d_input_list)):
 
             num_of_linear_module = setting.n_feature_type[i] if setting.one_linear_per_dim else 1
+            self.linear_groups.append((len(self.linear_layers), num_of_linear_module, masks[i] is None))
 
             for j in range(num_of_linear_module):
                 self.linear_layers.append(CustomizedLinear(masks[i])) if masks[i] is not None else self.linear_layers.append(nn.Linear(d_input_list[i], d_model_list[i]))
@@ -111,42 +125,57 @@ class TransposeMultiTransformers(nn.Module):
         self.transformer_list = nn.ModuleList()
         self.n_feature_type_list = n_feature_type_list
         for i in range(len(d_input_list)):
-            self.transformer_list.append(Transformer(n_feature_type_list[i] * setting.d_model_i, N, heads, dropout))
+            self.transformer_list.append(Transformer(n_feature_type_list[i] * self.d_model_i, N, heads, dropout))
 
     def forward(self, src_list, trg_list=None, src_mask=None, trg_mask=None, low_dim = False):
 
         # x = F.relu(self.linear_1(x))
         # x = x if low_dim else self.norm(x)
         # x = self.dropout(x)
+        ### trg_list None is the self conditioned mode, the target is the source itself. The source is projected
+        ### once and the same activations, with the same dropout masks, go into the encoder and the decoder
         assert len(src_list) == len(self.transformer_list), "inputs length is not same with input length for model"
-        src_list_linear = []
-        trg_list_linear = []
-        cur_linear = 0
-        for i in range(len(self.transformer_list)):
-
-            src_list_dim = []
-            trg_list_dim = []
-            for j in range(src_list[i].size(1)):
-                cur_src_dim = src_list[i][:,j:j+1,:]
-                cur_trg_dim = trg_list[i][:,j:j+1,:]
-                cur_src_processed_dim = self.dropouts[cur_linear](F.relu(self.linear_layers[cur_linear](cur_src_dim)))
-                cur_trg_processed_dim = self.dropouts[cur_linear](F.relu(self.linear_layers[cur_linear](cur_trg_dim)))
-                src_list_dim.append(cur_src_processed_dim.contiguous().view([-1, setting.d_model_i, setting.d_model_j]))
-                trg_list_dim.append(cur_trg_processed_dim.contiguous().view([-1, setting.d_model_i, setting.d_model_j]))
-                cur_linear += 1
-            src_list_linear.append(cat(tuple(src_list_dim), dim = 1))
-            trg_list_linear.append(cat(tuple(trg_list_dim), dim = 1))
-
-        output_list = []
-        for i in range(len(self.transformer_list)):
-            src_list_linear[i] = torch.transpose(src_list_linear[i], -1, -2)
-            if self.linear_only:
-                batch_size = src_list_linear[i].size(0)
-                output_list.append(src_list_linear[i].contiguous().view(batch_size, -1))
-            else:
-                trg_list_linear[i] = torch.transpose(trg_list_linear[i], -1, -2)
-                output_list.append(self.transformer_list[i](src_list_linear[i], trg_list_linear[i], low_dim=low_dim))
-        return output_list
+        projected = [self.__projection(i, src_list[i], None if trg_list is None else trg_list[i])
+                     for i in range(len(self.transformer_list))]
+
+        if self.linear_only:
+            return [src.transpose(-1, -2).contiguous().view(src.size(0), -1) for src, _ in projected]
+        return [transformer(src.transpose(-1, -2), trg.transpose(-1, -2), low_dim=low_dim)
+                for transformer, (src, trg) in zip(self.transformer_list, projected)]
+
+    def __projection(self, i, src, trg):
+
+        ### src, trg: batch x feature types x d_input (trg None: self conditioned), returns the projected
+        ### source and target, batch x (feature types * d_model_i) x d_model_j
+        first, num_of_linear_module, grouped = self.linear_groups[i]
+        if self.grouped_projection and grouped and num_of_linear_module == src.size(1):
+            return self.__grouped_projection(first, num_of_linear_module, self.d_model_j_list[i], src, trg)
+
+        shape = [-1, self.d_model_i, self.d_model_j_list[i]]
+        src_linear = cat(tuple(self.dropouts[first + j](F.relu(self.linear_layers[first + j](src[:, j:j+1, :])))
+                               .contiguous().view(shape) for j in range(src.size(1))), dim=1)
+        if trg is None:
+            return src_linear, src_linear
+        trg_linear = cat(tuple(self.dropouts[first + j](F.relu(self.linear_layers[first + j](trg[:, j:j+1, :])))
+                               .contiguous().view(shape) for j in range(trg.size(1))), dim=1)
+        return src_linear, trg_linear
+
+    def __grouped_projection(self, first, num_of_linear_module, d_model_j, src, trg):
+
+        ### every feature type j goes through its own self.linear_layers[first + j]: the layer weights are stacked
+        ### and all feature types of the source and target rows are projected in one batched matmul
+        batch_size = src.size(0)
+        x = src if trg is None else cat((src, trg), dim=0)
+        linears = [self.linear_layers[first + j] for j in range(num_of_linear_module)]
+        weight = torch.stack([linear.weight for linear in linears]).transpose(1, 2)
+        bias = torch.stack([linear.bias for linear in linears]).unsqueeze(1)
+        ### feature types x rows x d_model, dropout masks are drawn independently for every element as with one
+        ### nn.Dropout per feature type
+        x = self.dropouts[first](F.relu(torch.baddbmm(bias, x.transpose(0, 1), weight)))
+        x = x.transpose(0, 1).contiguous().view([-1, num_of_linear_module * self.d_model_i, d_model_j])
+        if trg is None:
+            return x, x
+        return x[:batch_size], x[batch_size:]
 
 class ChemFP(nn.Module):
 
@@ -180,12 +209,14 @@ class TransposeMultiTransformersPlusLinear(TransposeMultiTransformers):
         self.device2 = device('cuda:1')
         super().__init__(d_input_list, d_model_list, n_feature_type_list, N, heads, dropout, masks=masks, linear_only = linear_only)
         out_input_length = sum([d_model_list[i] * n_feature_type_list[i] for i in range(len(d_model_list))])
+        self.drugs_on_the_side = drugs_on_the_side
         if drugs_on_the_side:
-            self.drugs_on_the_side = drugs_on_the_side
             out_input_length += 2 * setting.drug_emb_dim
         self.out = OutputFeedForward(out_input_length, 1, d_layers=setting.output_FF_layers, dropout=dropout)
         self.linear_only = linear_only
         self.classifier = classifier
+        self.self_conditioned = setting.self_conditioned
+        self.neural_fp = setting.neural_fp
         if setting.neural_fp:
             self.drug_fp_a = NeuralFingerprint(setting.drug_input_dim['atom'], setting.drug_input_dim['bond'],
                                                setting.conv_size, setting.drug_emb_dim, setting.degree, device=self.device1)
@@ -198,17 +229,18 @@ class TransposeMultiTransformersPlusLinear(TransposeMultiTransformers):
     def forward(self, *src_list, drugs = None, src_mask=None, trg_mask=None, low_dim = True):
 
         input_src_list = src_list
-        input_trg_list = src_list[::]
+        ### self conditioned: the target is the source, TransposeMultiTransformers projects it only once
+        input_trg_list = None if self.self_conditioned else src_list[::]
         output_list = super().forward(input_src_list, input_trg_list, low_dim=low_dim)
 
         if drugs is not None and self.drugs_on_the_side:
             sub_drugs_a, sub_drugs_b = drugs[0], drugs[1]
             drug_a_embed = self.drug_fp_a(sub_drugs_a)
             drug_b_embed = self.drug_fp_b(sub_drugs_b)
-            if setting.neural_fp:
+            if self.neural_fp:
                 drug_a_embed = torch.sum(drug_a_embed, dim = 1)
                 drug_b_embed = torch.sum(drug_b_embed, dim = 1)
-            output_list += [drug_a_embed, drug_b_embed]
+            output_list = output_list + [drug_a_embed, drug_b_embed]
 
         cat_output = cat(tuple(output_list), dim=1)
         output = self.out(cat_output)
@@ -276,6 +308,18 @@ def get_model(inputs_lengths):
 
     return model
 
+def compile_model(model, mode=None):
+
+    ### mode (default setting.model_compile): None leaves the model as it is, 'compile' runs torch.compile on it in
+    ### place (parameter names and forward hooks are kept). The attention blocks are also TorchScript compatible
+    ### (torch.jit.script(model.transformer_list[i])), there is no script mode as it was not faster here
+    mode = setting.model_compile if mode is None else mode
+    if mode == 'compile':
+        model.compile()
+    else:
+        assert mode is None, "unknown model compile mode {!r}".format(mode)
+    return model
+
 def get_multi_models(inputs_lengths, input_masks = None, drugs_on_the_side = False, classifier = False):
 
     if not isinstance(setting.d_model, list):
@@ -0,0 +1,142 @@
+import os
+import pickle
+import hashlib
+import shutil
+import numpy as np
+import pandas as pd
+from src import setting, logger
+
+
+### Binary columnar cache for the csv/tsv sources read by the data loaders.
+### On the first read a source file is parsed with pd.read_csv and converted into
+###     one float matrix for all float columns (float32 if the table has at least
+###     setting.csv_cache_matrix_min_columns float columns, otherwise kept as it is),
+###     one int32 (or int64 if out of range) array per integer column, e.g. entrez ids,
+###     codes + categories per string column,
+### and the following reads load these arrays memory mapped instead of parsing the text again.
+### The cache entry is keyed by the absolute path and the read_csv arguments and is invalidated
+### as soon as the size or the modification time of the source file changes
+
+def __cache_dir(file_path, kwargs):
+
+    key = hashlib.sha1("{}|{!r}".format(os.path.abspath(file_path), sorted(kwargs.items())).encode()).hexdigest()[:16]
+    return os.path.join(setting.csv_cache_dir, "{}-{}".format(os.path.basename(file_path), key))
+
+def __source_stamp(file_path):
+
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+def __encode_column(values):
+
+    ### return (kind, arrays) of one column
+    if values.dtype.kind in 'iu':
+        if values.size == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+            return 'int', [values.astype(np.int32)]
+        return 'int', [values.astype(np.int64)]
+    if values.dtype.kind == 'O':
+        codes, categories = pd.factorize(values)
+        return 'category', [codes.astype(np.int32), np.array(categories, dtype=object)]
+    return 'raw', [values]
+
+def __decode_column(kind, arrays):
+
+    if kind == 'category':
+        codes, categories = arrays
+        values = categories.take(np.maximum(codes, 0)) if len(categories) else np.full(len(codes), np.nan, dtype=object)
+        if (codes < 0).any():
+            values = values.copy()
+            values[codes < 0] = np.nan
+        return values
+    return arrays[0]
+
+def __dump(df, cache_dir, stamp):
+
+    tmp_dir = cache_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    float_positions = [i for i, dtype in enumerate(df.dtypes) if dtype.kind == 'f']
+    matrix_dtype = np.float32 if len(float_positions) >= setting.csv_cache_matrix_min_columns else None
+    if float_positions:
+        matrix = df.iloc[:, float_positions].values
+        np.save(os.path.join(tmp_dir, 'matrix.npy'), matrix.astype(matrix_dtype or matrix.dtype))
+
+    columns = []
+    for i, dtype in enumerate(df.dtypes):
+        if dtype.kind == 'f':
+            continue
+        kind, arrays = __encode_column(np.asarray(df.iloc[:, i]))
+        columns.append((i, kind, len(arrays)))
+        for j, array in enumerate(arrays):
+            np.save(os.path.join(tmp_dir, 'column_{}_{}.npy'.format(i, j)), array, allow_pickle=True)
+    index_kind, index_arrays = __encode_column(np.asarray(df.index))
+    for j, array in enumerate(index_arrays):
+        np.save(os.path.join(tmp_dir, 'index_{}.npy'.format(j)), array, allow_pickle=True)
+
+    meta = {'source': stamp, 'columns': df.columns, 'float_positions': float_positions, 'other_columns': columns,
+            'index': (index_kind, len(index_arrays), df.index.name, isinstance(df.index, pd.RangeIndex))}
+    with open(os.path.join(tmp_dir, 'meta.pkl'), 'wb') as meta_file:
+        pickle.dump(meta, meta_file, protocol=4)
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+
+def __load(cache_dir, meta):
+
+    def load_array(file_name):
+        ### object arrays (categories) can not be memory mapped
+        try:
+            return np.load(os.path.join(cache_dir, file_name), mmap_mode='c')
+        except ValueError:
+            return np.load(os.path.join(cache_dir, file_name), allow_pickle=True)
+
+    index_kind, n_index_arrays, index_name, range_index = meta['index']
+    float_positions = meta['float_positions']
+    if float_positions:
+        matrix = load_array('matrix.npy')
+    if range_index:
+        index = None
+    else:
+        index = pd.Index(__decode_column(index_kind, [load_array('index_{}.npy'.format(j))
+                                                      for j in range(n_index_arrays)]), name=index_name)
+
+    n_columns = len(meta['columns'])
+    if len(float_positions) == n_columns:
+        df = pd.DataFrame(matrix, index=index)
+    else:
+        data = {}
+        if float_positions:
+            data.update({position: matrix[:, k] for k, position in enumerate(float_positions)})
+        for position, kind, n_arrays in meta['other_columns']:
+            data[position] = __decode_column(kind, [load_array('column_{}_{}.npy'.format(position, j))
+                                                    for j in range(n_arrays)])
+        df = pd.DataFrame(data, index=index, columns=list(range(n_columns)))
+    df.columns = meta['columns']
+    return df
+
+def read_csv(file_path, **kwargs):
+
+    ### drop in replacement of pd.read_csv(file_path, **kwargs) for data source files
+    if not setting.use_csv_cache or not isinstance(file_path, str) or not os.path.exists(file_path):
+        return pd.read_csv(file_path, **kwargs)
+
+    cache_dir = __cache_dir(file_path, kwargs)
+    stamp = __source_stamp(file_path)
+    meta_file = os.path.join(cache_dir, 'meta.pkl')
+    if os.path.exists(meta_file):
+        with open(meta_file, 'rb') as f:
+            meta = pickle.load(f)
+        if meta['source'] == stamp:
+            return __load(cache_dir, meta)
+        logger.debug("{!r} changed, rebuilding its binary cache".format(file_path))
+
+    df = pd.read_csv(file_path, **kwargs)
+    if not os.path.exists(setting.csv_cache_dir):
+        os.makedirs(setting.csv_cache_dir)
+    __dump(df, cache_dir, stamp)
+    logger.debug("Cached {!r} in {!r}".format(file_path, cache_dir))
+    ### return the cached version so that dtypes are the same in the first and the following runs
+    with open(meta_file, 'rb') as f:
+        return __load(cache_dir, pickle.load(f))
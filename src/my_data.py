@@ -1,9 +1,11 @@
 import pandas as pd
 from os import path, mkdir
 import numpy as np
+import pickle
+from scipy.sparse import csr_matrix
 import torch
 from torch.utils import data
-from src import drug_drug, setting, network_propagation, logger
+from src import drug_drug, setting, network_propagation, network_cache, logger, pipeline_cache, csv_cache, utils, device2
 from sklearn.preprocessing import StandardScaler
 from torch import save
 
@@ -25,8 +27,8 @@ class GenesDataReader(CustomDataReader):
     def __genes_initializer(cls):
 
         if cls.genes is None:
-            cls.genes = pd.read_csv(setting.genes,
-                                    dtype={'entrez': np.int})
+            cls.genes = csv_cache.read_csv(setting.genes,
+                                    dtype={'entrez': int})
         assert {'symbol','entrez'}.issubset(set(cls.genes.columns)), \
             "Genes data frame columns name should have symbol and entrez"
 
@@ -52,44 +54,56 @@ class NetworkDataReader(CustomDataReader):
     raw_network=None
     network = None
     entrez_set = None
+    adjacency = None
 
     def __init__(self):
         super().__init__()
 
+    @classmethod
+    def __adjacency_initializer(cls):
+
+        ### binary csr edge list of the network file, node ids of the genes panel first (src/network_cache.py)
+        if cls.entrez_set is None:
+            cls.entrez_set = GenesDataReader.get_gene_entrez_set()
+        if cls.adjacency is None:
+            cls.adjacency = network_cache.get_adjacency(setting.network, cls.entrez_set)
+
     @classmethod
     def __raw_network_initializer(cls):
         if cls.raw_network is None:
-            cls.raw_network = pd.read_csv(setting.network, header=None, sep ='\t')
-            assert len(cls.raw_network.columns) == 3, "genes network file should have three columns"
-            cls.raw_network.columns = ['entrez_a', 'entrez_b', 'association']
-            cls.raw_network = cls.raw_network.astype({'entrez_a': np.int,
-                                                      'entrez_b': np.int,
-                                                      'association': np.float})
+            cls.__adjacency_initializer()
+            cls.raw_network = cls.adjacency.to_frame()
 
     @classmethod
     def __filter_network(cls):
 
-        if cls.entrez_set is None:
-            cls.entrez_set = GenesDataReader.get_gene_entrez_set()
-
+        cls.__adjacency_initializer()
         if cls.network is None:
-            filter = (cls.raw_network['entrez_a'].isin(list(cls.entrez_set))) &\
-                     (cls.raw_network['entrez_b'].isin(list(cls.entrez_set)))
-            cls.network = cls.raw_network[filter]
+            cls.network = cls.adjacency.to_frame(mask=cls.adjacency.panel_edges())
 
     @classmethod
-    def get_network(cls):
+    def get_adjacency(cls):
+        cls.__adjacency_initializer()
+        return cls.adjacency
+
+    @classmethod
+    def get_raw_network(cls):
         cls.__raw_network_initializer()
-        cls.__filter_network()
+        return cls.raw_network
+
+    @classmethod
+    def get_network(cls):
+        if cls.network is None:
+            cls.__filter_network()
         return cls.network
 
     @classmethod
     def check_genes_in_network(cls):
 
-        if cls.network is None:
-            cls.get_network()
+        cls.__adjacency_initializer()
         ### Make sure genes are all in network
-        unfound_genes = set(cls.entrez_set) - (set(cls.network['entrez_a']).union(set(cls.network['entrez_b'])))
+        panel_genes = np.asarray(cls.adjacency.nodes[:cls.adjacency.n_panel])
+        unfound_genes = set(panel_genes[cls.adjacency.panel_degree() == 0])
         if len(unfound_genes) == 0:
             logger.info("Found all genes in networks")
         else:
@@ -103,6 +117,7 @@ class DrugTargetProfileDataLoader(CustomDataLoader):
     drug_target = None
     raw_simulated_drug_target = None
     simulated_drug_target_profile = None
+    propagation_error_bounds = None
 
     def __init__(self):
         super().__init__()
@@ -110,30 +125,47 @@ class DrugTargetProfileDataLoader(CustomDataLoader):
     @classmethod
     def __raw_drug_target_initializer(cls):
         if cls.raw_drug_target_profile is None:
-            cls.raw_drug_target_profile = pd.read_csv(setting.working_dir + "/chemicals/raw_chemicals.csv")
+            cls.raw_drug_target_profile = csv_cache.read_csv(setting.raw_chemicals)
             assert {'Name', 'combin_entrez'}.issubset(set(cls.raw_drug_target_profile.columns)), \
                 "Name and combin_entrez should be in raw_drug_target_profile columns names"
 
+    @staticmethod
+    def build_drug_target_matrix(raw_chemicals, entrez_list):
+
+        ### raw_chemicals: data frame with Name and combin_entrez ("7298,1559") columns
+        ### return: csr_matrix (len(entrez_list), len(raw_chemicals)), 1 if the gene is one of the drug targets
+        ### targets outside of entrez_list and drugs without a target list are ignored, a drug (gene)
+        ### appearing more than once gets the union of all its targets in every of its columns (rows)
+        drug_codes, drug_names = pd.factorize(raw_chemicals['Name'])
+        gene_codes, genes = pd.factorize(pd.Series(list(entrez_list)))
+
+        targets = pd.Series(raw_chemicals['combin_entrez'].astype(object).values).str.split(',').explode().dropna()
+        target_genes = pd.Series(np.arange(len(genes)), index=genes).reindex(targets.str.strip().astype(np.int64).values).values
+        found = ~np.isnan(target_genes)
+        unique_matrix = csr_matrix((np.ones(found.sum()), (target_genes[found].astype(np.int64),
+                                                           drug_codes[targets.index.values[found]])),
+                                   shape=(len(genes), len(drug_names)))
+        unique_matrix.sum_duplicates()
+        unique_matrix.data[:] = 1
+        return unique_matrix[gene_codes, :][:, drug_codes].tocsr()
+
+    @classmethod
+    def get_drug_target_matrix(cls):
+
+        ### return: csr_matrix genes x drugs built from raw_chemicals, rows follow list(entrez_set),
+        ### columns follow raw_chemicals['Name']
+        cls.__raw_drug_target_initializer()
+        return cls.build_drug_target_matrix(cls.raw_drug_target_profile, list(cls.entrez_set))
+
     @classmethod
     def __create_drug_target_profiles(cls):
 
         # return data frame
         # columns: drugs, index: entrez_ID (int)
-        cls.__raw_drug_target_initializer()
-        drug_profile = pd.DataFrame(np.zeros(shape=(len(cls.entrez_set), len(cls.raw_drug_target_profile))),
+        logger.debug("Creating raw drug target data frame")
+        drug_profile = pd.DataFrame(cls.get_drug_target_matrix().toarray(),
                                     index=list(cls.entrez_set),
                                     columns=cls.raw_drug_target_profile['Name'])
-
-        logger.debug("Creating raw drug target data frame")
-        for row in cls.raw_drug_target_profile.iterrows():
-            if not isinstance(row[1]['combin_entrez'], str):
-                continue
-            chem_name, target_list = row[1]['Name'], row[1]['combin_entrez'].split(",")
-            for target in target_list:
-                target = int(target)
-                if target in cls.entrez_set:
-                    drug_profile.loc[target, chem_name] = 1
-
         logger.debug("Create raw drug target data frame successfully")
         return drug_profile
 
@@ -149,7 +181,7 @@ class DrugTargetProfileDataLoader(CustomDataLoader):
         ### 222       0        0        0        0           1            0
         if cls.drug_target is None:
             if not setting.drug_profiles_renew and path.exists(setting.drug_profiles):
-                cls.drug_target = pd.read_csv(setting.drug_profiles, index_col=0)
+                cls.drug_target = csv_cache.read_csv(setting.drug_profiles, index_col=0)
                 cls.drug_target.index = cls.drug_target.index.astype(int)
                 #assert set(cls.drug_target.index).issubset(cls.entrez_set), "Drug Profile index is not correct"
 
@@ -158,6 +190,10 @@ class DrugTargetProfileDataLoader(CustomDataLoader):
                 cls.drug_target.to_csv(setting.drug_profiles)
         return cls.drug_target
 
+    @classmethod
+    def get_drug_target_profiles(cls):
+        return cls.__get_drug_target_profiles()
+
     @classmethod
     def check_unfound_genes_in_drug_target(cls):
 
@@ -182,8 +218,13 @@ class DrugTargetProfileDataLoader(CustomDataLoader):
             cls.__get_drug_target_profiles()
 
         logger.debug("Network propagation (methods: {}) ... ".format(setting.propagation_method))
-        simulated_drug_target_matrix = network_propagation.random_walk_network_propagation(
-                setting.random_walk_simulated_result_matrix)
+        if setting.propagation_method == 'random_walk_push':
+            simulated_drug_target_matrix, cls.propagation_error_bounds = network_propagation.push_network_propagation(
+                NetworkDataReader.get_raw_network(), cls.drug_target, cls.entrez_set)
+        else:
+            simulated_drug_target_matrix = network_propagation.random_walk_network_propagation(
+                setting.random_walk_simulated_result_matrix, NetworkDataReader.get_raw_network(),
+                cls.drug_target, cls.entrez_set)
 
         logger.debug("Network propagation (methods: {}) is Done.".format(setting.propagation_method))
         assert set(simulated_drug_target_matrix.columns).issubset(cls.entrez_set), \
@@ -246,7 +287,7 @@ class SynergyDataReader(CustomDataReader):
     @classmethod
     def __initialize_synergy_score(cls):
         if cls.synergy_score is None:
-            cls.synergy_score = pd.read_csv(setting.synergy_score)
+            cls.synergy_score = csv_cache.read_csv(setting.synergy_score)
             assert {'cell_line', 'drug_a_name', 'drug_b_name'}.issubset(set(cls.synergy_score.columns)), \
                 "'cell_line', 'drug_a_name', 'drug_b_name' are not in synergy score data frame"
 
@@ -256,9 +297,9 @@ class SynergyDataReader(CustomDataReader):
         if cls.drugs_filtered:
             return
         if setting.feature_type == 'LINCS1000':
-            cls.sel_drugs = set(list(pd.read_csv(setting.L1000_upregulation, header = None, index_col=0).index))
+            cls.sel_drugs = set(list(csv_cache.read_csv(setting.L1000_upregulation, header = None, index_col=0).index))
         elif setting.feature_type == 'others':
-            cls.sel_drugs = DrugTargetProfileDataLoader.get_sel_drugs_set() & set(list(pd.read_csv(
+            cls.sel_drugs = DrugTargetProfileDataLoader.get_sel_drugs_set() & set(list(csv_cache.read_csv(
                 setting.L1000_upregulation, header = None, index_col=0).index))
         else:
             cls.sel_drugs = DrugTargetProfileDataLoader.get_sel_drugs_set()
@@ -300,17 +341,97 @@ class SynergyDataReader(CustomDataReader):
     @classmethod
     def get_final_index(cls, pro_filter = False):
 
+        ### legacy combination names drugA_drugB_cellline_row, see IdCatalog for the integer ids
         if cls.final_index is None:
-            synergy_score = cls.get_synergy_score(pro_filter = pro_filter)
-            final_index_1 = synergy_score.reset_index().apply(
-                lambda row: row['drug_a_name'] + '_' + row['drug_b_name'] + '_' +
-                            row['cell_line'] + '_' + str(row['index']), axis=1)
-            final_index_2 = synergy_score.reset_index().apply(
-                lambda row: row['drug_b_name'] + '_' + row['drug_a_name'] + '_' +
-                            row['cell_line'] + '_' + str(row['index']), axis=1)
+            synergy_score = cls.get_synergy_score(pro_filter = pro_filter).reset_index()
+            row = synergy_score['index'].astype(str)
+            final_index_1 = synergy_score['drug_a_name'] + '_' + synergy_score['drug_b_name'] + '_' + \
+                            synergy_score['cell_line'] + '_' + row
+            final_index_2 = synergy_score['drug_b_name'] + '_' + synergy_score['drug_a_name'] + '_' + \
+                            synergy_score['cell_line'] + '_' + row
             cls.final_index = pd.concat([final_index_1, final_index_2], axis=0).reset_index(drop=True)
         return cls.final_index
 
+class IdCatalog(CustomDataReader):
+
+    ### Integer ids of the entities in the synergy data set, names are only resolved for reports
+    ###     drugs, cell lines: int32 code = position in the sorted names
+    ###     genes: int32 code = position in the sorted entrez IDs
+    ###     combinations: int64 id = row of final_index, the feature store and Y
+    ###         id < n: drug_a, drug_b and cell line of row id of the synergy score
+    ###         id >= n: the combination id - n with drug_a and drug_b switched
+    drugs = None
+    cell_lines = None
+    genes = None
+    combinations = None
+
+    def __init__(self):
+        super().__init__()
+
+    @classmethod
+    def __catalog_initializer(cls):
+
+        if cls.combinations is None:
+            synergy_score = SynergyDataReader.get_synergy_score()
+            cls.drugs = pd.Index(sorted(set(synergy_score['drug_a_name']) | set(synergy_score['drug_b_name'])))
+            cls.cell_lines = pd.Index(sorted(set(synergy_score['cell_line'])))
+            cls.genes = pd.Index(sorted(GenesDataReader.get_gene_entrez_set()))
+            drug_a = cls.drugs.get_indexer(synergy_score['drug_a_name']).astype(np.int32)
+            drug_b = cls.drugs.get_indexer(synergy_score['drug_b_name']).astype(np.int32)
+            cell_line = cls.cell_lines.get_indexer(synergy_score['cell_line']).astype(np.int32)
+            n = len(synergy_score)
+            cls.combinations = pd.DataFrame({'drug_a': np.concatenate([drug_a, drug_b]),
+                                             'drug_b': np.concatenate([drug_b, drug_a]),
+                                             'cell_line': np.concatenate([cell_line, cell_line]),
+                                             'row': np.concatenate([np.arange(n), np.arange(n)])},
+                                            index=pd.Index(np.arange(2 * n, dtype=np.int64), name='id'))
+
+    @classmethod
+    def get_drugs(cls):
+        cls.__catalog_initializer()
+        return cls.drugs
+
+    @classmethod
+    def get_cell_lines(cls):
+        cls.__catalog_initializer()
+        return cls.cell_lines
+
+    @classmethod
+    def get_genes(cls):
+        cls.__catalog_initializer()
+        return cls.genes
+
+    @classmethod
+    def get_combinations(cls):
+
+        ### return data frame, index = combination id
+        ###       drug_a  drug_b  cell_line  row
+        ### id
+        ### 0          3      12          5    0
+        cls.__catalog_initializer()
+        return cls.combinations
+
+    @classmethod
+    def get_names(cls, ids):
+
+        ### return: ndarray of legacy names drugA_drugB_cellline_row of the combinations ids
+        cls.__catalog_initializer()
+        combinations = cls.combinations.loc[np.asarray(ids, dtype=np.int64)]
+        return (cls.drugs.values[combinations['drug_a'].values].astype(object) + '_' +
+                cls.drugs.values[combinations['drug_b'].values].astype(object) + '_' +
+                cls.cell_lines.values[combinations['cell_line'].values].astype(object) + '_' +
+                combinations['row'].astype(str).values.astype(object))
+
+    @classmethod
+    def save(cls, file_path):
+
+        ### plain python / pandas objects only, so that report scripts (shap_analysis) can load
+        ### the catalog without importing the data loaders
+        cls.__catalog_initializer()
+        with open(file_path, 'wb+') as catalog_file:
+            pickle.dump({'drugs': list(cls.drugs), 'cell_lines': list(cls.cell_lines), 'genes': list(cls.genes),
+                         'combinations': cls.combinations}, catalog_file)
+
 class GeneDependenciesDataReader(CustomDataReader):
 
     genes_dp_indexes = None
@@ -327,14 +448,14 @@ class GeneDependenciesDataReader(CustomDataReader):
     @classmethod
     def __initialize_genes_dp_indexes(cls):
         if cls.genes_dp_indexes is None:
-            cls.genes_dp_indexes = pd.read_csv(setting.working_dir + "/cl_gene_dp/all_dependencies_genes_map.csv",
-                                               usecols=['symbol', 'entrez'], dtype={'entrez': np.int})
+            cls.genes_dp_indexes = csv_cache.read_csv(setting.genes_dp_indexes,
+                                               usecols=['symbol', 'entrez'], dtype={'entrez': int})
     @classmethod
     def __initialize_genes_dp(cls):
 
         cls.__initialize_genes_dp_indexes()
         if cls.genes_dp is None:
-            cls.genes_dp = pd.read_csv(setting.cl_genes_dp)
+            cls.genes_dp = csv_cache.read_csv(setting.cl_genes_dp)
             if cls.genes_dp.shape[0] < 40:
                 cls.genes_dp = cls.genes_dp.set_index('Unnamed: 0').T
                 cls.genes_dp.index = [int(x.split("(")[1][:-1]) for x in list(cls.genes_dp.index)]
@@ -367,7 +488,7 @@ class GeneDependenciesDataReader(CustomDataReader):
         cls.genes_dp = cls.genes_dp.loc[cls.genes_dp.index.intersection(index_filter_1)].reindex(index_filter_1)
         cls.gene_filtered = True
         print(len(index_filter_1))
-        assert len(index_filter_1) != 0 and isinstance(index_filter_1[0], np.int), "entrezID filter should be integer"
+        assert len(index_filter_1) != 0 and isinstance(index_filter_1[0], int), "entrezID filter should be integer"
 
     @classmethod
     def __rm_duplications(cls):
@@ -443,7 +564,7 @@ class ExpressionDataLoader(CustomDataLoader):
         ### return: gene expression data frame
 
         if cls.gene_expression is None:
-            cls.gene_expression = pd.read_csv(setting.gene_expression, sep='\t')
+            cls.gene_expression = csv_cache.read_csv(setting.gene_expression, sep='\t')
             logger.debug("Read in gene expresion data successfully")
             cls.gene_expression.set_index(keys='Entrez', inplace=True)
         return cls.gene_expression
@@ -455,7 +576,7 @@ class ExpressionDataLoader(CustomDataLoader):
         ### return: gene expression data frame
 
         if cls.backup_expression is None:
-            cls.backup_expression = pd.read_csv(setting.backup_expression, sep='\t')
+            cls.backup_expression = csv_cache.read_csv(setting.backup_expression, sep='\t')
             logger.debug("Read in back up expresion data successfully")
             cls.backup_expression.set_index(keys='Entrez', inplace=True)
         return cls.backup_expression
@@ -528,7 +649,7 @@ class NetExpressDataLoader(CustomDataLoader):
         ### return: gene expression data frame
 
         if cls.netexpress_df is None:
-            cls.netexpress_df = pd.read_csv(setting.netexpress_df, sep='\t')
+            cls.netexpress_df = csv_cache.read_csv(setting.netexpress_df, sep='\t')
             logger.debug("Read in netexpress data successfully")
         return cls.netexpress_df
 
@@ -574,9 +695,9 @@ class ECFPDataLoader(CustomDataLoader):
     def __dataloader_initializer(cls):
 
         if cls.drug_ECFP is None:
-            cls.drug_ECFP = pd.read_csv(setting.drug_ECFP)
+            cls.drug_ECFP = csv_cache.read_csv(setting.drug_ECFP)
         if cls.cl_ECFP is None:
-            cls.cl_ECFP = pd.read_csv(setting.cl_ECFP, index_col=0)
+            cls.cl_ECFP = csv_cache.read_csv(setting.cl_ECFP, index_col=0)
 
     @classmethod
     def get_drug_ecfp_data(cls, save_each_data_point = setting.save_each_ecfp_phy_data_point):
@@ -628,9 +749,9 @@ class PhysicochemDataLoader(CustomDataLoader):
     def __dataloader_initializer(cls):
 
         if cls.drug_physicochem is None:
-            cls.drug_physicochem = pd.read_csv(setting.drug_physicochem, index_col=0)
+            cls.drug_physicochem = csv_cache.read_csv(setting.drug_physicochem, index_col=0)
         if cls.cl_physicochem is None:
-            cls.cl_physicochem = pd.read_csv(setting.cl_physicochem, index_col = 0)
+            cls.cl_physicochem = csv_cache.read_csv(setting.cl_physicochem, index_col = 0)
 
     @classmethod
     def get_drug_physicochem_property(cls, save_each_data_point = setting.save_each_ecfp_phy_data_point):
@@ -674,15 +795,62 @@ class PhysicochemDataLoader(CustomDataLoader):
 class SingleResponseDataLoader(CustomDataLoader):
 
     single_response = None
+    pIC50_table = None
+    pIC50_cell_lines = None
+    pIC50_drugs = None
 
     def __init__(self):
         super().__init__()
 
+    @classmethod
+    def __pIC50_table_initializer(cls):
+
+        ### dense (cell line x drug) array of pIC50 scaled by StandardScaler(with_mean=False), nan if not measured
+        ###           5-FU    ABT-888   ...
+        ### A2058     2.31     2.30
+        ### A2780     2.12     nan
+        if cls.pIC50_table is None:
+            single_response = csv_cache.read_csv(setting.single_response, index_col=0)
+            drugs = single_response['drug'].str.upper()
+            pIC50 = StandardScaler(with_mean=False).fit_transform(single_response[['pIC50']]).reshape(-1)
+            cls.pIC50_cell_lines = pd.Index(sorted(set(single_response['cell_line'])))
+            cls.pIC50_drugs = pd.Index(sorted(set(drugs)))
+            cls.pIC50_table = np.full((len(cls.pIC50_cell_lines), len(cls.pIC50_drugs)), np.nan, dtype=np.float32)
+            cls.pIC50_table[cls.pIC50_cell_lines.get_indexer(single_response['cell_line']),
+                            cls.pIC50_drugs.get_indexer(drugs)] = pIC50
+
+    @classmethod
+    def get_pIC50_table(cls, cell_lines, drugs):
+
+        ### return: ndarray (len(cell_lines), len(drugs)), the pIC50 table reordered to the given cell lines and
+        ### drugs, e.g. IdCatalog.get_cell_lines() and IdCatalog.get_drugs() so that it can be indexed by codes
+        cls.__pIC50_table_initializer()
+        cell_line_codes = cls.pIC50_cell_lines.get_indexer(list(cell_lines))
+        drug_codes = cls.pIC50_drugs.get_indexer([str(drug).upper() for drug in drugs])
+        table = np.full((len(cell_line_codes), len(drug_codes)), np.nan, dtype=np.float32)
+        found_cell_lines, found_drugs = cell_line_codes >= 0, drug_codes >= 0
+        table[np.ix_(found_cell_lines, found_drugs)] = \
+            cls.pIC50_table[np.ix_(cell_line_codes[found_cell_lines], drug_codes[found_drugs])]
+        return table
+
+    @classmethod
+    def get_pIC50(cls, drugs, cell_lines):
+
+        ### drugs, cell_lines: names of the drug and the cell line of every pair
+        ### return: ndarray (n_pairs,), scaled pIC50, nan if the pair was not measured
+        cls.__pIC50_table_initializer()
+        drug_codes = cls.pIC50_drugs.get_indexer([str(drug).upper() for drug in drugs])
+        cell_line_codes = cls.pIC50_cell_lines.get_indexer(list(cell_lines))
+        found = (drug_codes >= 0) & (cell_line_codes >= 0)
+        pIC50 = np.full(len(drug_codes), np.nan, dtype=np.float32)
+        pIC50[found] = cls.pIC50_table[cell_line_codes[found], drug_codes[found]]
+        return pIC50
+
     @classmethod
     def __dataloader_initializer(cls):
 
         if cls.single_response is None:
-            cls.single_response = pd.read_csv(setting.single_response, index_col=0).drop(['mean', 'sigma'], axis=1)
+            cls.single_response = csv_cache.read_csv(setting.single_response, index_col=0).drop(['mean', 'sigma'], axis=1)
             cls.single_response['drug'] = cls.single_response['drug'].str.upper()
             cls.single_response.set_index(['cell_line', 'drug'], inplace = True)
 
@@ -709,7 +877,7 @@ class ProteomicsDataLoader(CustomDataLoader):
     def __dataloader_initializer(cls):
 
         if cls.proteomics is None:
-            cls.proteomics = pd.read_csv(setting.ccle_pro, index_col=0)
+            cls.proteomics = csv_cache.read_csv(setting.ccle_pro, index_col=0)
 
     @classmethod
     def get_proteomics(cls, save_each_data_point = setting.save_each_ecfp_phy_data_point):
@@ -746,12 +914,12 @@ class RepresentationSamplesDataLoader(CustomDataLoader):
         ######################
         ### 5-FU ....
         #####################
-        cls.L1000_downregulation = pd.read_csv(setting.L1000_upregulation, header = None, index_col = 0)
+        cls.L1000_downregulation = csv_cache.read_csv(setting.L1000_upregulation, header = None, index_col = 0)
 
         ######################
         ### A2058 ......
         #####################
-        cls.F_cl = pd.read_csv(setting.F_cl, header = None, index_col = 0)
+        cls.F_cl = csv_cache.read_csv(setting.F_cl, header = None, index_col = 0)
 
         ### Reading synergy score data ###
         ### Unnamed: 0,drug_a_name,drug_b_name,cell_line,synergy
@@ -842,6 +1010,7 @@ class SamplesDataLoader(CustomDataLoader):
     var_filter = None
     raw_x = None
     combine_drug_multi_gene_express = None
+    drug_pair_target = None
     single_drug_response = None
 
     def __init__(self):
@@ -882,33 +1051,29 @@ class SamplesDataLoader(CustomDataLoader):
         ### entrez
         ### 1001
         ### 10001
-        if 'gene_dependence' in setting.cellline_features:
-            cls.sel_dp = GeneDependenciesDataReader.get_gene_dp()
-
         ### Prepare gene expression data information
-        cls.expression_df = ExpressionDataLoader.prepare_expresstion_df(entrezIDs=list(cls.entrez_set),
-                                                                            celllines=list(cls.cellline_set))
-
-        if 'netexpress' in setting.cellline_features:
-            cls.netexpress_df = NetExpressDataLoader.prepare_netexpress_df(entrezIDs=list(cls.entrez_set))
+        cls.get_cellline_entity_features()
 
         if setting.add_single_response_to_drug_target:
-            from sklearn.preprocessing import StandardScaler
-            scaler = StandardScaler(with_mean=False)
-            cls.single_drug_response = pd.read_csv(setting.single_response, index_col=0)
-            cls.single_drug_response['pIC50'] = scaler.fit_transform(cls.single_drug_response[['pIC50']]).reshape(-1,1)
-            if 'drug' in cls.single_drug_response.columns:
-                cls.single_drug_response['drug'] = cls.single_drug_response['drug'].str.upper()
+            ### (cell line x drug) pIC50 table, gathered by IdCatalog codes in __single_response_prep
+            cls.single_drug_response = SingleResponseDataLoader.get_pIC50_table(IdCatalog.get_cell_lines(),
+                                                                                IdCatalog.get_drugs())
 
         ######################
         ### 5-FU ....
         #####################
         if 'L1000_upregulation' in setting.drug_features:
-            cls.L1000_upregulation = pd.read_csv(setting.L1000_upregulation, header = None, index_col = 0)
+            cls.L1000_upregulation = csv_cache.read_csv(setting.L1000_upregulation, header = None, index_col = 0)
         if 'L1000_downregulation' in setting.drug_features:
-            cls.L1000_downregulation = pd.read_csv(setting.L1000_downregulation, header = None, index_col = 0)
+            cls.L1000_downregulation = csv_cache.read_csv(setting.L1000_downregulation, header = None, index_col = 0)
 
-        if 'combine_drugs_for_cl' in setting.cellline_features:
+        if 'combine_drugs_for_cl' in setting.cellline_features and setting.factorized_features:
+
+            ### combinations x genes features are gathered per batch from these pair level targets, see EntityFeatureTables
+            cls.drug_pair_target = network_propagation.drug_pair_target_as_0_network_propagation(
+                cls.network, cls.entrez_set, cls.simulated_drug_target, cls.synergy_score[['drug_a_name', 'drug_b_name']])
+
+        elif 'combine_drugs_for_cl' in setting.cellline_features:
 
             cls.combine_drug_multi_gene_express = \
             network_propagation.drug_combine_multiplication_gene_expression_network_propagation(cls.network,
@@ -923,6 +1088,92 @@ class SamplesDataLoader(CustomDataLoader):
 
 
 
+    @classmethod
+    def get_cellline_entity_features(cls):
+
+        ### return dict of per cell line data frames, index = genes, columns = cell lines
+        entrez_set = GenesDataReader.get_gene_entrez_set()
+        if cls.sel_dp is None and 'gene_dependence' in setting.cellline_features:
+            cls.sel_dp = GeneDependenciesDataReader.get_gene_dp()
+
+        if cls.expression_df is None:
+            cellline_set = SynergyDataReader.get_synergy_data_cell_lines()
+            cls.expression_df = ExpressionDataLoader.prepare_expresstion_df(entrezIDs=list(entrez_set),
+                                                                            celllines=list(cellline_set))
+
+        if cls.netexpress_df is None and 'netexpress' in setting.cellline_features:
+            cls.netexpress_df = NetExpressDataLoader.prepare_netexpress_df(entrezIDs=list(entrez_set))
+        return {'sel_dp': cls.sel_dp, 'expression_df': cls.expression_df, 'netexpress_df': cls.netexpress_df}
+
+    @classmethod
+    def set_cellline_entity_features(cls, features):
+
+        cls.sel_dp, cls.expression_df, cls.netexpress_df = \
+            features['sel_dp'], features['expression_df'], features['netexpress_df']
+        if cls.sel_dp is not None:
+            GeneDependenciesDataReader.genes_dp = cls.sel_dp
+            GeneDependenciesDataReader.cell_line_filtered = True
+            GeneDependenciesDataReader.gene_filtered = True
+            GeneDependenciesDataReader.var_filtered = True
+
+    @classmethod
+    def __single_response_prep(cls, drug_column, rows = slice(None)):
+
+        ### return: ndarray (n_combinations,), pIC50 of the drug in drug_column for the combinations in rows,
+        ### nan if the pair was not measured
+        combinations = IdCatalog.get_combinations().iloc[:len(cls.synergy_score)].iloc[rows]
+        drug_codes = combinations['drug_a' if drug_column == 'drug_a_name' else 'drug_b'].values
+        single_response = cls.single_drug_response[combinations['cell_line'].values, drug_codes]
+        if np.isnan(single_response).any():
+            logger.debug("{!r} combinations have no single response for {!r}".format(
+                int(np.isnan(single_response).sum()), drug_column))
+        return single_response
+
+    @classmethod
+    def __drug_blocks(cls, rows):
+
+        ### drug_a and drug_b feature blocks of the combinations in rows (a slice of synergy score)
+        ### return: [drug_a blocks], [drug_b blocks], [block lengths]
+        synergy_score = cls.synergy_score.iloc[rows]
+        drug_a_blocks, drug_b_blocks, lengths = [], [], []
+        if 'drug_target_profile' in setting.drug_features:
+
+            drug_a_target_feature = cls.simulated_drug_target.loc[list(synergy_score['drug_a_name']), :]
+            drug_a_target_feature = pd.DataFrame(drug_a_target_feature, columns=cls.entrez_set).reset_index(drop=True)
+            if setting.add_single_response_to_drug_target:
+
+                # drug_a_single_response = cls.single_drug_response.loc[list(cls.synergy_score['drug_a_name']), :]
+                drug_a_target_feature['pIC50'] = cls.__single_response_prep('drug_a_name', rows)
+
+            drug_a_target_feature.fillna(0, inplace=True)
+            drug_a_blocks.append(drug_a_target_feature.values)
+            lengths.append(drug_a_target_feature.shape[1])
+            drug_b_target_feature = cls.simulated_drug_target.loc[list(synergy_score['drug_b_name']), :]
+            drug_b_target_feature = pd.DataFrame(drug_b_target_feature, columns=cls.entrez_set).reset_index(drop=True)
+            if setting.add_single_response_to_drug_target:
+                # drug_b_single_response = cls.single_drug_response.loc[list(cls.synergy_score['drug_b_name']), :]
+                drug_b_target_feature['pIC50'] = cls.__single_response_prep('drug_b_name', rows)
+            drug_b_target_feature.fillna(0, inplace=True)
+            drug_b_blocks.append(drug_b_target_feature.values)
+
+        if 'L1000_upregulation' in setting.drug_features:
+
+            drug_a_F_feature = cls.L1000_upregulation.loc[list(synergy_score['drug_a_name']), :]
+            drug_a_blocks.append(drug_a_F_feature.values)
+            lengths.append(drug_a_F_feature.shape[1])
+            drug_b_F_feature = cls.L1000_upregulation.loc[list(synergy_score['drug_b_name']), :]
+            drug_b_blocks.append(drug_b_F_feature.values)
+
+        if 'L1000_downregulation' in setting.drug_features:
+
+            drug_a_F_feature_2 = cls.L1000_downregulation.loc[list(synergy_score['drug_a_name']), :]
+            drug_a_blocks.append(drug_a_F_feature_2.values)
+            lengths.append(drug_a_F_feature_2.shape[1])
+            drug_b_F_feature_2 = cls.L1000_downregulation.loc[list(synergy_score['drug_b_name']), :]
+            drug_b_blocks.append(drug_b_F_feature_2.values)
+
+        return drug_a_blocks, drug_b_blocks, lengths
+
     @classmethod
     def __drug_features_prep(cls):
 
@@ -931,107 +1182,135 @@ class SamplesDataLoader(CustomDataLoader):
         if cls.drug_a_features is None or cls.drug_b_features is None or cls.drug_features is None:
             cls.__dataloader_initializer()
             cls.drug_features = []
-            cls.drug_a_features = []
-            cls.drug_b_features = []
-
-            if 'drug_target_profile' in setting.drug_features:
-
-                drug_a_target_feature = cls.simulated_drug_target.loc[list(cls.synergy_score['drug_a_name']), :]
-                drug_a_target_feature = pd.DataFrame(drug_a_target_feature, columns=cls.entrez_set).reset_index(drop=True)
-                if setting.add_single_response_to_drug_target:
-
-                    # drug_a_single_response = cls.single_drug_response.loc[list(cls.synergy_score['drug_a_name']), :]
-
-                    drug_a_single_response = cls.single_drug_response.merge(cls.synergy_score,
-                                                                            left_on = ['drug', 'cell_line'],
-                                                                            right_on = ['drug_a_name', 'cell_line'])['pIC50'].values
-                    assert len(drug_a_single_response) == len(drug_a_target_feature), "single repsonse data didn't have same length with drug feature"
-                    drug_a_target_feature['pIC50'] = drug_a_single_response
-
-                drug_a_target_feature.fillna(0, inplace=True)
-                cls.drug_a_features.append(drug_a_target_feature.values)
-                cls.drug_features_lengths.append(drug_a_target_feature.shape[1])
-                drug_b_target_feature = cls.simulated_drug_target.loc[list(cls.synergy_score['drug_b_name']), :]
-                drug_b_target_feature = pd.DataFrame(drug_b_target_feature, columns=cls.entrez_set).reset_index(drop=True)
-                if setting.add_single_response_to_drug_target:
-                    # drug_b_single_response = cls.single_drug_response.loc[list(cls.synergy_score['drug_b_name']), :]
-                    drug_b_single_response = cls.single_drug_response.merge(cls.synergy_score,
-                                                                            left_on = ['drug', 'cell_line'],
-                                                                            right_on = ['drug_b_name', 'cell_line'])['pIC50'].values
-                    assert len(drug_b_single_response) == len(drug_b_target_feature), "single repsonse data didn't have same length with drug feature"
-
-                    drug_b_target_feature['pIC50'] = drug_b_single_response
-                drug_b_target_feature.fillna(0, inplace=True)
-                cls.drug_b_features.append(drug_b_target_feature.values)
-
-            if 'L1000_upregulation' in setting.drug_features:
-
-                drug_a_F_feature = cls.L1000_upregulation.loc[list(cls.synergy_score['drug_a_name']), :]
-                cls.drug_a_features.append(drug_a_F_feature.values)
-                cls.drug_features_lengths.append(drug_a_F_feature.shape[1])
-                drug_b_F_feature = cls.L1000_upregulation.loc[list(cls.synergy_score['drug_b_name']), :]
-                cls.drug_b_features.append(drug_b_F_feature.values)
-
-            if 'L1000_downregulation' in setting.drug_features:
-
-                drug_a_F_feature_2 = cls.L1000_downregulation.loc[list(cls.synergy_score['drug_a_name']), :]
-                cls.drug_a_features.append(drug_a_F_feature_2.values)
-                cls.drug_features_lengths.append(drug_a_F_feature_2.shape[1])
-                drug_b_F_feature_2 = cls.L1000_downregulation.loc[list(cls.synergy_score['drug_b_name']), :]
-                cls.drug_b_features.append(drug_b_F_feature_2.values)
+            cls.drug_a_features, cls.drug_b_features, lengths = cls.__drug_blocks(slice(None))
+            cls.drug_features_lengths.extend(lengths)
 
         return [cls.drug_a_features, cls.drug_b_features]
 
+    @classmethod
+    def __cellline_blocks(cls, rows):
+
+        ### cell line feature blocks of the combinations in rows (a slice of synergy score)
+        ### return: [blocks], [block lengths]
+        synergy_score = cls.synergy_score.iloc[rows]
+        blocks = []
+        dp_features = None
+        ### generate cell lines features
+        if 'gene_dependence' in setting.cellline_features:
+
+            dp_features = cls.sel_dp[list(synergy_score['cell_line'])].T
+            dp_features = pd.DataFrame(dp_features, columns=cls.entrez_set).reset_index(drop=True)
+            dp_features.fillna(0, inplace=True)
+            blocks.append(dp_features.values)
+        if 'combine_drugs_for_cl' in setting.cellline_features:
+
+            combine_drug_multi_gene_express = pd.DataFrame(cls.combine_drug_multi_gene_express.iloc[rows],
+                                                           columns=cls.entrez_set).reset_index(drop=True)
+            combine_drug_multi_gene_express.fillna(0, inplace=True)
+            if setting.expression_dependencies_interaction and dp_features is not None:
+                combine_drug_multi_gene_express = pd.DataFrame(np.multiply(combine_drug_multi_gene_express.values, dp_features.values),
+                                                        index=combine_drug_multi_gene_express.index,
+                                                        columns=combine_drug_multi_gene_express.columns)
+            blocks.append(combine_drug_multi_gene_express.values)
+
+        if 'gene_expression' in setting.cellline_features:
+            cellline_express_features = cls.expression_df.T.loc[list(synergy_score['cell_line']), :]
+            blocks.append(cellline_express_features.values)
+
+        if 'netexpress' in setting.cellline_features:
+            netexpress_feature = cls.netexpress_df.T.loc[list(synergy_score['cell_line']), :]
+            blocks.append(netexpress_feature.values)#.values/np.absolute(netexpress_feature.values).max())
+
+        if setting.add_single_response_to_drug_target:
+
+            # cell_line_single_response = cls.single_drug_response.loc[list(cls.synergy_score['cell_line']), :]
+            # cls.cellline_features[i] = np.concatenate([cls.cellline_features[i], cell_line_single_response.values], axis = 1)
+            blocks = [np.concatenate([block, np.zeros((len(block), 1))], axis=1) for block in blocks]
+
+        return blocks, [block.shape[1] for block in blocks]
+
     @classmethod
     def __cellline_features_prep(cls):
 
         if cls.cellline_features is None:
             cls.__dataloader_initializer()
-            cls.cellline_features = []
-            dp_features = None
-            ### generate cell lines features
-            if 'gene_dependence' in setting.cellline_features:
-
-                dp_features = cls.sel_dp[list(cls.synergy_score['cell_line'])].T
-                dp_features = pd.DataFrame(dp_features, columns=cls.entrez_set).reset_index(drop=True)
-                dp_features.fillna(0, inplace=True)
-                cls.cellline_features.append(dp_features.values)
-                cls.cellline_features_lengths.append(dp_features.shape[1])
-            if 'combine_drugs_for_cl' in setting.cellline_features:
-
-                combine_drug_multi_gene_express = pd.DataFrame(cls.combine_drug_multi_gene_express, columns=cls.entrez_set).reset_index(drop=True)
-                combine_drug_multi_gene_express.fillna(0, inplace=True)
-                if setting.expression_dependencies_interaction and dp_features is not None:
-                    combine_drug_multi_gene_express = pd.DataFrame(np.multiply(combine_drug_multi_gene_express.values, dp_features.values),
-                                                            index=combine_drug_multi_gene_express.index,
-                                                            columns=combine_drug_multi_gene_express.columns)
-                cls.cellline_features.append(combine_drug_multi_gene_express.values)
-                cls.cellline_features_lengths.append(combine_drug_multi_gene_express.shape[1])
-
-            if 'gene_expression' in setting.cellline_features:
-                cellline_express_features = cls.expression_df.T.loc[list(cls.synergy_score['cell_line']), :]
-                cls.cellline_features.append(cellline_express_features.values)
-                cls.cellline_features_lengths.append(cellline_express_features.shape[1])
-
-            if 'netexpress' in setting.cellline_features:
-                netexpress_feature = cls.netexpress_df.T.loc[list(cls.synergy_score['cell_line']), :]
-                cls.cellline_features.append(netexpress_feature.values)#.values/np.absolute(netexpress_feature.values).max())
-                cls.cellline_features_lengths.append(netexpress_feature.shape[1])
+            cls.cellline_features, lengths = cls.__cellline_blocks(slice(None))
+            cls.cellline_features_lengths.extend(lengths)
 
-            if setting.add_single_response_to_drug_target:
+        return cls.cellline_features
 
+    @classmethod
+    def __entity_tables_prep(cls):
 
-                for i in range(len(cls.cellline_features)):
-                    # cell_line_single_response = cls.single_drug_response.loc[list(cls.synergy_score['cell_line']), :]
-                    # assert len(cell_line_single_response) == len(cls.cellline_features[i]), "single repsonse data didn't have same length with cell line fetures"
-                    # cls.cellline_features[i] = np.concatenate([cls.cellline_features[i], cell_line_single_response.values], axis = 1)
+        ### Factorized raw X: one row per drug and one row per cell line instead of one row per combination
+        ### drug table:      drug_target_profile (+ pIC50 placeholder), L1000 features ...   index = drugs
+        ### cell line table: gene_dependence, gene_expression, netexpress ...               index = cell lines
+        ### ids:             (drug_a, drug_b, cell_line) IdCatalog codes = row numbers in the tables for every combination
+        ### combine_drugs_for_cl: propagated pair targets (index = drug pairs) times a per cell line factor,
+        ###                       gene expression (x gene dependence), multiplied per batch
+        cls.__dataloader_initializer()
+        drugs, celllines = list(IdCatalog.get_drugs()), list(IdCatalog.get_cell_lines())
 
-                    cls.cellline_features[i] = np.concatenate([cls.cellline_features[i],
-                                                        np.array([[0] * len(cls.cellline_features[i])]).reshape(-1,1)],
-                                                       axis=1)
-                    cls.cellline_features_lengths[i] += 1
+        drug_blocks = []
+        response, response_column = None, None
+        if 'drug_target_profile' in setting.drug_features:
+            drug_target_feature = pd.DataFrame(cls.simulated_drug_target.loc[drugs, :], columns=cls.entrez_set)
+            if setting.add_single_response_to_drug_target:
+                ### pIC50 depends on drug and cell line, it is stored per combination and written into this column
+                response_column = drug_target_feature.shape[1]
+                drug_target_feature['pIC50'] = 0
+                response = np.stack([cls.__single_response_prep('drug_a_name'),
+                                     cls.__single_response_prep('drug_b_name')], axis=1)
+                response = np.nan_to_num(response.astype(np.float32))
+            drug_target_feature.fillna(0, inplace=True)
+            drug_blocks.append(drug_target_feature.values)
+            cls.drug_features_lengths.append(drug_target_feature.shape[1])
+        if 'L1000_upregulation' in setting.drug_features:
+            drug_blocks.append(cls.L1000_upregulation.loc[drugs, :].values)
+            cls.drug_features_lengths.append(drug_blocks[-1].shape[1])
+        if 'L1000_downregulation' in setting.drug_features:
+            drug_blocks.append(cls.L1000_downregulation.loc[drugs, :].values)
+            cls.drug_features_lengths.append(drug_blocks[-1].shape[1])
+
+        cellline_blocks = []
+        dp_features = None
+        padding = 1 if setting.add_single_response_to_drug_target else 0
+        combinations = IdCatalog.get_combinations().iloc[:len(cls.synergy_score)]
+        pair_block = None
+        if 'gene_dependence' in setting.cellline_features:
+            dp_features = pd.DataFrame(cls.sel_dp[celllines].T, columns=cls.entrez_set)
+            dp_features.fillna(0, inplace=True)
+            cellline_blocks.append(dp_features.values)
+        if 'combine_drugs_for_cl' in setting.cellline_features:
+            pair_codes, pairs = pd.factorize(combinations['drug_a'].values * len(drugs) + combinations['drug_b'].values)
+            pair_names = [drugs[pair // len(drugs)] + '_' + drugs[pair % len(drugs)] for pair in pairs]
+            missing_pairs = [pair for pair in pair_names if pair not in cls.drug_pair_target.index]
+            assert not missing_pairs, "drug pairs without propagated targets: {!r}".format(missing_pairs[:5])
+            pair_target = cls.drug_pair_target.loc[pair_names].reindex(columns=list(cls.entrez_set)).values
+            pair_factor = cls.expression_df.T.reindex(index=celllines, columns=list(cls.entrez_set)).values
+            if setting.expression_dependencies_interaction and dp_features is not None:
+                pair_factor = pair_factor * dp_features.values
+            ### a missing gene makes the product 0, as the fillna(0) of the combinations x genes matrix did
+            pair_block = {'table': np.nan_to_num(pair_target).astype(np.float32), 'ids': pair_codes.astype(np.int64),
+                          'factor': np.nan_to_num(pair_factor).astype(np.float32), 'padding': padding,
+                          'offset': sum(block.shape[1] + padding for block in cellline_blocks)}
+        if 'gene_expression' in setting.cellline_features:
+            cellline_blocks.append(cls.expression_df.T.loc[celllines, :].values)
+        if 'netexpress' in setting.cellline_features:
+            cellline_blocks.append(cls.netexpress_df.T.loc[celllines, :].values)
+        if setting.add_single_response_to_drug_target:
+            cellline_blocks = [np.concatenate([block, np.zeros((len(block), 1))], axis=1) for block in cellline_blocks]
+        cls.cellline_features_lengths.extend([block.shape[1] for block in cellline_blocks])
+        if pair_block is not None:
+            position = 1 if dp_features is not None else 0
+            cls.cellline_features_lengths.insert(len(cls.cellline_features_lengths) - len(cellline_blocks) + position,
+                                                 pair_block['table'].shape[1] + padding)
 
-        return cls.cellline_features
+        ids = combinations[['drug_a', 'drug_b', 'cell_line']].values.astype(np.int64)
+        return EntityFeatureTables(np.concatenate(drug_blocks, axis=1).astype(np.float32),
+                                   np.concatenate(cellline_blocks, axis=1).astype(np.float32)
+                                   if cellline_blocks else np.zeros((len(celllines), 0), dtype=np.float32),
+                                   ids, response=response, response_column=response_column, pair_block=pair_block)
 
     @classmethod
     def __construct_whole_raw_X(cls):
@@ -1039,14 +1318,30 @@ class SamplesDataLoader(CustomDataLoader):
         ### return dataframe
         ###  first_half_drugs_features                first_half_cellline_features
         ###  switched_second_half_drugs_features      second_half_cellline_features
+        if cls.whole_df is None and setting.factorized_features:
+            ### every feature block only depends on one drug, on the drug pair or on the cell line, see EntityFeatureTables
+            cls.whole_df = cls.__entity_tables_prep()
         if cls.whole_df is None:
-            two_drugs_features_list = cls.__drug_features_prep()
-            cellline_features_list = cls.__cellline_features_prep()
-            first_half = np.concatenate(tuple(two_drugs_features_list[0] + two_drugs_features_list[1] +
-                                              cellline_features_list), axis=1)
-            second_half = np.concatenate(tuple(two_drugs_features_list[1] + two_drugs_features_list[0] +
-                                               cellline_features_list), axis=1)
-            cls.whole_df = np.concatenate(tuple([first_half, second_half]), axis=0)#.reset_index(drop=True)
+            ### the first drug order is built and written raw_x_chunk_size combinations at a time, so only the
+            ### feature blocks of one chunk are held in memory besides the memmap
+            cls.__dataloader_initializer()
+            n_rows = len(cls.synergy_score)
+            first_half = None
+            for start in range(0, n_rows, setting.raw_x_chunk_size):
+                rows = slice(start, min(start + setting.raw_x_chunk_size, n_rows))
+                drug_a_blocks, drug_b_blocks, drug_lengths = cls.__drug_blocks(rows)
+                cellline_blocks, cellline_lengths = cls.__cellline_blocks(rows)
+                chunk = np.concatenate(drug_a_blocks + drug_b_blocks + cellline_blocks, axis=1)
+                if first_half is None:
+                    cls.drug_features_lengths.extend(drug_lengths)
+                    cls.cellline_features_lengths.extend(cellline_lengths)
+                    first_half = np.lib.format.open_memmap(setting.raw_x_first_half, mode='w+', dtype=np.float32,
+                                                           shape=(n_rows, chunk.shape[1]))
+                first_half[rows] = chunk
+            first_half.flush()
+            ### the switched second half is not materialized, DrugSwappedView permutes the drug
+            ### column blocks of the first half when rows are gathered
+            cls.whole_df = DrugSwappedView(first_half, sum(cls.drug_features_lengths))
         return cls.whole_df
 
     @classmethod
@@ -1058,7 +1353,17 @@ class SamplesDataLoader(CustomDataLoader):
         raw_x = cls.__construct_whole_raw_X()
         entrez_array = np.array(list(cls.entrez_set))
         if methods == 'attn':
-            x = raw_x.reshape(-1, setting.n_feature_type, len(cls.entrez_set))
+            ### only the first drug order is stored, reshaped to feature types x genes; the drug blocks of the
+            ### switched rows are swapped per feature type when rows are gathered
+            if isinstance(raw_x, DrugSwappedView):
+                first_half = raw_x.base
+            else:
+                first_half = utils.rows_to_memmap(raw_x, setting.raw_x_file, n_rows=len(raw_x) // 2,
+                                                  chunk_size=setting.raw_x_chunk_size)
+            drug_feature_types, remainder = divmod(sum(cls.drug_features_lengths), len(cls.entrez_set))
+            assert remainder == 0, "drug features are not whole feature types"
+            x = DrugSwappedView(first_half.reshape(len(first_half), setting.n_feature_type, len(cls.entrez_set)),
+                                drug_feature_types)
             filter_drug_features_len = filter_cl_features_len = x.shape[-1]
             drug_features_name = cl_features_name = cls.entrez_set
 
@@ -1071,12 +1376,12 @@ class SamplesDataLoader(CustomDataLoader):
             cl_features_len = int(raw_x.shape[1] - 2 * drug_features_len)
             assert cl_features_len == int((1 - 2 / setting.n_feature_type) * raw_x.shape[1]), \
                 "features len are calculated in wrong way"
-            var_filter = raw_x.var(axis=0) > 0
+            var_filter = utils.streaming_column_variance(raw_x, chunk_size=setting.raw_x_chunk_size) > 0
             filter_drug_features_len = sum(var_filter[:drug_features_len])
             filter_cl_features_len = sum(var_filter[2*drug_features_len:])
             drug_features_name = entrez_array[var_filter[:drug_features_len]]
             cl_features_name = np.array(list(entrez_array) * (setting.n_feature_type - 2))[var_filter[2 * drug_features_len:]]
-            x = raw_x[:, var_filter]
+            x = utils.rows_to_memmap(raw_x, setting.raw_x_file, columns=var_filter, chunk_size=setting.raw_x_chunk_size)
             assert filter_drug_features_len == len(drug_features_name) and filter_cl_features_len == len(cl_features_name), \
                                                                                   'features len and names do not match'
         return x, filter_drug_features_len, filter_cl_features_len, list(drug_features_name), list(cl_features_name)
@@ -1185,6 +1490,223 @@ class DataPreprocessor:
                     train_index[:100], test_index[:100], test_index_2[:100], evaluation_index[:100], evaluation_index_2[:100]
             yield train_index, test_index, test_index_2, evaluation_index, evaluation_index_2
 
+class DrugSwappedView:
+
+    ### Read only view of the whole raw X without storing the drug switched half
+    ### rows [0, n) are the combinations in synergy score order: drug_a features, drug_b features, cell line features
+    ### rows [n, 2n) are the same combinations with drug_a and drug_b switched, generated at gather time
+    ### so that the train_index + n addressing used by the split generators keeps working
+    def __init__(self, base, drug_features_length):
+        self.base = base
+        self.drug_features_length = int(drug_features_length)
+        assert 2 * self.drug_features_length <= base.shape[1], "drug features are longer than the data point"
+
+    @property
+    def shape(self):
+        return (2 * self.base.shape[0],) + tuple(self.base.shape[1:])
+
+    @property
+    def dtype(self):
+        return self.base.dtype
+
+    def __len__(self):
+        return 2 * len(self.base)
+
+    def __getitem__(self, rows):
+
+        ### rows: int, slice or array of row positions in [0, 2n)
+        n = len(self.base)
+        single_row = isinstance(rows, (int, np.integer))
+        if isinstance(rows, slice):
+            rows = np.arange(len(self))[rows]
+        rows = np.asarray(rows).reshape(-1)
+        rows = np.where(rows < 0, rows + len(self), rows)
+        assert ((rows >= 0) & (rows < len(self))).all(), "row index out of range"
+
+        d = self.drug_features_length
+        out = np.empty((len(rows),) + tuple(self.base.shape[1:]), dtype=self.base.dtype)
+        switched = rows >= n
+        out[~switched] = self.base[rows[~switched]]
+        if switched.any():
+            switched_rows = np.asarray(self.base[rows[switched] - n])
+            out[switched, :d] = switched_rows[:, d:2 * d]
+            out[switched, d:2 * d] = switched_rows[:, :d]
+            out[switched, 2 * d:] = switched_rows[:, 2 * d:]
+        return out[0] if single_row else out
+
+    def materialize(self):
+        return self[np.arange(len(self))]
+
+class EntityFeatureTables:
+
+    ### Factorized whole raw X, a data point is assembled from a drug table and a cell line table:
+    ###     [drug_table[drug_a], drug_table[drug_b], cellline_table[cell_line]]
+    ### ids: (n, 3) table rows of drug_a, drug_b and cell line of every combination
+    ### response: optional (n, 2) pIC50 of drug_a and drug_b, written into column response_column of each drug part
+    ### pair_block: optional dict, the combine_drugs_for_cl block table[ids] * factor[cell line] followed by padding
+    ###             zero columns is inserted at column offset of the cell line part
+    ### rows [0, n) follow synergy score order and rows [n, 2n) have drug_a and drug_b switched, the same
+    ### row addressing as DrugSwappedView. The tables are either ndarrays or torch tensors (see to), in the
+    ### latter case batches are gathered on the device of the tensors
+    def __init__(self, drug_table, cellline_table, ids, response=None, response_column=None, pair_block=None):
+        self.drug_table = drug_table
+        self.cellline_table = cellline_table
+        self.ids = ids
+        self.response = response
+        self.response_column = response_column
+        self.pair_block = pair_block
+
+    @property
+    def shape(self):
+        pair_length = 0 if self.pair_block is None else self.pair_block['table'].shape[1] + self.pair_block['padding']
+        return (2 * len(self.ids), 2 * self.drug_table.shape[1] + self.cellline_table.shape[1] + pair_length)
+
+    @property
+    def dtype(self):
+        return self.drug_table.dtype
+
+    def __len__(self):
+        return 2 * len(self.ids)
+
+    def to(self, device):
+
+        ### return a copy whose tables are torch tensors on device
+        def to_tensor(table):
+            return None if table is None else torch.as_tensor(np.asarray(table)).to(device)
+
+        tensors = [to_tensor(table) for table in (self.drug_table, self.cellline_table, self.ids, self.response)]
+        pair_block = None
+        if self.pair_block is not None:
+            pair_block = dict(self.pair_block)
+            pair_block.update({key: to_tensor(self.pair_block[key]) for key in ('table', 'ids', 'factor')})
+        return EntityFeatureTables(*tensors, response_column=self.response_column, pair_block=pair_block)
+
+    def __getitem__(self, rows):
+
+        ### rows: int, slice or array of row positions in [0, 2n)
+        n = len(self.ids)
+        single_row = isinstance(rows, (int, np.integer))
+        if isinstance(rows, slice):
+            rows = np.arange(len(self))[rows]
+        rows = np.asarray(rows).reshape(-1)
+        rows = np.where(rows < 0, rows + len(self), rows)
+        assert ((rows >= 0) & (rows < len(self))).all(), "row index out of range"
+
+        on_device = torch.is_tensor(self.drug_table)
+        concatenate, where = (torch.cat, torch.where) if on_device else (np.concatenate, np.where)
+        if on_device:
+            rows = torch.as_tensor(rows, device=self.drug_table.device)
+        switched = rows >= n
+        combinations = rows - n * switched
+        ids = self.ids[combinations]
+        drug_a, drug_b = where(switched, ids[:, 1], ids[:, 0]), where(switched, ids[:, 0], ids[:, 1])
+        cellline = self.cellline_table[ids[:, 2]]
+        if self.pair_block is not None:
+            ### pair level targets times the cell line factor, only computed for the rows of this batch
+            block = self.pair_block['table'][self.pair_block['ids'][combinations]] * self.pair_block['factor'][ids[:, 2]]
+            padding = (len(block), self.pair_block['padding'])
+            padding = torch.zeros(padding, dtype=block.dtype, device=block.device) if on_device \
+                else np.zeros(padding, dtype=block.dtype)
+            offset = self.pair_block['offset']
+            cellline = concatenate([cellline[:, :offset], block, padding, cellline[:, offset:]], 1)
+        out = concatenate([self.drug_table[drug_a], self.drug_table[drug_b], cellline], 1)
+        if self.response is not None:
+            response = self.response[combinations]
+            d = self.drug_table.shape[1]
+            out[:, self.response_column] = where(switched, response[:, 1], response[:, 0])
+            out[:, d + self.response_column] = where(switched, response[:, 0], response[:, 1])
+        return out[0] if single_row else out
+
+    def materialize(self):
+        return self[np.arange(len(self))]
+
+class FeatureStore(CustomDataLoader):
+
+    ### All data points are persisted in one contiguous float32 matrix (setting.feature_store),
+    ### row i of the matrix belongs to the i-th entry of setting.feature_store_index (final_index),
+    ### i.e. to the combination with IdCatalog id i.
+    ### Rows are read back through np.memmap so that no per sample file is opened.
+    ### If a DrugSwappedView is persisted, only its first half is stored and the view is rebuilt on reading
+    features = None
+    n_rows = None
+
+    def __init__(self):
+        super().__init__()
+
+    @classmethod
+    def __is_up_to_date(cls, X, final_index):
+
+        if not path.exists(setting.feature_store) or not path.exists(setting.feature_store_index) \
+                or not path.exists(setting.feature_store_layout):
+            return False
+        base = X.base if isinstance(X, DrugSwappedView) else X
+        if np.load(setting.feature_store, mmap_mode='r').shape != base.shape:
+            return False
+        with open(setting.feature_store_layout, 'rb') as layout_file:
+            drug_features_length = pickle.load(layout_file)
+        if drug_features_length != getattr(X, 'drug_features_length', None):
+            return False
+        stored_index = pd.read_csv(setting.feature_store_index, header=None)[0].astype(str)
+        return np.array_equal(stored_index.values, np.array(final_index).astype(str))
+
+    @classmethod
+    def persist(cls, X, final_index):
+
+        ### X: ndarray (n_samples, ...) or DrugSwappedView, final_index: n_samples combination names in the same order
+        assert len(X) == len(final_index), "features and final index have different length"
+        if isinstance(X, EntityFeatureTables):
+            ### the factorized tables are small, they are kept in memory (on the training device) instead
+            cls.features = X.to(device2) if setting.gather_on_device else X
+            cls.n_rows = len(final_index)
+            logger.debug("Feature store keeps {!r} drugs and {!r} cell lines in factorized tables".format(
+                len(X.drug_table), len(X.cellline_table)))
+            return
+        if not setting.update_features and cls.__is_up_to_date(X, final_index):
+            logger.debug("Feature store {!r} is up to date".format(setting.feature_store))
+            return
+
+        base = X.base if isinstance(X, DrugSwappedView) else X
+        logger.debug("Persisting {!r} data points to feature store ...".format(len(base)))
+        ### rows keep their shape, the drug_features_length of a DrugSwappedView counts along the second axis
+        store = np.lib.format.open_memmap(setting.feature_store, mode='w+', dtype=np.float32, shape=base.shape)
+        for start in range(0, len(base), setting.feature_store_chunk_size):
+            stop = min(start + setting.feature_store_chunk_size, len(base))
+            store[start:stop] = np.asarray(base[start:stop], dtype=np.float32)
+        store.flush()
+        del store
+        pd.Series(final_index).to_csv(setting.feature_store_index, header=False, index=False)
+        with open(setting.feature_store_layout, 'wb+') as layout_file:
+            pickle.dump(getattr(X, 'drug_features_length', None), layout_file)
+        cls.features, cls.n_rows = None, None
+        logger.debug("Persisted feature store successfully")
+
+    @classmethod
+    def __store_initializer(cls):
+
+        if cls.features is None:
+            ### copy-on-write mapping so that rows can be handed to torch without copying
+            cls.features = np.load(setting.feature_store, mmap_mode='c')
+            with open(setting.feature_store_layout, 'rb') as layout_file:
+                drug_features_length = pickle.load(layout_file)
+            if drug_features_length is not None:
+                cls.features = DrugSwappedView(cls.features, drug_features_length)
+            cls.n_rows = len(cls.features)
+
+    @classmethod
+    def get_features(cls):
+        cls.__store_initializer()
+        return cls.features
+
+    @classmethod
+    def get_rows(cls, IDs):
+
+        ### IDs: IdCatalog combination ids
+        ### return: ndarray, the feature store rows of the combinations in IDs
+        cls.__store_initializer()
+        rows = np.asarray(IDs, dtype=np.int64).reshape(-1)
+        assert ((rows >= 0) & (rows < cls.n_rows)).all(), "combination ids are not in the feature store"
+        return rows
+
 class MyDataset(data.Dataset):
 
     synergy_score = None
@@ -1195,6 +1717,8 @@ class MyDataset(data.Dataset):
         self.labels = labels
         self.list_IDs = list_IDs
         self.prefix = prefix
+        if self.prefix is None:
+            self.rows = FeatureStore.get_rows(list_IDs)
         if MyDataset.synergy_score is None:
             print('prepare synergy score')
             MyDataset.synergy_score = SynergyDataReader.get_synergy_score()
@@ -1205,7 +1729,7 @@ class MyDataset(data.Dataset):
             MyDataset.synergy_score.reset_index(inplace=True)
         if MyDataset.drug_smile is None:
             print('prepare drug smile')
-            name_smile_df = pd.read_csv(setting.inchi_merck)
+            name_smile_df = csv_cache.read_csv(setting.inchi_merck)
             MyDataset.drug_smile = {name: smile for name, smile in zip(name_smile_df['Name'], name_smile_df['SMILE'])}
 
     def __len__(self):
@@ -1217,15 +1741,16 @@ class MyDataset(data.Dataset):
         # Select sample
         ID = self.list_IDs[index]
         if self.prefix is None:
-            drug_combine_file = path.join(setting.data_folder, ID + '.pt')
+            X = FeatureStore.get_features()[self.rows[index]]
+            X = X if torch.is_tensor(X) else torch.from_numpy(X)
         else:
-            drug_combine_file = self.prefix + '_datas/' + ID + '.pt'
-        # Load data and get label
-        try:
-            X = torch.load(drug_combine_file)
-        except:
-            logger.error("Fail to get {}".format(ID))
-            raise
+            drug_combine_file = self.prefix + '_datas/' + str(ID) + '.pt'
+            # Load data and get label
+            try:
+                X = torch.load(drug_combine_file)
+            except:
+                logger.error("Fail to get {}".format(ID))
+                raise
         y = self.labels[ID]
         drug_a = MyDataset.synergy_score.loc[index, 'drug_a_name']
         drug_a_smiles = MyDataset.drug_smile[drug_a]
@@ -1233,3 +1758,118 @@ class MyDataset(data.Dataset):
         drug_b_smiles = MyDataset.drug_smile[drug_b]
 
         return (X, drug_a_smiles, drug_b_smiles), y
+
+class BatchDataset(data.Dataset):
+
+    ### Every item of this dataset is a whole mini-batch: __getitem__ receives an array of positions
+    ### in list_IDs (see BatchIndexSampler) and gathers features, SMILES and labels with one
+    ### fancy-index each, so that no python code runs per sample
+    smiles_a = None
+    smiles_b = None
+
+    def __init__(self, list_IDs, labels):
+
+        ### list_IDs: IdCatalog combination ids, labels: ndarray indexed by combination id
+        self.list_IDs = list_IDs
+        self.rows = FeatureStore.get_rows(list_IDs)
+        self.labels = np.asarray(labels).reshape(-1)[self.rows]
+        if BatchDataset.smiles_a is None or BatchDataset.smiles_b is None:
+            BatchDataset.__smiles_initializer()
+
+    @classmethod
+    def __smiles_initializer(cls):
+
+        ### SMILES of drug_a and drug_b indexed by combination id
+        name_smile_df = csv_cache.read_csv(setting.inchi_merck)
+        drug_smile = pd.Series(name_smile_df['SMILE'].values, index=name_smile_df['Name'])
+        drug_smile = drug_smile[~drug_smile.index.duplicated()].reindex(IdCatalog.get_drugs()).values
+        combinations = IdCatalog.get_combinations()
+        cls.smiles_a = drug_smile[combinations['drug_a'].values]
+        cls.smiles_b = drug_smile[combinations['drug_b'].values]
+
+    def __len__(self):
+        return len(self.list_IDs)
+
+    def __getitem__(self, batch_index):
+
+        rows = self.rows[batch_index]
+        X = FeatureStore.get_features()[rows]
+        X = X if torch.is_tensor(X) else torch.from_numpy(X)
+        y = torch.from_numpy(self.labels[batch_index])
+        return (X, BatchDataset.smiles_a[rows], BatchDataset.smiles_b[rows]), y
+
+class BatchIndexSampler(data.Sampler):
+
+    ### yield arrays of dataset positions, one array per mini-batch
+    def __init__(self, n_samples, batch_size, shuffle=False):
+        self.n_samples = n_samples
+        self.batch_size = max(int(batch_size), 1)
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        order = torch.randperm(self.n_samples).numpy() if self.shuffle else np.arange(self.n_samples)
+        for start in range(0, self.n_samples, self.batch_size):
+            yield order[start:start + self.batch_size]
+
+    def __len__(self):
+        return (self.n_samples + self.batch_size - 1) // self.batch_size
+
+def get_batch_generator(list_IDs, labels, batch_size, shuffle=False):
+
+    ### batch_size=None turns off the default per-sample collation of DataLoader,
+    ### batches come out of BatchDataset as they are
+    batch_set = BatchDataset(list_IDs, labels)
+    sampler = BatchIndexSampler(len(batch_set), batch_size, shuffle=shuffle)
+    return data.DataLoader(batch_set, sampler=sampler, batch_size=None)
+
+### Preprocessing DAG, see pipeline_cache.PreprocessingDAG
+### input_files are upstream sources only, files a stage writes itself (propagation results, intermediate
+### matrices) would change the fingerprint after every run
+### network filter -> drug target profile -> propagation -> per-entity features -> Raw_X_features_prep -> final_index
+def __restore_network(network):
+    NetworkDataReader.network = network
+    NetworkDataReader.entrez_set = GenesDataReader.get_gene_entrez_set()
+
+def __restore_drug_target_profile(drug_target):
+    DrugTargetProfileDataLoader.drug_target = drug_target
+
+def __restore_propagation(simulated_drug_target):
+    DrugTargetProfileDataLoader.simulated_drug_target_profile = simulated_drug_target
+
+def __compute_raw_x():
+    ### only the first half of a DrugSwappedView is cached, EntityFeatureTables are pickled as they are
+    X, drug_features_length, cellline_features_length = SamplesDataLoader.Raw_X_features_prep(methods='flexible_attn')
+    X = X.base if isinstance(X, DrugSwappedView) else X
+    return X, drug_features_length, cellline_features_length, SamplesDataLoader.Y_features_prep()
+
+def __restore_final_index(final_index):
+    SynergyDataReader.final_index = final_index
+
+pipeline_cache.PreprocessingDAG.register('network', NetworkDataReader.get_network, __restore_network,
+                                         input_files=['network', 'genes'])
+pipeline_cache.PreprocessingDAG.register('drug_target_profile', DrugTargetProfileDataLoader.get_drug_target_profiles,
+                                         __restore_drug_target_profile,
+                                         input_files=['drug_profiles', 'raw_chemicals', 'genes'],
+                                         force_flags=['drug_profiles_renew'])
+pipeline_cache.PreprocessingDAG.register('propagation', DrugTargetProfileDataLoader.get_filtered_simulated_drug_target_matrix,
+                                         __restore_propagation, deps=['network', 'drug_target_profile'],
+                                         settings=['propagation_method', 'network_prop_normalized',
+                                                   'random_walk_alphas', 'random_walk_alpha', 'random_walk_solver',
+                                                   'random_walk_tolerance', 'push_tolerance', 'push_top_k'],
+                                         force_flags=['renew'])
+pipeline_cache.PreprocessingDAG.register('cellline_entity_features', SamplesDataLoader.get_cellline_entity_features,
+                                         SamplesDataLoader.set_cellline_entity_features,
+                                         input_files=['synergy_score', 'genes', 'cl_genes_dp', 'genes_dp_indexes',
+                                                      'gene_expression', 'backup_expression', 'netexpress_df'],
+                                         settings=['cellline_features', 'feature_type'],
+                                         force_flags=['raw_expression_data_renew'])
+pipeline_cache.PreprocessingDAG.register('raw_x', __compute_raw_x, deps=['propagation', 'cellline_entity_features'],
+                                         input_files=['synergy_score', 'single_response', 'L1000_upregulation',
+                                                      'L1000_downregulation'],
+                                         settings=['drug_features', 'cellline_features', 'feature_type',
+                                                   'add_single_response_to_drug_target',
+                                                   'expression_dependencies_interaction', 'factorized_features'],
+                                         force_flags=['update_xy', 'combine_gene_expression_renew'], version=4)
+pipeline_cache.PreprocessingDAG.register('final_index', SynergyDataReader.get_final_index, __restore_final_index,
+                                         deps=['propagation'], input_files=['synergy_score'],
+                                         settings=['feature_type'], force_flags=['update_final_index'])
@@ -0,0 +1,107 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+from src import setting, logger
+
+
+### Binary adjacency cache of the tab separated gene network file (entrez_a, entrez_b, association).
+### The file is parsed once into
+###     nodes:      int64 entrez ids, the genes of the panel first (sorted), then the other network nodes (sorted)
+###     offsets:    int64 csr offsets, the edges of node i are offsets[i]:offsets[i + 1]
+###     targets:    int32 node ids (positions in nodes) of the edge ends
+###     weights:    float32 associations
+###     edge_order: int64 line of every edge in the network file
+### and every following read memory maps these arrays. Since panel genes come first, an edge is inside the
+### panel if both node ids are below n_panel. The cache entry is keyed by the size and modification time of
+### the network file and by the gene panel.
+
+class NetworkAdjacency:
+
+    def __init__(self, nodes, n_panel, offsets, targets, weights, edge_order):
+
+        self.nodes = nodes
+        self.n_panel = n_panel
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+        self.edge_order = edge_order
+
+    def sources(self):
+        return np.repeat(np.arange(len(self.nodes), dtype=np.int32), np.diff(self.offsets))
+
+    def panel_edges(self):
+
+        ### bool mask of the edges with both ends in the panel
+        return (self.sources() < self.n_panel) & (np.asarray(self.targets) < self.n_panel)
+
+    def panel_degree(self):
+
+        ### number of panel edges at every panel gene, both directions counted
+        mask = self.panel_edges()
+        return np.bincount(self.sources()[mask], minlength=self.n_panel) + \
+               np.bincount(np.asarray(self.targets)[mask], minlength=self.n_panel)
+
+    def to_frame(self, mask=None):
+
+        ### edge data frame entrez_a, entrez_b, association in network file order, index = line in the file
+        sources, targets, weights, edge_order = self.sources(), self.targets, self.weights, self.edge_order
+        if mask is not None:
+            sources, targets, weights, edge_order = sources[mask], targets[mask], weights[mask], edge_order[mask]
+        order = np.argsort(edge_order, kind='mergesort')
+        nodes = np.asarray(self.nodes)
+        return pd.DataFrame({'entrez_a': nodes[sources[order]], 'entrez_b': nodes[np.asarray(targets)[order]],
+                             'association': np.asarray(weights)[order].astype(float)},
+                            index=pd.Index(np.asarray(edge_order)[order]))
+
+def __cache_dir(network_file, panel_genes):
+
+    stat = os.stat(network_file)
+    sha = hashlib.sha1("{}|{}|{}".format(os.path.abspath(network_file), stat.st_size, stat.st_mtime_ns).encode())
+    sha.update(np.sort(np.asarray(list(panel_genes), dtype=np.int64)).tobytes())
+    return os.path.join(setting.network_cache_dir, "{}-{}".format(os.path.basename(network_file), sha.hexdigest()[:16]))
+
+def __build(network_file, panel_genes, cache_dir):
+
+    raw_network = pd.read_csv(network_file, header=None, sep='\t')
+    assert len(raw_network.columns) == 3, "genes network file should have three columns"
+    entrez_a, entrez_b = raw_network[0].values.astype(np.int64), raw_network[1].values.astype(np.int64)
+    panel = np.sort(np.asarray(list(panel_genes), dtype=np.int64))
+    others = np.setdiff1d(np.union1d(entrez_a, entrez_b), panel)
+    nodes = np.concatenate([panel, others])
+    node_index = pd.Index(nodes)
+    sources = node_index.get_indexer(entrez_a)
+    targets = node_index.get_indexer(entrez_b).astype(np.int32)
+
+    ### stable sort keeps the file order of the edges of one node
+    order = np.argsort(sources, kind='mergesort')
+    offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(sources, minlength=len(nodes)))
+    arrays = {'nodes': nodes, 'offsets': offsets, 'targets': targets[order],
+              'weights': raw_network[2].values.astype(np.float32)[order], 'edge_order': order.astype(np.int64)}
+
+    tmp_dir = cache_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), array)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'n_panel': len(panel)}, f)
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+    logger.debug("Cached network {!r}: {!r} nodes, {!r} edges".format(network_file, len(nodes), len(order)))
+
+def get_adjacency(network_file, panel_genes):
+
+    cache_dir = __cache_dir(network_file, panel_genes)
+    if not os.path.exists(os.path.join(cache_dir, 'meta.json')):
+        __build(network_file, panel_genes, cache_dir)
+    with open(os.path.join(cache_dir, 'meta.json')) as f:
+        n_panel = json.load(f)['n_panel']
+    arrays = {name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+              for name in ('nodes', 'offsets', 'targets', 'weights', 'edge_order')}
+    return NetworkAdjacency(n_panel=n_panel, **arrays)
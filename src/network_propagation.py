@@ -1,9 +1,13 @@
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, coo_matrix, diags, issparse
 import pandas as pd
 import numpy as np
-from src import setting
+from src import setting, csv_cache, propagation_kernel
 import os
+import shutil
+import hashlib
+import pickle
 import logging
+import multiprocessing
 import pdb
 
 # Setting up log file
@@ -21,7 +25,7 @@ def combin_drug_target_probabilities_matrix(drug_pairs, drug_target):
     ### drug_target: drug_target dataframe, index = genes, columns = drugs
     ### return: combine_drug_target_matrix: index = drugA_drugB, columns = genes
     if not setting.combine_drug_target_renew and os.path.exists(setting.combine_drug_target_matrix):
-        combine_drug_target_matrix = pd.read_csv(setting.combine_drug_target_matrix, index_col=0)
+        combine_drug_target_matrix = csv_cache.read_csv(setting.combine_drug_target_matrix, index_col=0)
         return combine_drug_target_matrix
 
     if len(drug_pairs.columns) != 2:
@@ -40,6 +44,19 @@ def combin_drug_target_probabilities_matrix(drug_pairs, drug_target):
     return combine_drug_target_matrix
 
 
+def drug_pair_target_as_0_network_propagation(network, entrez_set, drug_target, drug_pairs):
+
+    ### network: gene-gene network
+    ### drug_target: drug_target dataframe, index = genes, columns = drugs
+    ### drug_pairs: data frame: drugA, drugB
+    ### return data frame: propagated combined targets of every drug pair, index: drugA_drugB, columns: genes
+    combine_drug_target_matrix = combin_drug_target_probabilities_matrix(drug_pairs, drug_target)
+    logger.debug('Computing for target as 0 propagated data frame')
+    processed_drug_target = target_as_0_network_propagation(network, combine_drug_target_matrix.T, entrez_set, setting.intermediate_ge_target0_matrix)
+    logger.debug('Computed for target as 0 propagated data frame successfully')
+    processed_drug_target.columns = processed_drug_target.columns.astype(int)
+    return processed_drug_target
+
 def drug_combine_multiplication_gene_expression_network_propagation(network, gene_expression_df, entrez_set, drug_target, synergy_df, result_matrix_file):
 
     ### network: gene-gene network
@@ -51,20 +68,18 @@ def drug_combine_multiplication_gene_expression_network_propagation(network, gen
     ### return data frame: processed drugs: columns: genes, index: drugs
 
     if not setting.combine_gene_expression_renew and os.path.exists(result_matrix_file):
-        result_df = pd.read_csv(result_matrix_file, index_col = 0)
+        result_df = csv_cache.read_csv(result_matrix_file, index_col = 0)
         result_df.columns = result_df.columns.astype(int)
         return result_df
 
     drug_pairs = synergy_df[['drug_a_name', 'drug_b_name']]
-    combine_drug_target_matrix = combin_drug_target_probabilities_matrix(drug_pairs, drug_target)
-    logger.debug('Computing for target as 0 propagated data frame')
-    processed_drug_target = target_as_0_network_propagation(network, combine_drug_target_matrix.T, entrez_set, setting.intermediate_ge_target0_matrix)
-    logger.debug('Computed for target as 0 propagated data frame successfully')
-    processed_drug_target.columns = processed_drug_target.columns.astype(int)
+    processed_drug_target = drug_pair_target_as_0_network_propagation(network, entrez_set, drug_target, drug_pairs)
     processed_drug_target = processed_drug_target.loc[:, gene_expression_df.index]
     assert len(processed_drug_target.columns) == len(gene_expression_df.index), "Processed drug target has different genes number from gene expression dataset"
-    result_df = synergy_df.apply(lambda row: processed_drug_target.loc[row['drug_a_name']+'_'+row['drug_b_name'], :] *
-                                             gene_expression_df.loc[:, row['cell_line']], axis = 1)
+    pair_names = synergy_df['drug_a_name'] + '_' + synergy_df['drug_b_name']
+    result_df = pd.DataFrame(processed_drug_target.loc[pair_names, :].values *
+                             gene_expression_df.loc[:, synergy_df['cell_line']].values.T,
+                             index=synergy_df.index, columns=gene_expression_df.index)
     result_df.to_csv(result_matrix_file)
     return result_df
 
@@ -83,12 +98,12 @@ def target_as_1_network_propagation(network, drug_target, entrez_set, result_mat
     # if matrix renewal is needed, it will recompute the simulated result matrix
     if not setting.renew and os.path.exists(result_matrix_file):
 
-        result_matrix = pd.read_csv(result_matrix_file, index_col = 0)
+        result_matrix = csv_cache.read_csv(result_matrix_file, index_col = 0)
 
     else:
 
-        # constructed a zero network matrix, columns and index are genes
-        network_matrix = get_matrix_from_network(network, entrez_set)
+        # sparse network matrix, rows and columns follow list(entrez_set)
+        network_matrix, _ = get_sparse_network(network, entrez_set)
 
         # drug_target_matrix: columns = genes, index = Drugs
         drug_target.index = drug_target.index.astype(int)
@@ -106,87 +121,164 @@ def target_as_1_network_propagation(network, drug_target, entrez_set, result_mat
 def get_max_probability(drug_target, network):
 
     # input drug_target matrix: columns = genes, index = drugs
-    result_drug_target = pd.DataFrame(np.zeros(shape=drug_target.shape), columns=drug_target.columns, index = drug_target.index)
-    for gene in result_drug_target.columns:
-        logger.debug("processing genes {}".format(str(gene)))
-        for drug in result_drug_target.index:
-            if drug_target.loc[drug, gene] == 1:
-                result_drug_target.loc[drug, gene] = 1
-            else:
-                result_drug_target.loc[drug, gene] = (drug_target.loc[drug, :] * network.loc[gene, :]).max()
-
-    return result_drug_target
+    # network: gene-gene matrix, data frame or scipy sparse matrix in the gene order of drug_target columns
+    # result[drug, gene] = 1 if gene is a target of drug, else max over all genes g of
+    # drug_target[drug, g] * network[gene, g]. Only the target genes of a drug give non zero products,
+    # so for every drug the max is taken over the network columns of its targets only
+    genes = drug_target.columns
+    if isinstance(network, pd.DataFrame):
+        network = network.loc[genes, genes].values
+    # row g of network_t holds network[:, g]
+    network_t = csr_matrix(network).T.tocsr()
+    targets = drug_target.values
+    result = np.zeros(shape=targets.shape)
+    for i, drug_targets in enumerate(targets):
+        target_genes = np.flatnonzero(drug_targets)
+        if len(target_genes):
+            products = network_t[target_genes].multiply(drug_targets[target_genes].reshape(-1, 1))
+            result[i] = products.max(axis=0).toarray().reshape(-1)
+        if len(target_genes) < len(genes):
+            # products with non target genes are 0
+            result[i] = np.maximum(result[i], 0)
+        result[i, drug_targets == 1] = 1
+
+    return pd.DataFrame(result, columns=drug_target.columns, index=drug_target.index)
 
 def normalize_matrix(raw_matrix, axis):
 
-    def __normalize(vector):
+    # raw_matrix: data frame, ndarray or scipy sparse matrix, the result has the same type (sparse as csr)
+    # axis: 0 or 'index': every row is divided by its sum
+    #       1 or 'column': every column is divided by its sum
+    #       'symmetric': D^-1/2 A D^-1/2, D = row sums
+    # vectors summing to 0 are kept as they are
+    if isinstance(raw_matrix, pd.DataFrame):
+        return pd.DataFrame(normalize_matrix(raw_matrix.values, axis), columns=raw_matrix.columns, index=raw_matrix.index)
 
-        denominator = sum(vector)
-        if not denominator:
-            return vector
+    sparse = issparse(raw_matrix)
+    matrix = csr_matrix(raw_matrix, dtype=float) if sparse else np.asarray(raw_matrix, dtype=float)
 
-        return vector/denominator
+    def __inverse(sums, power=1):
 
-    # normalize each row
-    normalized_matrix = pd.DataFrame(np.zeros(shape=raw_matrix.shape, dtype='float'), columns=raw_matrix.columns, index=raw_matrix.index)
-    if axis == 0 or axis == 'index':
-
-        for i in raw_matrix.index:
-            normalized_matrix.loc[i, :] = __normalize(raw_matrix.loc[i, :])
+        sums = np.asarray(sums, dtype=float).reshape(-1)
+        inverse = np.ones(len(sums))
+        inverse[sums != 0] = 1 / sums[sums != 0] ** power
+        return inverse
 
+    if axis == 0 or axis == 'index':
+        row_factor, column_factor = __inverse(matrix.sum(axis=1)), None
     elif axis == 1 or axis == 'column':
-
-        for i in raw_matrix.columns:
-            normalized_matrix.loc[:, i] = __normalize(raw_matrix.loc[:, i])
-
+        row_factor, column_factor = None, __inverse(matrix.sum(axis=0))
+    elif axis == 'symmetric':
+        row_factor = column_factor = __inverse(matrix.sum(axis=1), 0.5)
     else:
         logger.debug("axis is out of range")
+        return csr_matrix(matrix.shape) if sparse else np.zeros(shape=matrix.shape)
+
+    if sparse:
+        if row_factor is not None:
+            matrix = diags(row_factor).dot(matrix)
+        if column_factor is not None:
+            matrix = matrix.dot(diags(column_factor))
+        return matrix.tocsr()
+    if row_factor is not None:
+        matrix = matrix * row_factor.reshape(-1, 1)
+    if column_factor is not None:
+        matrix = matrix * column_factor.reshape(1, -1)
+    return matrix
+
+def __network_file(genes):
+
+    ### one binary matrix per gene panel, e.g. the ~2400 selected genes or all network nodes
+    key = hashlib.sha1(np.sort(np.asarray(genes, dtype=np.int64)).tobytes()).hexdigest()[:12]
+    return "{}-{}".format(setting.network_matrix, key)
+
+def __save_sparse_network(network_matrix, genes, file_path):
+
+    ### csr arrays are saved as plain .npy files so that they can be memory mapped back
+    tmp_dir = file_path + '.tmp'
+    if not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
+    for name, array in (('data', network_matrix.data), ('indices', network_matrix.indices),
+                        ('indptr', network_matrix.indptr), ('genes', np.asarray(genes, dtype=np.int64))):
+        np.save(os.path.join(tmp_dir, name + '.npy'), array)
+    if os.path.exists(file_path):
+        shutil.rmtree(file_path)
+    os.rename(tmp_dir, file_path)
+
+def __load_sparse_network(file_path, genes):
+
+    ### return the saved matrix with rows and columns in the order of genes
+    arrays = {name: np.load(os.path.join(file_path, name + '.npy'), mmap_mode='r')
+              for name in ('data', 'indices', 'indptr', 'genes')}
+    n = len(arrays['genes'])
+    network_matrix = csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=(n, n), copy=False)
+    saved_genes = pd.Index(np.asarray(arrays['genes']))
+    if not saved_genes.equals(genes):
+        order = saved_genes.get_indexer(genes)
+        network_matrix = network_matrix[order][:, order]
+    return network_matrix
 
-    return normalized_matrix
-
-def get_matrix_from_network(network, entrez_set):
+def get_sparse_network(network, entrez_set=None):
 
-    # build the matrix from gene gene interaction network, so far
+    # build the symmetric sparse matrix from gene gene interaction network, so far
     # gene-gene self interaction weight is 0
-    # output: network_matrix: columns: genes entrezids, index: genes entrezids
-
-    if not setting.network_update and os.path.exists(setting.network_matrix):
-        network_matrix = pd.read_csv(setting.network_matrix, index_col=0)
-        network_matrix.index = network_matrix.index.astype(int)
-        network_matrix.columns = network_matrix.columns.astype(int)
-        return network_matrix
-
-    network_matrix = np.zeros(shape=(len(entrez_set), len(entrez_set)), dtype='float')
-    network_matrix = pd.DataFrame(data=network_matrix)
-    network_matrix.columns, network_matrix.index = list(entrez_set), list(entrez_set)
+    # network: data frame: entrez_a, entrez_b, association
+    # entrez_set: genes of the matrix, all genes in network if None
+    # output: (network_matrix, genes): csr_matrix, row and column i are gene genes[i]
 
-    for row in network.iterrows():
+    if entrez_set is None:
+        genes = pd.unique(network[['entrez_a', 'entrez_b']].values.astype(int).reshape(-1))
+    else:
+        genes = list(entrez_set)
+    genes = pd.Index(genes)
+    file_path = __network_file(genes)
+
+    if not setting.network_update and os.path.exists(file_path):
+        return __load_sparse_network(file_path, genes), genes
+
+    a = genes.get_indexer(network['entrez_a'].values.astype(int))
+    b = genes.get_indexer(network['entrez_b'].values.astype(int))
+    association = network['association'].values.astype(float)
+    kept = (a >= 0) & (b >= 0)
+    a, b, association = a[kept], b[kept], association[kept]
+
+    ### both directions of every edge, a repeated edge keeps the association of its last occurrence
+    rows, cols = np.concatenate([a, b]), np.concatenate([b, a])
+    values = np.concatenate([association, association])
+    occurrence = np.tile(np.arange(len(a)), 2)
+    order = np.lexsort((occurrence, cols, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    last = np.ones(len(rows), dtype=bool)
+    last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    network_matrix = coo_matrix((values[last], (rows[last], cols[last])), shape=(len(genes), len(genes))).tocsr()
+
+    __save_sparse_network(network_matrix, genes, file_path)
+    logger.debug("Saved sparse network matrix of {!r} genes to {!r}".format(len(genes), file_path))
+    return network_matrix, genes
 
-        a, b = int(row[1]['entrez_a']), int(row[1]['entrez_b'])
-        if a in entrez_set and b in entrez_set:
-            network_matrix.loc[a, b] = row[1]['association']
-            network_matrix.loc[b, a] = row[1]['association']
+def get_matrix_from_network(network, entrez_set):
 
-    network_matrix.to_csv(setting.network_matrix)
-    return network_matrix
+    # dense version of get_sparse_network
+    # output: network_matrix: columns: genes entrezids, index: genes entrezids
+    network_matrix, genes = get_sparse_network(network, entrez_set)
+    return pd.DataFrame(network_matrix.toarray(), columns=genes, index=genes)
 
 def RWlike_network_propagation(network, drug_target, entrez_set, result_matrix_file):
 
     # input drug_target matrix: index = genes, columns = drugs
     if not setting.renew and os.path.exists(result_matrix_file):
 
-        result_matrix = pd.read_csv(result_matrix_file, index_col = 0)
+        result_matrix = csv_cache.read_csv(result_matrix_file, index_col = 0)
 
     else:
 
         # build the matrix from gene gene interaction network, so far
         # gene-gene self interaction weight is 0
-        network_matrix = get_matrix_from_network(network, entrez_set)
+        network_matrix, _ = get_sparse_network(network, entrez_set)
 
         # Normalize gene gene association probability so that the total gene gene
         # association probability weights for one gene is 1
-        normalized_network_matrix = normalize_matrix(network_matrix, 0)
-        network_sparse_matrix = csr_matrix(normalized_network_matrix.values)
+        network_sparse_matrix = normalize_matrix(network_matrix, 0)
 
         # drug_target_matrix: columns = genes, index = Drugs
         drug_target_matrix = drug_target.loc[entrez_set, :].values.T
@@ -202,68 +294,247 @@ def RWlike_network_propagation(network, drug_target, entrez_set, result_matrix_f
 
     return result_matrix
 
-def random_walk_network_propagation(result_matrix_file):
-
-    import subprocess
-    # input drug_target matrix: index = genes, columns = drugs
-    if setting.renew or not os.path.exists(result_matrix_file):
-
-        ### set up correct python_interpreter
-        python_interpreter_path = setting.python_interpreter_path
-        try:
-            bash_command = python_interpreter_path + " " + os.path.join(os.getcwd(), 'network_propagation.py')
-            logger.debug("Executing {!r}".format(bash_command))
-            retcode = subprocess.call(bash_command, shell=True)
-            if retcode < 0:
-                logger.debug("Subprocess was terminated by signal {!r}".format(-retcode))
-            else:
-                logger.debug("Subprocess returned {!r}".format(retcode))
-        except OSError as e:
-            logger.debug("Execution failed: {!r}".format(e))
-
-    result_matrix = pd.read_csv(result_matrix_file, index_col=0)
+def random_walk_with_restart(network_matrix, seeds, alphas, symmetric_norm=False, genes=None):
+
+    # network_matrix: n x n sparse gene-gene matrix
+    # seeds: drugs x n array, one seed vector per drug
+    # alphas: propagation coefficients, 1 - alpha is the restart probability
+    # same model as pyNBS network propagation: propagated = (1 - alpha) * seeds * (I - alpha * W)^-1 with
+    # W = D^-1 A (D^-1/2 A D^-1/2 if symmetric_norm). Instead of inverting I - alpha * W, propagated is either
+    # iterated (power) or solved with the cached factorization of I - alpha * W (kernel), all drugs at once
+    # genes: entrez ids of the network rows, part of the kernel cache key
+    # return float32 array: (alphas, drugs, n)
+    normalized_network = normalize_matrix(csr_matrix(network_matrix), 'symmetric' if symmetric_norm else 0)
+
+    seeds = np.asarray(seeds, dtype=float)
+    propagated = np.empty(shape=(len(alphas),) + seeds.shape, dtype=np.float32)
+    for i, alpha in enumerate(alphas):
+        if setting.random_walk_solver == 'power':
+            ### propagated = alpha * propagated * W + (1 - alpha) * seeds, converges with rate alpha
+            restart = (1 - alpha) * seeds
+            result, transposed_network = restart.copy(), normalized_network.T.tocsr()
+            while True:
+                updated = alpha * transposed_network.dot(result.T).T + restart
+                change = np.abs(updated - result).max() if updated.size else 0
+                result = updated
+                if change <= setting.random_walk_tolerance:
+                    break
+        else:
+            ### factorization (or dense kernel) cached on disk by network, gene panel and alpha
+            result = propagation_kernel.get_kernel(normalized_network, alpha, genes).propagate(seeds)
+        propagated[i] = result
+        logger.debug("Propagated {!r} drugs with alpha {!r}".format(len(seeds), alpha))
+    return propagated
+
+def forward_push(network_matrix, seeds, alpha, tolerance):
+
+    # approximate random walk with restart (same model as random_walk_with_restart) by forward push:
+    # residuals above tolerance are pushed, all of them at once in every round, estimate gets 1 - alpha of
+    # a pushed residual and its network neighbors the rest. Every round keeps
+    # exact = estimate + residual * (1 - alpha) * (I - alpha * W)^-1, so with non negative seeds the L1
+    # error of every estimate row is the L1 norm of its residual row
+    # seeds: drugs x n, sparse or dense
+    # return: (estimate, residual) csr matrices drugs x n
+    normalized_network = normalize_matrix(csr_matrix(network_matrix), 0)
+    residual = csr_matrix(seeds, dtype=float)
+    estimate = csr_matrix(residual.shape, dtype=float)
+    while True:
+        active = residual.multiply(residual > tolerance).tocsr()
+        if active.nnz == 0:
+            break
+        estimate = estimate + (1 - alpha) * active
+        residual = residual - active + alpha * active.dot(normalized_network)
+        residual.eliminate_zeros()
+    return estimate.tocsr(), residual.tocsr()
+
+def top_k_rows(matrix, top_k):
+
+    # keep the top_k largest entries of every row of a csr matrix
+    # return: (csr matrix, L1 norm of the dropped entries of every row)
+    matrix = csr_matrix(matrix)
+    data, dropped = matrix.data.copy(), np.zeros(matrix.shape[0])
+    for i in range(matrix.shape[0]):
+        start, stop = matrix.indptr[i], matrix.indptr[i + 1]
+        if stop - start > top_k:
+            row = data[start:stop]
+            removed = np.argpartition(row, stop - start - top_k)[:stop - start - top_k]
+            dropped[i] = np.abs(row[removed]).sum()
+            row[removed] = 0
+    result = csr_matrix((data, matrix.indices.copy(), matrix.indptr.copy()), shape=matrix.shape)
+    result.eliminate_zeros()
+    return result, dropped
+
+def push_network_propagation(network, drug_target, genes):
+
+    # network: the whole gene-gene network data frame: entrez_a, entrez_b, association
+    # drug_target: index = genes, columns = drugs
+    # genes: genes kept in the propagated profiles, e.g. all network genes
+    # Approximate random walk with restart (alpha = setting.random_walk_alpha) by forward push until every
+    # residual is below setting.push_tolerance, then only the setting.push_top_k largest genes of every drug
+    # are kept. Unlike random_walk_network_propagation, genes without a target are seeded with 0 instead of
+    # 0.00001 so that the seeds and the pushed residuals stay sparse.
+    # return: (data frame, error bounds): index = drugs, columns = genes in the top k of at least one drug,
+    #         standardized as a whole; L1 bound of the error of every drug's top k vector before standardization
+    network_matrix, network_genes = get_sparse_network(network)
+    seeds = csr_matrix(drug_target.reindex(network_genes).fillna(0).values.T)
+    estimate, residual = forward_push(network_matrix, seeds, setting.random_walk_alpha, setting.push_tolerance)
+    columns = network_genes.get_indexer(list(genes))
+    propagated, dropped = top_k_rows(estimate[:, columns[columns >= 0]], setting.push_top_k)
+    error_bounds = pd.Series(np.asarray(abs(residual).sum(axis=1)).reshape(-1) + dropped, index=drug_target.columns)
+    logger.debug("Pushed {!r} drugs, max L1 error bound {!r}".format(len(seeds.indptr) - 1, error_bounds.max()))
+
+    kept = np.unique(propagated.indices)
+    propagated = propagated[:, kept].toarray()
+    std = propagated.std()
+    propagated = (propagated - propagated.mean()) / (std if std else 1)
+    result_matrix = pd.DataFrame(propagated, index=drug_target.columns,
+                                 columns=network_genes[columns[columns >= 0][kept]].astype(int))
+    return result_matrix, error_bounds
+
+def __digest(*arrays):
+
+    sha = hashlib.sha1()
+    for array in arrays:
+        sha.update(np.ascontiguousarray(array).tobytes())
+    return sha.hexdigest()
+
+def __load_propagation_manifest(network_digest, genes):
+
+    ### manifest of the propagated array, None if it was made with another network, gene panel or alphas
+    if setting.renew or not os.path.exists(setting.random_walk_result_array_index) \
+            or not os.path.exists(setting.random_walk_result_array):
+        return None
+    with open(setting.random_walk_result_array_index, 'rb') as f:
+        manifest = pickle.load(f)
+    if manifest.get('network') != network_digest or manifest['alphas'] != list(setting.random_walk_alphas) \
+            or manifest['genes'] != list(genes):
+        return None
+    return manifest
+
+def __update_propagated_array(network, drug_target, genes):
+
+    ### Propagate the drugs whose seed vector is new or changed since the last run and patch them into
+    ### setting.random_walk_result_array, all drugs if there is no usable manifest
+    ### return: bool, whether the array changed
+    network_matrix, network_genes = get_sparse_network(network)
+    ### genes of the network without a drug target profile get a small seed, as in pyNBS
+    seeds = drug_target.reindex(network_genes).fillna(0.00001)
+    drugs = list(seeds.columns)
+    seed_digests = {drug: __digest(seeds[drug].values) for drug in drugs}
+    network_digest = __digest(network_matrix.indptr, network_matrix.indices, network_matrix.data, network_genes.values)
+    manifest = __load_propagation_manifest(network_digest, genes)
+    if manifest is None:
+        changed = drugs
+    else:
+        changed = [drug for drug in drugs if manifest['seeds'].get(drug) != seed_digests[drug]]
+        if not changed and manifest['drugs'] == drugs:
+            return False
+
+    logger.debug("Random walk with restart of {!r} drugs on {!r} genes".format(len(changed), len(network_genes)))
+    propagated = chunked_random_walk_with_restart(network_genes, seeds[changed].values.T, setting.random_walk_alphas,
+                                                  network_genes.get_indexer(list(genes)),
+                                                  setting.random_walk_result_array + '.changed.npy')
+
+    changed_rows = pd.Index(drugs).get_indexer(changed)
+    if manifest is not None and manifest['drugs'] == drugs:
+        ### same drugs, the changed rows are overwritten in place
+        result_array = np.load(setting.random_walk_result_array, mmap_mode='r+')
+        result_array[:, changed_rows] = propagated
+        result_array.flush()
+        del result_array, propagated
+    else:
+        tmp_file = setting.random_walk_result_array + '.tmp.npy'
+        result_array = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32,
+                                                 shape=(len(setting.random_walk_alphas), len(drugs), len(genes)))
+        if manifest is not None:
+            ### drugs kept from the last run are copied over
+            old_array = np.load(setting.random_walk_result_array, mmap_mode='r')
+            old_rows = pd.Index(manifest['drugs']).get_indexer(drugs)
+            kept = np.setdiff1d(np.flatnonzero(old_rows >= 0), changed_rows)
+            result_array[:, kept] = old_array[:, old_rows[kept]]
+            del old_array
+        result_array[:, changed_rows] = propagated
+        result_array.flush()
+        del result_array, propagated
+        os.replace(tmp_file, setting.random_walk_result_array)
+    os.remove(setting.random_walk_result_array + '.changed.npy')
+
+    manifest = {'network': network_digest, 'alphas': list(setting.random_walk_alphas), 'genes': list(genes), 'drugs': drugs, 'seeds': seed_digests}
+    with open(setting.random_walk_result_array_index, 'wb') as f:
+        pickle.dump(manifest, f)
+    logger.debug("Propagated {!r} new or changed drugs out of {!r}".format(len(changed), len(drugs)))
+    return True
+
+def __random_walk_chunk(network_genes, seeds_file, result_file, start, stop, alphas, columns):
+
+    ### worker: propagate the seed rows [start, stop) and write them into the shared result memmap,
+    ### the network is memory mapped from the file saved by get_sparse_network
+    network_matrix = __load_sparse_network(__network_file(network_genes), network_genes)
+    seeds = np.load(seeds_file, mmap_mode='r')[start:stop]
+    result = np.load(result_file, mmap_mode='r+')
+    result[:, start:stop] = random_walk_with_restart(network_matrix, seeds, alphas, genes=network_genes)[:, :, columns]
+    result.flush()
+
+def chunked_random_walk_with_restart(network_genes, seeds, alphas, columns, result_file):
+
+    # network_genes: genes of a network matrix built (and saved) by get_sparse_network
+    # seeds: drugs x network genes
+    # columns: positions in network_genes of the genes kept in the result
+    # Seeds are split in chunks of setting.propagation_chunk_size drugs that are propagated by
+    # setting.propagation_processes worker processes. Workers share the network and the seeds through
+    # memory mapped files and write their chunk into the result memmap.
+    # return memmap (alphas, drugs, columns) saved in result_file
+    seeds_file = result_file + '.seeds.npy'
+    np.save(seeds_file, np.asarray(seeds, dtype=float))
+    result = np.lib.format.open_memmap(result_file, mode='w+', dtype=np.float32,
+                                       shape=(len(alphas), len(seeds), len(columns)))
+    del result
+    if setting.random_walk_solver == 'kernel':
+        ### factorize once in this process, the workers load the cached kernels
+        normalized_network = normalize_matrix(__load_sparse_network(__network_file(network_genes), network_genes), 0)
+        for alpha in alphas:
+            propagation_kernel.get_kernel(normalized_network, alpha, network_genes)
+
+    chunks = [(network_genes, seeds_file, result_file, start, min(start + setting.propagation_chunk_size, len(seeds)),
+               list(alphas), columns) for start in range(0, len(seeds), setting.propagation_chunk_size)]
+    processes = min(setting.propagation_processes or os.cpu_count(), len(chunks))
+    logger.debug("Propagating {!r} drugs in {!r} chunks with {!r} processes".format(len(seeds), len(chunks), processes))
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            pool.starmap(__random_walk_chunk, chunks)
+    else:
+        for chunk in chunks:
+            __random_walk_chunk(*chunk)
+    os.remove(seeds_file)
+    return np.load(result_file, mmap_mode='r')
+
+def random_walk_network_propagation(result_matrix_file, network=None, drug_target=None, genes=None):
+
+    # network: the whole gene-gene network data frame: entrez_a, entrez_b, association
+    # drug_target: index = genes, columns = drugs
+    # genes: genes kept in the propagated profiles
+    # Drug targets are propagated for all setting.random_walk_alphas in one call and kept as one float32
+    # array (alphas, drugs, genes) in setting.random_walk_result_array, with a manifest of the network,
+    # the alphas, the genes and a digest of every drug seed vector. Later calls only propagate the drugs
+    # whose seed vector changed and patch them into the array. The slice of setting.random_walk_alpha,
+    # standardized as a whole, is saved to result_matrix_file.
+    # network, drug_target and genes are only needed if the result matrix has to be computed or updated.
+    # return data frame: index = drugs, columns = genes
+    incremental = drug_target is not None and os.path.exists(setting.random_walk_result_array_index)
+    if setting.renew or not os.path.exists(result_matrix_file) or incremental:
+
+        assert setting.random_walk_alpha in setting.random_walk_alphas, "random_walk_alpha should be one of random_walk_alphas"
+        if __update_propagated_array(network, drug_target, genes) or not os.path.exists(result_matrix_file):
+            with open(setting.random_walk_result_array_index, 'rb') as f:
+                manifest = pickle.load(f)
+            propagated = np.load(setting.random_walk_result_array, mmap_mode='r')
+            propagated = np.asarray(propagated[manifest['alphas'].index(setting.random_walk_alpha)], dtype=float)
+            std = propagated.std()
+            propagated = (propagated - propagated.mean()) / (std if std else 1)
+            result_matrix = pd.DataFrame(propagated, index=manifest['drugs'], columns=manifest['genes'])
+            result_matrix.to_csv(result_matrix_file)
+            logger.debug("Propagation finished")
+
+    result_matrix = csv_cache.read_csv(result_matrix_file, index_col=0)
     result_matrix.columns = result_matrix.columns.astype(int)
     return result_matrix
-
-
-def pyNBS_random_walk():
-
-
-    from pyNBS import network_propagation as NBS_propagation
-    from src.setting import network, drug_profiles, random_walk_simulated_result_matrix, network_path, genes
-    import networkx as nx
-    from src.utils import standarize_dataframe
-
-    # build the matrix from gene gene interaction network, so far
-    # gene-gene self interaction weight is 0
-    network = nx.read_edgelist(network, delimiter='\t', nodetype=int,
-                               data=(('weight', float),))
-    drug_target = pd.read_csv(drug_profiles, index_col=0)
-    genes = set(pd.read_csv(genes,
-                            dtype={'entrez': np.int})['entrez'])
-    drug_target = drug_target.loc[list(network.nodes), :]
-    drug_target.fillna(0.00001, inplace = True)
-    #subnetwork = network.subgraph(list(genes))
-    subnetwork = network
-
-    ### Compute precoputed kernel to speed up random walk
-    subnetwork_nodes = subnetwork.nodes()
-    I = pd.DataFrame(np.identity(len(subnetwork_nodes)), index=subnetwork_nodes, columns=subnetwork_nodes)
-    logger.debug("Preparing network propagation kernel")
-    print("Preparing network propagation kernel")
-    kernel = NBS_propagation.network_propagation(subnetwork, I, alpha=0.9999, symmetric_norm=False, verbose=True)
-    logger.debug("Got network propagation kernel. Start propagate ...")
-    print("Got network propagation kernel. Start propagate ...")
-    #assert len(subnetwork.nodes()) == len(drug_target.index), "{!r}, {!r} doesn't match".format(len(subnetwork.nodes()), len(drug_target.index))
-    propagated_drug_target = NBS_propagation.network_kernel_propagation(network=subnetwork, network_kernel=kernel,
-                                                         binary_matrix=drug_target.T, outdir = network_path)
-    pdb.set_trace()
-    propagated_drug_target = propagated_drug_target.loc[:, list(genes)]
-    logger.debug("Propagation finished")
-    print("Propagation finished")
-    propagated_drug_target = standarize_dataframe(propagated_drug_target)
-    propagated_drug_target.to_csv(random_walk_simulated_result_matrix)
-
-if __name__ == '__main__':
-
-    pyNBS_random_walk()
@@ -0,0 +1,160 @@
+import os
+import json
+import pickle
+import hashlib
+import shutil
+import numpy as np
+from src import setting, logger
+
+
+class _ArrayRef:
+
+    ### placeholder for an ndarray that is persisted as its own .npy file in the artifact folder
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+
+class PreprocessingDAG:
+
+    ### Preprocessing stages (network filter -> drug target profile -> propagation -> per-entity
+    ### features -> Raw_X_features_prep -> final_index) modeled as a DAG. Every stage output is
+    ### stored under setting.preprocessing_cache_dir, content addressed by a fingerprint of
+    ###     the stage name and version,
+    ###     the content of its input files,
+    ###     the values of the settings it depends on,
+    ###     the fingerprints of its upstream stages,
+    ### so that only stages with changed inputs are recomputed and everything else is reused across
+    ### runs and cvn folds. A legacy renew flag set to True forces the stage to be recomputed.
+
+    stages = {}
+    fingerprints = {}
+    results = {}
+    file_digests = None
+
+    @classmethod
+    def register(cls, name, compute, restore=None, deps=(), input_files=(), settings=(), force_flags=(), version=1):
+
+        ### compute: callable returning the stage output
+        ### restore: callable(output), installs a cached output into the data loaders
+        ### input_files: names of setting attributes holding input file paths
+        ### settings: names of setting attributes the output depends on
+        ### force_flags: names of legacy setting flags that force recomputation
+        for dep in deps:
+            assert dep in cls.stages, "stage {!r} has to be registered before {!r}".format(dep, name)
+        cls.stages[name] = {'compute': compute, 'restore': restore, 'deps': tuple(deps),
+                            'input_files': tuple(input_files), 'settings': tuple(settings),
+                            'force_flags': tuple(force_flags), 'version': version}
+
+    @classmethod
+    def __digest_file(cls, file_path):
+
+        ### content hash of one file, memoized on disk by (size, mtime) so that unchanged
+        ### files are not read again in the following runs
+        if cls.file_digests is None:
+            digests_file = os.path.join(setting.preprocessing_cache_dir, 'file_digests.json')
+            cls.file_digests = json.load(open(digests_file)) if os.path.exists(digests_file) else {}
+        if not os.path.exists(file_path):
+            return 'missing'
+        stat = os.stat(file_path)
+        key = os.path.abspath(file_path)
+        cached = cls.file_digests.get(key)
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime_ns:
+            return cached['digest']
+        sha = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        cls.file_digests[key] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'digest': sha.hexdigest()}
+        with open(os.path.join(setting.preprocessing_cache_dir, 'file_digests.json'), 'w') as f:
+            json.dump(cls.file_digests, f)
+        return cls.file_digests[key]['digest']
+
+    @classmethod
+    def fingerprint(cls, name):
+
+        if name not in cls.fingerprints:
+            stage = cls.stages[name]
+            sha = hashlib.sha1()
+            sha.update("{}:{}".format(name, stage['version']).encode())
+            for file_attr in stage['input_files']:
+                file_path = getattr(setting, file_attr, None)
+                sha.update("{}={}".format(file_attr, cls.__digest_file(file_path) if file_path else None).encode())
+            for setting_attr in stage['settings']:
+                sha.update("{}={!r}".format(setting_attr, getattr(setting, setting_attr, None)).encode())
+            for dep in stage['deps']:
+                sha.update("{}={}".format(dep, cls.fingerprint(dep)).encode())
+            cls.fingerprints[name] = sha.hexdigest()[:16]
+        return cls.fingerprints[name]
+
+    @classmethod
+    def __artifact_dir(cls, name):
+        return os.path.join(setting.preprocessing_cache_dir, "{}-{}".format(name, cls.fingerprint(name)))
+
+    @classmethod
+    def __dump(cls, output, artifact_dir):
+
+        ### ndarrays are saved as .npy files so that they can be memory mapped back,
+        ### everything else is pickled
+        tmp_dir = artifact_dir + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        def replace_arrays(item):
+            if isinstance(item, np.ndarray):
+                ref = _ArrayRef('array_{}.npy'.format(len(os.listdir(tmp_dir))))
+                np.save(os.path.join(tmp_dir, ref.file_name), item)
+                return ref
+            if isinstance(item, (list, tuple)):
+                return type(item)(replace_arrays(x) for x in item)
+            if isinstance(item, dict):
+                return {k: replace_arrays(v) for k, v in item.items()}
+            return item
+
+        with open(os.path.join(tmp_dir, 'output.pkl'), 'wb') as f:
+            pickle.dump(replace_arrays(output), f, protocol=4)
+        os.rename(tmp_dir, artifact_dir)
+
+    @classmethod
+    def __load(cls, artifact_dir):
+
+        def restore_arrays(item):
+            if isinstance(item, _ArrayRef):
+                return np.load(os.path.join(artifact_dir, item.file_name), mmap_mode='r')
+            if isinstance(item, (list, tuple)):
+                return type(item)(restore_arrays(x) for x in item)
+            if isinstance(item, dict):
+                return {k: restore_arrays(v) for k, v in item.items()}
+            return item
+
+        with open(os.path.join(artifact_dir, 'output.pkl'), 'rb') as f:
+            return restore_arrays(pickle.load(f))
+
+    @classmethod
+    def run(cls, name):
+
+        ### return the output of stage name, recomputing only if its fingerprint is not in the cache
+        if name in cls.results:
+            return cls.results[name]
+        stage = cls.stages[name]
+        for dep in stage['deps']:
+            cls.run(dep)
+
+        if not os.path.exists(setting.preprocessing_cache_dir):
+            os.makedirs(setting.preprocessing_cache_dir)
+        artifact_dir = cls.__artifact_dir(name)
+        forced = any(getattr(setting, flag, False) for flag in stage['force_flags'])
+        if not forced and os.path.exists(artifact_dir):
+            logger.debug("Reuse cached preprocessing stage {!r} ({})".format(name, cls.fingerprint(name)))
+            output = cls.__load(artifact_dir)
+            if stage['restore'] is not None:
+                stage['restore'](output)
+        else:
+            logger.debug("Computing preprocessing stage {!r} ({})".format(name, cls.fingerprint(name)))
+            output = stage['compute']()
+            if os.path.exists(artifact_dir):
+                shutil.rmtree(artifact_dir)
+            cls.__dump(output, artifact_dir)
+            logger.debug("Cached preprocessing stage {!r} in {!r}".format(name, artifact_dir))
+        cls.results[name] = output
+        return output
@@ -0,0 +1,113 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from scipy.sparse import csr_matrix, identity
+from scipy.sparse.linalg import splu, spsolve_triangular
+from src import setting, logger
+
+
+### Random walk with restart kernels propagated = seeds * K, K = (1 - alpha) (I - alpha W)^-1, cached on disk
+### under setting.propagation_kernel_dir, keyed by the content of the normalized network W, the gene panel
+### and alpha. A panel with up to setting.propagation_kernel_dense_genes genes keeps K itself (one matmul
+### per propagation), a larger panel keeps the sparse LU factors of (I - alpha W)^T (two triangular solves
+### per propagation). Least recently used kernels are removed once the folder grows beyond
+### setting.propagation_kernel_cache_bytes.
+
+class PropagationKernel:
+
+    def __init__(self, kind, alpha, arrays):
+
+        self.kind = kind
+        self.alpha = alpha
+        self.arrays = arrays
+
+    def propagate(self, seeds):
+
+        ### seeds: drugs x genes, return drugs x genes
+        seeds = np.asarray(seeds, dtype=float)
+        if self.kind == 'dense':
+            return seeds.dot(self.arrays['kernel'])
+
+        ### Pr (I - alpha W)^T Pc = L U, solve (I - alpha W)^T propagated^T = (1 - alpha) seeds^T
+        n = len(self.arrays['perm_r'])
+        lower = csr_matrix((self.arrays['L_data'], self.arrays['L_indices'], self.arrays['L_indptr']), shape=(n, n))
+        upper = csr_matrix((self.arrays['U_data'], self.arrays['U_indices'], self.arrays['U_indptr']), shape=(n, n))
+        permuted = np.empty(shape=(n, len(seeds)))
+        permuted[self.arrays['perm_r']] = (1 - self.alpha) * seeds.T
+        solved = spsolve_triangular(lower, permuted, lower=True, unit_diagonal=True)
+        solved = spsolve_triangular(upper, solved, lower=False)
+        return solved[self.arrays['perm_c']].T
+
+def __kernel_key(normalized_network, genes, alpha):
+
+    normalized_network = csr_matrix(normalized_network)
+    normalized_network.sort_indices()
+    sha = hashlib.sha1()
+    for array in (normalized_network.indptr, normalized_network.indices, normalized_network.data):
+        sha.update(np.ascontiguousarray(array).tobytes())
+    sha.update(np.asarray(genes if genes is not None else [], dtype=np.int64).tobytes())
+    sha.update("{!r}".format(float(alpha)).encode())
+    return sha.hexdigest()[:16]
+
+def __factorize(normalized_network, alpha):
+
+    n = normalized_network.shape[0]
+    system = (identity(n, format='csc') - alpha * normalized_network).T.tocsc()
+    ### the system has the symmetric sparsity pattern of the network
+    lu = splu(system, permc_spec='MMD_AT_PLUS_A')
+    if n <= setting.propagation_kernel_dense_genes:
+        ### K^T = (1 - alpha) (I - alpha W)^-T
+        return 'dense', {'kernel': lu.solve((1 - alpha) * np.identity(n)).T.astype(np.float32)}
+    lower, upper = lu.L.tocsr(), lu.U.tocsr()
+    return 'lu', {'L_data': lower.data, 'L_indices': lower.indices, 'L_indptr': lower.indptr,
+                  'U_data': upper.data, 'U_indices': upper.indices, 'U_indptr': upper.indptr,
+                  'perm_r': lu.perm_r, 'perm_c': lu.perm_c}
+
+def __folder_size(folder):
+    return sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+
+def __evict(keep):
+
+    ### remove least recently used kernels until the cache fits, the folder mtime is the last use
+    entries = [os.path.join(setting.propagation_kernel_dir, name) for name in os.listdir(setting.propagation_kernel_dir)
+               if not name.endswith('.tmp')]
+    entries.sort(key=os.path.getmtime)
+    total = sum(__folder_size(entry) for entry in entries)
+    for entry in entries:
+        if total <= setting.propagation_kernel_cache_bytes:
+            break
+        if entry == keep:
+            continue
+        total -= __folder_size(entry)
+        shutil.rmtree(entry)
+        logger.debug("Evicted propagation kernel {!r}".format(entry))
+
+def get_kernel(normalized_network, alpha, genes=None):
+
+    ### normalized_network: n x n sparse W, genes: entrez ids of the rows of W
+    key = __kernel_key(normalized_network, genes, alpha)
+    kernel_dir = os.path.join(setting.propagation_kernel_dir, key)
+    meta_file = os.path.join(kernel_dir, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(kernel_dir, name + '.npy'), mmap_mode='r') for name in meta['arrays']}
+        os.utime(kernel_dir)
+        logger.debug("Reuse propagation kernel {!r}".format(kernel_dir))
+        return PropagationKernel(meta['kind'], alpha, arrays)
+
+    logger.debug("Computing {!r} x {!r} propagation kernel with alpha {!r}".format(*normalized_network.shape, alpha))
+    kind, arrays = __factorize(csr_matrix(normalized_network, dtype=float), alpha)
+    tmp_dir = kernel_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), array)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'kind': kind, 'alpha': float(alpha), 'arrays': list(arrays)}, f)
+    os.rename(tmp_dir, kernel_dir)
+    __evict(kernel_dir)
+    return PropagationKernel(kind, alpha, arrays)
@@ -19,20 +19,8 @@ def create_drugs_profiles(raw_chemicals, genes):
         drug_profile = pd.read_csv(setting.drug_profiles, index_col=0)
         return drug_profile
 
-    drug_profile = np.zeros(shape=(len(raw_chemicals), len(genes)))
-    drug_profile = pd.DataFrame(drug_profile, columns=genes['entrez'], index=raw_chemicals['Name'])
-    entrez_set = set(genes['entrez'])
-    for row in raw_chemicals.iterrows():
-
-        if not isinstance(row[1]['combin_entrez'], str):
-            continue
-
-        chem_name, target_list = row[1]['Name'], row[1]['combin_entrez'].split(",")
-        for target in target_list:
-            target = int(target)
-            if target in entrez_set:
-
-                drug_profile.loc[chem_name, target] = 1
+    drug_target_matrix = my_data.DrugTargetProfileDataLoader.build_drug_target_matrix(raw_chemicals, genes['entrez'])
+    drug_profile = pd.DataFrame(drug_target_matrix.T.toarray(), columns=genes['entrez'], index=raw_chemicals['Name'])
     print(setting.drug_profiles)
     drug_profile.T.to_csv(setting.drug_profiles)
     return drug_profile.T
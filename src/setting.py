@@ -27,7 +27,7 @@ if not os.path.exists(run_dir):
     shutil.copyfile(cur_dir_setting, run_specific_setting)
 
 
-# propagation_methods: target_as_1, RWlike, random_walk
+# propagation_methods: target_as_1, RWlike, random_walk, random_walk_push
 propagation_method = 'random_walk'
 # feature type: LINCS1000, others, determine whether or not ignoring drugs without hidden representation
 feature_type = 'more'
@@ -50,8 +50,35 @@ if not os.path.exists(data_folder):
     os.makedirs(data_folder)
     open(os.path.join(data_folder, "__init__.py"), 'w+').close()
 
-
-
+# all data points are kept in one float32 matrix, rows are addressed by final_index
+feature_store = os.path.join(data_folder, 'feature_store.npy')
+feature_store_index = os.path.join(data_folder, 'feature_store_index.csv')
+feature_store_layout = os.path.join(data_folder, 'feature_store_layout.pkl')
+feature_store_chunk_size = 4096
+# drug and cell line features are kept in per entity tables and gathered per batch (on the training device),
+# combine_drugs_for_cl depends on the drug pair and is kept as a drug pair table times a cell line factor
+# (pair_block of EntityFeatureTables), multiplied per batch
+factorized_features = True
+gather_on_device = True
+# dense raw X is built out of core: row blocks of raw_x_chunk_size rows are streamed into float32 memmaps
+raw_x_chunk_size = 4096
+raw_x_first_half = os.path.join(data_folder, 'raw_x_first_half.npy')
+raw_x_file = os.path.join(data_folder, 'raw_x.npy')
+
+# preprocessing stages are cached under a fingerprint of their inputs and settings (src/pipeline_cache.py),
+# the renew/update flags below only force a stage to be recomputed
+use_preprocessing_cache = True
+preprocessing_cache_dir = os.path.join(data_src_dir, 'preprocessing_cache')
+# csv/tsv sources are converted once into memory mapped binary columns (src/csv_cache.py),
+# float tables with at least csv_cache_matrix_min_columns columns are stored as float32
+use_csv_cache = True
+csv_cache_dir = os.path.join(data_src_dir, 'csv_cache')
+csv_cache_matrix_min_columns = 64
+
+# the downloaded zenodo x.npy / old_x_lengths.pkl / y.pkl are used when they exist (unless update_xy is set or
+# use_downloaded_x is off), otherwise X and final_index come from the preprocessing stages (or are rebuilt if
+# use_preprocessing_cache is off). final_index.csv is read if update_final_index is off
+use_downloaded_x = True
 update_final_index = True
 final_index = os.path.join(data_src_dir, "synergy_score/final_index.csv")
 update_xy = False
@@ -63,6 +90,8 @@ old_y = os.path.join(data_src_dir,"synergy_score/y.pkl")
 # old_y = os.path.join('/workspace/TranSynergy', "y.pkl")
 
 y_labels_file = os.path.join(src_dir, 'y_labels.p')
+# drug, cell line, gene and combination ids used in saved labels, partitions and predictions
+id_catalog = os.path.join(working_dir, 'id_catalog.pkl')
 ### ecfp, phy, ge, gd
 catoutput_output_type = data_specific + "_dt"
 save_final_pred = True
@@ -83,6 +112,7 @@ genes = os.path.join(data_src_dir, 'Genes', 'genes_2401_df.csv')
 synergy_score = os.path.join(data_src_dir, 'synergy_score', 'synergy_score.csv')
 pathway_dataset = os.path.join(data_src_dir, 'pathways', 'genewise.p')
 cl_genes_dp = os.path.join(data_src_dir, 'cl_gene_dp', 'new_gene_dependencies_35.csv')
+genes_dp_indexes = os.path.join(data_src_dir, 'cl_gene_dp', 'all_dependencies_genes_map.csv')
 #genes_network = '../genes_network/genes_network.csv'
 #drugs_profile = '../drugs_profile/drugs_profile.csv'
 L1000_upregulation = os.path.join(data_src_dir, 'F_repr', 'sel_F_drug_sample.csv')
@@ -102,7 +132,10 @@ network_update = True
 network_prop_normalized = True
 network_path = os.path.join(data_src_dir, 'network')
 network = os.path.join(data_src_dir, 'network', 'string_network')
-network_matrix = os.path.join(data_src_dir, 'network', 'string_network_matrix.csv')
+# binary csr edge list of the network file, built once per gene panel (src/network_cache.py)
+network_cache_dir = os.path.join(data_src_dir, 'network', 'edge_cache')
+# symmetric sparse gene-gene matrices are saved as memory mappable csr arrays, one folder per gene panel
+network_matrix = os.path.join(data_src_dir, 'network', 'string_network_matrix')
 split_random_seed = 3
 index_in_literature = True
 index_renewal = True
@@ -137,8 +170,33 @@ combine_drug_target_matrix = os.path.join(data_src_dir, 'chemicals', 'combine_dr
 
 drug_profiles_renew = False
 drug_profiles = os.path.join(data_src_dir, 'chemicals','new_dedup_drug_profile.csv')
-
-python_interpreter_path = '/Users/QiaoLiu1/anaconda3/envs/pynbs_env/bin/python'
+raw_chemicals = os.path.join(data_src_dir, 'chemicals', 'raw_chemicals.csv')
+
+# random walk with restart on the whole network: drug targets are propagated for all random_walk_alphas
+# in one call, random_walk_alpha is the one used as drug features. The raw propagated array and its manifest
+# are kept, so that later runs only propagate new drugs and drugs whose targets changed
+# random_walk_solver: power (power iteration until random_walk_tolerance, fast for alpha <= 0.8),
+# kernel (exact, cached dense kernel or sparse LU factors, for small networks or alpha close to 1)
+random_walk_alphas = [0.1, 0.3, 0.5, 0.55, 0.8]
+random_walk_alpha = 0.3
+random_walk_solver = 'power'
+random_walk_tolerance = 1e-8
+random_walk_result_array = os.path.join(data_src_dir, 'chemicals', 'random_walk_simulated_result_array.npy')
+random_walk_result_array_index = os.path.join(data_src_dir, 'chemicals', 'random_walk_simulated_result_array_index.pkl')
+# random_walk_push: approximate random walk with restart by forward push, residuals are pushed until all
+# are below push_tolerance and the top push_top_k genes are kept per drug, for whole network gene panels
+push_tolerance = 1e-6
+push_top_k = 500
+# drug seeds are propagated in chunks of propagation_chunk_size drugs by propagation_processes worker
+# processes (None: one per core) sharing the memory mapped network
+propagation_chunk_size = 64
+propagation_processes = None
+# random walk kernels are cached by network content, gene panel and alpha (src/propagation_kernel.py): the
+# dense kernel for up to propagation_kernel_dense_genes genes, sparse LU factors otherwise, least recently
+# used kernels are removed beyond propagation_kernel_cache_bytes
+propagation_kernel_dir = os.path.join(data_src_dir, 'network', 'propagation_kernels')
+propagation_kernel_dense_genes = 5000
+propagation_kernel_cache_bytes = 8 * 1024 ** 3
 
 y_transform = True
 
@@ -171,6 +229,20 @@ d_model = d_model_i * d_model_j
 attention_heads = 1
 attention_dropout = 0.1
 n_layers = 1 # This has to be 1
+### MultiHeadAttention backend: 'math' materializes the batch x heads x d_model_j x d_model_j scores, 'sdpa' uses
+### torch scaled_dot_product_attention ('chunked' if not available), 'chunked' an online softmax over
+### attention_chunk_size key positions at a time. Approximations in linear time and memory (compared in
+### attention_benchmark.py): 'performer' with performer_features random features and no extra parameters,
+### 'lowrank' with keys and values projected to lowrank_attention_k learned positions (new parameters)
+attention_backend = 'sdpa'
+attention_chunk_size = 64
+performer_features = 64
+performer_seed = 0
+lowrank_attention_k = 64
+### None or 'compile' (torch.compile of the whole training model). Compiling only helps inference: on one cpu core
+### a training step was slower (1.39s vs 1.25s), inference was 5x faster with the 'math' attention backend and
+### about the same with 'sdpa'
+model_compile = None
 
 model_folder = os.path.join(working_dir, 'model')
 if not os.path.exists(model_folder):
@@ -190,4 +262,13 @@ perform_importance_study = False
 input_importance_path = os.path.join(working_dir, "input_importance_" + data_specific)
 out_input_importance_path = os.path.join(working_dir, "out_input_importance_" + data_specific)
 transform_input_importance_path = os.path.join(working_dir, "transform_input_importance_" +data_specific)
+### run the per feature type linear layers of TransposeMultiTransformers as one grouped matmul. The layer weights
+### are stacked in every step, on one cpu core this is not faster than the per feature type loop (slower when
+### self_conditioned), so it is opt-in. The importance study explains the single linear and dropout layers, it
+### needs them to be called one by one
+grouped_projection = False
+### the decoder input of TransposeMultiTransformersPlusLinear is its encoder input, project it once for both.
+### Encoder and decoder then get the same dropout masks instead of two independent draws, so training is not
+### reproducible against the default. Eval outputs and the parameters (so saved models) are the same in both modes
+self_conditioned = False
 feature_importance_path = os.path.join(working_dir, 'all_features_importance_' + data_specific )
@@ -11,6 +11,7 @@ import os
 class SHAP_ANALYSIS:
 
     drug_target = None
+    catalog = None
     def __init__(self, data, index_list, genes):
         assert data.shape[0] == len(index_list), "data and index are not matching"
         assert data.shape[1] == 3, "more than 3 input feature sets"
@@ -19,6 +20,32 @@ class SHAP_ANALYSIS:
                                                    pd.DataFrame( data[:,2,:], index= index_list, columns= genes)
         if self.drug_target is None:
             self.drug_target = pd.read_csv(shap_analysis_setting.drug_target, index_col=0)
+        if self.catalog is None and os.path.exists(shap_analysis_setting.id_catalog_file):
+            self.catalog = pickle.load(open(shap_analysis_setting.id_catalog_file, 'rb'))
+
+    def __describe(self, index_name):
+
+        ### return drug_a, drug_b, cell_line and printable name of a combination id (or legacy name)
+        if isinstance(index_name, str):
+            ### legacy name drugA_drugB_cellline_row
+            if self.catalog is None:
+                ### split on '_': a '_' in drug_b or in the cell line name ends up in the wrong field
+                drug_a, drug_b, cell_line, _ = index_name.rsplit("_", 3)
+                return drug_a, drug_b, cell_line, index_name
+            ### the row ends the name, one of the two drug orders of that row has the same name
+            combinations = self.catalog['combinations']
+            row = int(index_name.rsplit("_", 1)[1])
+            matches = [described for described in (self.__describe(combination_id) for combination_id in
+                                                    combinations.index[combinations['row'] == row])
+                       if described[3] == index_name]
+            assert len(matches) == 1, "{!r} is not a combination of the id catalog".format(index_name)
+            return matches[0]
+        assert self.catalog is not None, \
+            "{!r} is needed to describe combination id {!r}".format(shap_analysis_setting.id_catalog_file, index_name)
+        combination = self.catalog['combinations'].loc[int(index_name)]
+        drug_a, drug_b = self.catalog['drugs'][combination['drug_a']], self.catalog['drugs'][combination['drug_b']]
+        cell_line = self.catalog['cell_lines'][combination['cell_line']]
+        return drug_a, drug_b, cell_line, "{}_{}_{}_{}".format(drug_a, drug_b, cell_line, combination['row'])
 
     def plot_gene_wise_shap(self, index_name):
 
@@ -35,7 +62,7 @@ class SHAP_ANALYSIS:
         plt.rcParams['font.family'] = 'serif'
         rcParams['font.sans-serif'] = ['Palatino']
         rcParams['figure.max_open_warning'] = 30
-        drug_a, drug_b, cell_line, _ = index_name.split("_")
+        drug_a, drug_b, cell_line, index_name = self.__describe(index_name)
         drug_a_target = self.drug_target.loc[drug_a, 'combin_gene'].split(",")
         drug_b_target = self.drug_target.loc[drug_b, 'combin_gene'].split(",")
         drug_a_high_shap_gene = shap_series[0].sort_values(ascending=False)[:n].index
@@ -108,6 +135,9 @@ if __name__ == "__main__":
     training_df = pd.DataFrame(training_data, columns=['combination', 'prediction', 'ground_truth'])
     testing_data = load(shap_analysis_setting.prediction_testing)
     testing_df = pd.DataFrame(testing_data[:len(testing_data)//2, :], columns=['combination', 'prediction', 'ground_truth'])
+    if os.path.exists(shap_analysis_setting.id_catalog_file):
+        ### predictions are saved with integer combination ids
+        testing_df['combination'] = testing_df['combination'].astype(np.int64)
 
     alpha = 2
     testing_df['order'] = pd.to_numeric(testing_df['ground_truth']) - \
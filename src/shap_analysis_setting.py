@@ -6,6 +6,7 @@ prediction_testing = os.path.join(cwd, "shap_analysis_dat/prediction_nest_label_
 
 importance_files = ["shap_analysis_dat/input_importance_nest_label_2401_0.5_dedup_norm_drug_norm_net"]
 all_index_list_file = "shap_analysis_dat/all_index_list"
+id_catalog_file = "shap_analysis_dat/id_catalog.pkl"
 
 drug_target = os.path.join(cwd, "chemicals/new_raw_chemicals.csv")
 gene_map_df_file = "Genes/genes_2401_df.csv"
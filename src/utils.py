@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 from sklearn.preprocessing import StandardScaler
 
 def uniprot2gene(uniprotIDs):
@@ -43,3 +44,40 @@ def standarize_dataframe(df, with_mean = True):
     for col in df.columns:
         df.loc[:, col] = scaler.transform(df.loc[:, col].values.reshape(-1,1))
     return df
+
+def rows_to_memmap(source, file_path, columns = None, n_rows = None, chunk_size = 4096, dtype = np.float32):
+
+    ### source: 2d array like supporting len() and source[row_positions], e.g. ndarray, DrugSwappedView,
+    ### EntityFeatureTables
+    ### columns: optional bool mask or positions of the columns to keep
+    ### n_rows: optional number of leading rows to keep, all rows by default
+    ### return: .npy memmap of source[:n_rows, columns], written one row block at a time
+    n_rows = len(source) if n_rows is None else n_rows
+    n_columns = source.shape[1] if columns is None else len(np.arange(source.shape[1])[columns])
+    out = np.lib.format.open_memmap(file_path, mode='w+', dtype=dtype, shape=(n_rows, n_columns))
+    for start in range(0, n_rows, chunk_size):
+        stop = min(start + chunk_size, n_rows)
+        rows = np.asarray(source[np.arange(start, stop)])
+        out[start:stop] = rows if columns is None else rows[:, columns]
+    out.flush()
+    return out
+
+def streaming_column_variance(source, chunk_size = 4096):
+
+    ### population variance of every column, same as np.var(source, axis=0), computed from row blocks
+    ### of source merged with the parallel Welford (Chan et al.) update, in float64
+    count, mean, m2 = 0, None, None
+    for start in range(0, len(source), chunk_size):
+        stop = min(start + chunk_size, len(source))
+        rows = np.asarray(source[np.arange(start, stop)], dtype=np.float64)
+        chunk_count, chunk_mean = len(rows), rows.mean(axis=0)
+        chunk_m2 = ((rows - chunk_mean) ** 2).sum(axis=0)
+        if mean is None:
+            count, mean, m2 = chunk_count, chunk_mean, chunk_m2
+            continue
+        delta = chunk_mean - mean
+        total = count + chunk_count
+        mean = mean + delta * chunk_count / total
+        m2 = m2 + chunk_m2 + delta ** 2 * count * chunk_count / total
+        count = total
+    return m2 / count
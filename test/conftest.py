@@ -0,0 +1,62 @@
+import os
+import sys
+
+### same import path as attention_main, run the tests from the repository root (src.setting copies itself
+### into the run directory)
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+sys.path.append(os.path.join(root_dir, 'src', 'NeuralFingerPrint'))
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def toy_samples(monkeypatch, tmp_path):
+
+    ### SamplesDataLoader, IdCatalog and SynergyDataReader filled with a toy data set instead of the data/ files:
+    ### 3 drugs, 2 cell lines, 4 genes and 4 combinations. Returns the SamplesDataLoader class, the feature
+    ### settings can be changed with monkeypatch before its features are built
+    from src import setting, my_data, network_propagation
+    generator = np.random.RandomState(0)
+    genes = [11, 12, 13, 14]
+    drugs, celllines = ['5-FU', 'ABT-888', 'MK_2206'], ['A2058', 'A375']
+    synergy_score = pd.DataFrame({'drug_a_name': ['ABT-888', '5-FU', 'ABT-888', 'MK_2206'],
+                                  'drug_b_name': ['5-FU', 'MK_2206', '5-FU', 'ABT-888'],
+                                  'cell_line': ['A2058', 'A375', 'A375', 'A2058'],
+                                  'synergy': [7.7, -1.2, 2.6, 0.4]})
+    pair_names = synergy_score['drug_a_name'] + '_' + synergy_score['drug_b_name']
+    drug_pair_target = pd.DataFrame(generator.rand(3, len(genes)), index=pair_names.unique(), columns=genes)
+    expression_df = pd.DataFrame(generator.rand(len(genes), 2), index=genes, columns=celllines)
+    single_drug_response = generator.rand(len(celllines), len(drugs))
+    single_drug_response[1, 2] = np.nan
+
+    for name, value in {'drug_features': ['drug_target_profile'],
+                        'cellline_features': ['gene_dependence', 'combine_drugs_for_cl', 'gene_expression'],
+                        'add_single_response_to_drug_target': True, 'expression_dependencies_interaction': True,
+                        'combine_gene_expression_renew': True,
+                        'gene_expression_simulated_result_matrix': str(tmp_path / 'combine_drugs_for_cl.csv')}.items():
+        monkeypatch.setattr(setting, name, value)
+    monkeypatch.setattr(my_data.SynergyDataReader, 'get_synergy_score', classmethod(lambda cls: synergy_score))
+    monkeypatch.setattr(my_data.GenesDataReader, 'get_gene_entrez_set', classmethod(lambda cls: set(genes)))
+    for name in ('drugs', 'cell_lines', 'genes', 'combinations'):
+        monkeypatch.setattr(my_data.IdCatalog, name, None)
+    ### the eager combine_drugs_for_cl product of the propagated pair targets, without the network propagation
+    monkeypatch.setattr(network_propagation, 'drug_pair_target_as_0_network_propagation',
+                        lambda network, entrez_set, drug_target, drug_pairs: drug_pair_target)
+    combine_drug_multi_gene_express = network_propagation.drug_combine_multiplication_gene_expression_network_propagation(
+        None, expression_df, genes, None, synergy_score, setting.gene_expression_simulated_result_matrix)
+
+    loader = my_data.SamplesDataLoader
+    for name, value in {'data_initialized': True, 'entrez_set': genes, 'synergy_score': synergy_score,
+                        'simulated_drug_target': pd.DataFrame(generator.rand(len(drugs), len(genes)), index=drugs,
+                                                              columns=genes),
+                        'sel_dp': pd.DataFrame(generator.rand(len(genes), 2), index=genes, columns=celllines),
+                        'expression_df': expression_df, 'netexpress_df': None, 'drug_pair_target': drug_pair_target,
+                        'combine_drug_multi_gene_express': combine_drug_multi_gene_express,
+                        'single_drug_response': single_drug_response, 'drug_a_features': None,
+                        'drug_b_features': None, 'drug_features': None, 'cellline_features': None,
+                        'whole_df': None, 'drug_features_lengths': [], 'cellline_features_lengths': []}.items():
+        monkeypatch.setattr(loader, name, value)
+    return loader
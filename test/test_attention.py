@@ -0,0 +1,54 @@
+import torch
+import pytest
+from src import setting
+from src.Sublayers import attention, chunked_attention, fused_attention, performer_attention, \
+    orthogonal_random_features, MultiHeadAttention
+
+
+def get_inputs(generator, batch_size=4, heads=2, length=50, d_k=8):
+
+    ### q, k, v: batch x heads x length x d_k and a key mask batch x 1 x length
+    q, k, v = (torch.randn(batch_size, heads, length, d_k, generator=generator) * 0.5 for _ in range(3))
+    mask = (torch.rand(batch_size, 1, length, generator=generator) > 0.3).float()
+    return q, k, v, mask
+
+def relative_error(output, exact):
+    return ((output - exact).norm() / exact.norm()).item()
+
+@pytest.mark.parametrize('masked', [False, True])
+def test_exact_backends_match(masked):
+
+    q, k, v, mask = get_inputs(torch.Generator().manual_seed(0))
+    mask = mask if masked else None
+    exact = attention(q, k, v, q.size(-1), mask)
+    assert torch.allclose(chunked_attention(q, k, v, q.size(-1), mask, chunk_size=16), exact, atol=1e-5)
+    assert torch.allclose(fused_attention(q, k, v, mask), exact, atol=1e-5)
+
+@pytest.mark.parametrize('masked', [False, True])
+def test_performer_close_to_exact(masked):
+
+    generator = torch.Generator().manual_seed(0)
+    q, k, v, mask = get_inputs(generator)
+    mask = mask if masked else None
+    exact = attention(q, k, v, q.size(-1), mask)
+    few = performer_attention(q, k, v, orthogonal_random_features(64, q.size(-1), generator), mask)
+    many = performer_attention(q, k, v, orthogonal_random_features(1024, q.size(-1), generator), mask)
+    ### the approximation improves with the number of random features
+    assert relative_error(many, exact) < 0.1
+    assert relative_error(many, exact) < relative_error(few, exact)
+
+def test_lowrank_identity_projection_is_exact(monkeypatch):
+
+    ### with as many projected positions as positions and an identity projection lowrank is exact attention
+    length, d_model, heads = 20, 16, 2
+    monkeypatch.setattr(setting, 'd_model_j', length)
+    monkeypatch.setattr(setting, 'lowrank_attention_k', length)
+    torch.manual_seed(0)
+    exact = MultiHeadAttention(heads, d_model, dropout=0., backend='math').eval()
+    lowrank = MultiHeadAttention(heads, d_model, dropout=0., backend='lowrank').eval()
+    lowrank.load_state_dict(exact.state_dict(), strict=False)
+    with torch.no_grad():
+        lowrank.seq_projection.weight.copy_(torch.eye(length))
+    x = torch.randn(3, length, d_model)
+    with torch.no_grad():
+        assert torch.allclose(lowrank(x, x, x), exact(x, x, x), atol=1e-5)
@@ -0,0 +1,49 @@
+import torch
+from src import setting, attention_model
+
+
+def get_model(monkeypatch, length=32, **settings):
+
+    ### small TransposeMultiTransformersPlusLinear on the cpu (its drug fingerprints are built on cuda:0),
+    ### 4 feature types of 50 inputs projected to length positions
+    monkeypatch.setattr(attention_model, 'device', lambda name: torch.device('cpu'))
+    monkeypatch.setattr(setting, 'd_model_j', length)
+    monkeypatch.setattr(setting, 'd_model', setting.d_model_i * length)
+    monkeypatch.setattr(setting, 'output_FF_layers', [64, 32, 1])
+    for name, value in settings.items():
+        monkeypatch.setattr(setting, name, value)
+    torch.manual_seed(0)
+    return attention_model.get_multi_models([4 * 50]).to(torch.device('cpu'))
+
+def get_inputs(batch_size=8):
+    return torch.randn(batch_size, 4, 50, generator=torch.Generator().manual_seed(1))
+
+def test_self_conditioned_eval_outputs_match(monkeypatch):
+
+    model = get_model(monkeypatch, self_conditioned=False)
+    self_conditioned = get_model(monkeypatch, self_conditioned=True)
+    ### same parameters, so saved models load in either mode
+    assert list(model.state_dict()) == list(self_conditioned.state_dict())
+    self_conditioned.load_state_dict(model.state_dict())
+    model.eval()
+    self_conditioned.eval()
+    x = get_inputs()
+    with torch.no_grad():
+        assert torch.allclose(self_conditioned(x), model(x), atol=1e-6)
+
+def test_grouped_projection_matches_loop(monkeypatch):
+
+    for self_conditioned in (False, True):
+        model = get_model(monkeypatch, one_linear_per_dim=True, self_conditioned=self_conditioned).eval()
+        x = get_inputs()
+        outputs, grads = [], []
+        for grouped_projection in (False, True):
+            model.grouped_projection = grouped_projection
+            model.zero_grad()
+            output = model(x)
+            output.sum().backward()
+            outputs.append(output.detach())
+            grads.append([param.grad.clone() for param in model.linear_layers.parameters()])
+        assert torch.allclose(outputs[1], outputs[0], atol=1e-5)
+        for grouped_grad, grad in zip(grads[1], grads[0]):
+            assert torch.allclose(grouped_grad, grad, atol=1e-5)
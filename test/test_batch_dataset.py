@@ -0,0 +1,34 @@
+import numpy as np
+import torch
+from src import my_data
+
+
+def test_batch_index_sampler_covers_every_position():
+
+    sampler = my_data.BatchIndexSampler(10, 4, shuffle=True)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 3
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert sorted(np.concatenate(batches)) == list(range(10))
+    assert [list(batch) for batch in my_data.BatchIndexSampler(5, 2)] == [[0, 1], [2, 3], [4]]
+
+def test_batches_match_per_sample_gather(monkeypatch):
+
+    ### 6 combinations in the feature store, 2 x 3 features each
+    features = np.random.RandomState(0).rand(6, 2, 3).astype(np.float32)
+    labels = np.arange(6, dtype=np.float32) * 10
+    smiles = np.array(['C', 'CC', 'CCC', 'CO', 'CN', 'CS'], dtype=object)
+    monkeypatch.setattr(my_data.FeatureStore, 'features', features)
+    monkeypatch.setattr(my_data.FeatureStore, 'n_rows', len(features))
+    monkeypatch.setattr(my_data.BatchDataset, 'smiles_a', smiles)
+    monkeypatch.setattr(my_data.BatchDataset, 'smiles_b', smiles[::-1].copy())
+
+    IDs = np.array([5, 1, 3, 0])
+    gathered = list(my_data.get_batch_generator(IDs, labels, 3))
+    assert len(gathered) == 2
+    (X, smiles_a, smiles_b), y = gathered[0]
+    assert torch.equal(X, torch.from_numpy(features[[5, 1, 3]]))
+    assert torch.equal(y, torch.from_numpy(labels[[5, 1, 3]]))
+    assert list(smiles_a) == ['CS', 'CC', 'CO'] and list(smiles_b) == ['C', 'CN', 'CCC']
+    (X, _, _), y = gathered[1]
+    assert torch.equal(X, torch.from_numpy(features[[0]])) and y.tolist() == [0.]
@@ -0,0 +1,79 @@
+import copy
+import torch
+import pytest
+from src import setting, attention_model
+
+backends = ['math', 'sdpa', 'chunked', 'performer', 'lowrank']
+
+
+def get_masks(generator, batch_size, length):
+
+    ### key masks batch x 1 x length, every row keeps at least its first position
+    src_mask = (torch.rand(batch_size, 1, length, generator=generator) > 0.3).float()
+    trg_mask = (torch.rand(batch_size, 1, length, generator=generator) > 0.3).float()
+    src_mask[..., 0], trg_mask[..., 0] = 1, 1
+    return src_mask, trg_mask
+
+def get_model(monkeypatch, length=32):
+
+    ### small TransposeMultiTransformersPlusLinear on the cpu (its drug fingerprints are built on cuda:0),
+    ### 4 feature types projected to length positions
+    monkeypatch.setattr(attention_model, 'device', lambda name: torch.device('cpu'))
+    monkeypatch.setattr(setting, 'd_model_j', length)
+    monkeypatch.setattr(setting, 'd_model', setting.d_model_i * length)
+    monkeypatch.setattr(setting, 'output_FF_layers', [64, 32, 1])
+    torch.manual_seed(0)
+    return attention_model.get_multi_models([4 * 50]).to(torch.device('cpu'))
+
+def assert_same_step(model, compiled, *inputs, **kwargs):
+
+    ### same outputs in eval mode, same gradients after one backward step (dropout off)
+    model.eval()
+    compiled.eval()
+    expected = model(*inputs, **kwargs)
+    output = compiled(*inputs, **kwargs)
+    assert torch.allclose(output, expected, atol=1e-5, rtol=1e-4)
+    expected.sum().backward()
+    output.sum().backward()
+    for (name, param), compiled_param in zip(model.named_parameters(), compiled.parameters()):
+        assert (param.grad is None) == (compiled_param.grad is None), name
+        if param.grad is not None:
+            assert torch.allclose(compiled_param.grad, param.grad, atol=1e-5, rtol=1e-4), name
+
+@pytest.mark.parametrize('backend', backends)
+@pytest.mark.parametrize('masked', [False, True])
+def test_scripted_transformer(monkeypatch, backend, masked):
+
+    length, d_model, batch_size = 16, 4, 3
+    monkeypatch.setattr(setting, 'd_model_j', length)
+    torch.manual_seed(0)
+    model = attention_model.Transformer(d_model, 1, 1, 0.1, attention_backend=backend)
+    scripted = torch.jit.script(copy.deepcopy(model))
+    generator = torch.Generator().manual_seed(1)
+    src, trg = torch.randn(batch_size, length, d_model, generator=generator), \
+               torch.randn(batch_size, length, d_model, generator=generator)
+    src_mask, trg_mask = get_masks(generator, batch_size, length) if masked else (None, None)
+    assert_same_step(model, scripted, src, trg, src_mask=src_mask, trg_mask=trg_mask)
+
+@pytest.mark.skipif(not hasattr(torch, 'compile'), reason="torch.compile needs torch >= 2.0")
+def test_compile_model(monkeypatch):
+
+    model = get_model(monkeypatch)
+    compiled = attention_model.compile_model(copy.deepcopy(model), 'compile')
+    assert_same_step(model, compiled, torch.randn(8, 4, 50, generator=torch.Generator().manual_seed(1)))
+
+@pytest.mark.skipif(not hasattr(torch, 'compile'), reason="torch.compile needs torch >= 2.0")
+@pytest.mark.parametrize('masked', [False, True])
+def test_compiled_transformer(monkeypatch, masked):
+
+    ### the model level forward has no masks, they are given to the attention blocks directly
+    length, d_model, batch_size = 16, 4, 3
+    monkeypatch.setattr(setting, 'd_model_j', length)
+    torch.manual_seed(0)
+    model = attention_model.Transformer(d_model, 1, 1, 0.1)
+    compiled = attention_model.compile_model(copy.deepcopy(model), 'compile')
+    generator = torch.Generator().manual_seed(1)
+    src, trg = torch.randn(batch_size, length, d_model, generator=generator), \
+               torch.randn(batch_size, length, d_model, generator=generator)
+    src_mask, trg_mask = get_masks(generator, batch_size, length) if masked else (None, None)
+    assert_same_step(model, compiled, src, trg, src_mask=src_mask, trg_mask=trg_mask)
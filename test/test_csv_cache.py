@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src import setting, csv_cache
+
+
+@pytest.fixture
+def source(monkeypatch, tmp_path):
+
+    monkeypatch.setattr(setting, 'use_csv_cache', True)
+    monkeypatch.setattr(setting, 'csv_cache_dir', str(tmp_path / 'csv_cache'))
+    monkeypatch.setattr(setting, 'csv_cache_matrix_min_columns', 2)
+    file_path = tmp_path / 'source.csv'
+    file_path.write_text("name,entrez,a,b,cell_line\n"
+                         "5-FU,1001,0.5,1.25,A2058\n"
+                         "ABT-888,10001,,2.5,\n"
+                         "MK_2206,3000000000,-1.5,0.125,A375\n")
+    return str(file_path)
+
+def read_without_parsing(monkeypatch, file_path, **kwargs):
+
+    ### a cache hit never parses the text
+    with monkeypatch.context() as context:
+        context.setattr(pd, 'read_csv', lambda *args, **kwargs: pytest.fail("source was parsed again"))
+        return csv_cache.read_csv(file_path, **kwargs)
+
+@pytest.mark.parametrize('kwargs', [{}, {'index_col': 0}])
+def test_round_trip(monkeypatch, source, kwargs):
+
+    expected = pd.read_csv(source, **kwargs)
+    first = csv_cache.read_csv(source, **kwargs)
+    cached = read_without_parsing(monkeypatch, source, **kwargs)
+    for df in (first, cached):
+        ### float columns are stored as one float32 matrix
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+        assert (df.dtypes[expected.dtypes.map(lambda dtype: dtype.kind == 'f')] == np.float32).all()
+    assert cached['entrez'].values.dtype == np.int64 and cached['entrez'].iloc[2] == 3000000000
+
+def test_changed_source_is_parsed_again(monkeypatch, source):
+
+    csv_cache.read_csv(source)
+    with open(source, 'a') as source_file:
+        source_file.write("5-FU,12,1.0,2.0,A375\n")
+    assert len(csv_cache.read_csv(source)) == 4
+    assert len(read_without_parsing(monkeypatch, source)) == 4
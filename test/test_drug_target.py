@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+from src.my_data import DrugTargetProfileDataLoader
+
+
+def old_drug_profile(raw_chemicals, entrez_list):
+
+    ### the iterrows loop that build_drug_target_matrix replaced
+    drug_profile = pd.DataFrame(np.zeros(shape=(len(entrez_list), len(raw_chemicals))), index=list(entrez_list),
+                                columns=raw_chemicals['Name'])
+    entrez_set = set(entrez_list)
+    for row in raw_chemicals.iterrows():
+        if not isinstance(row[1]['combin_entrez'], str):
+            continue
+        chem_name, target_list = row[1]['Name'], row[1]['combin_entrez'].split(",")
+        for target in target_list:
+            target = int(target)
+            if target in entrez_set:
+                drug_profile.loc[target, chem_name] = 1
+    return drug_profile.values
+
+def test_build_drug_target_matrix_matches_loop():
+
+    ### a drug without targets, targets outside of the panel and a drug listed twice
+    raw_chemicals = pd.DataFrame({'Name': ['5-FU', 'ABT-888', 'MK_2206', '5-FU', 'BORTEZOMIB'],
+                                  'combin_entrez': ['1001,235', np.nan, '99999', '2222, 32', '1001,10001,235,32']})
+    entrez_list = [1001, 10001, 235, 32, 25, 2222]
+    matrix = DrugTargetProfileDataLoader.build_drug_target_matrix(raw_chemicals, entrez_list)
+    assert matrix.shape == (len(entrez_list), len(raw_chemicals))
+    assert np.array_equal(matrix.toarray(), old_drug_profile(raw_chemicals, entrez_list))
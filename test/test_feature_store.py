@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from src import setting
+from src.my_data import FeatureStore, DrugSwappedView
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+
+    for name in ('feature_store', 'feature_store_index', 'feature_store_layout'):
+        monkeypatch.setattr(setting, name, str(tmp_path / name))
+    monkeypatch.setattr(setting, 'feature_store_chunk_size', 2)
+    monkeypatch.setattr(setting, 'update_features', False)
+    monkeypatch.setattr(FeatureStore, 'features', None)
+    monkeypatch.setattr(FeatureStore, 'n_rows', None)
+    return FeatureStore
+
+def test_drug_swapped_feature_types_round_trip(store):
+
+    ### 'attn' rows are feature types x genes, the two drug feature types are swapped in the second half
+    view = DrugSwappedView(np.random.RandomState(0).rand(3, 5, 4).astype(np.float32), 1)
+    store.persist(view, ['c{}'.format(i) for i in range(6)])
+    rows = store.get_rows([5, 0, 3])
+    assert np.array_equal(store.get_features()[rows], view[rows])
+
+def test_persist_and_get_rows(store):
+
+    x = np.random.RandomState(0).rand(5, 3)
+    store.persist(x, ['c{}'.format(i) for i in range(5)])
+    rows = store.get_rows(np.array([4, 0, 2]))
+    features = store.get_features()
+    assert isinstance(features, np.memmap) and features.dtype == np.float32
+    assert np.allclose(features[rows], x[[4, 0, 2]])
+    with pytest.raises(AssertionError):
+        store.get_rows([5])
+
+def test_persist_skips_up_to_date_store(store):
+
+    x = np.random.RandomState(0).rand(4, 3)
+    index = ['c{}'.format(i) for i in range(4)]
+    store.persist(x, index)
+    modified = np.load(setting.feature_store, mmap_mode='r+')
+    modified[0] = -1
+    modified.flush()
+    del modified
+    ### same shape, layout and final index, the store is reused
+    store.persist(x, index)
+    assert store.get_features()[0, 0] == -1
+    store.persist(x, index[::-1])
+    assert np.allclose(store.get_features(), x)
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+import torch
+from src import setting
+from src.my_data import DrugSwappedView
+
+
+def dense_first_half(loader, monkeypatch):
+
+    ### first drug order of the eager raw X, one row per combination
+    monkeypatch.setattr(loader, 'drug_features_lengths', [])
+    monkeypatch.setattr(loader, 'cellline_features_lengths', [])
+    drug_a_features, drug_b_features = loader._SamplesDataLoader__drug_features_prep()
+    cellline_features = loader._SamplesDataLoader__cellline_features_prep()
+    return np.concatenate(drug_a_features + drug_b_features + cellline_features, axis=1), \
+           list(loader.drug_features_lengths), list(loader.cellline_features_lengths)
+
+def entity_tables(loader, monkeypatch):
+
+    monkeypatch.setattr(loader, 'drug_features_lengths', [])
+    monkeypatch.setattr(loader, 'cellline_features_lengths', [])
+    tables = loader._SamplesDataLoader__entity_tables_prep()
+    return tables, list(loader.drug_features_lengths), list(loader.cellline_features_lengths)
+
+def test_factorized_pair_rows_match_eager_product(toy_samples, monkeypatch):
+
+    dense, drug_lengths, cellline_lengths = dense_first_half(toy_samples, monkeypatch)
+    tables, factorized_drug_lengths, factorized_cellline_lengths = entity_tables(toy_samples, monkeypatch)
+    assert (factorized_drug_lengths, factorized_cellline_lengths) == (drug_lengths, cellline_lengths)
+    n = len(toy_samples.synergy_score)
+    ### gene_dependence, combine_drugs_for_cl, gene_expression blocks, the pair block is the second one
+    start = 2 * sum(drug_lengths) + cellline_lengths[0]
+    pair_columns = slice(start, start + cellline_lengths[1])
+    assert np.allclose(tables[np.arange(n)][:, pair_columns], dense[:, pair_columns], atol=1e-6)
+    assert np.allclose(tables[np.arange(n)], dense, atol=1e-6)
+
+def test_missing_drug_pair_fails(toy_samples, monkeypatch):
+
+    monkeypatch.setattr(toy_samples, 'drug_pair_target', toy_samples.drug_pair_target.iloc[1:])
+    with pytest.raises(AssertionError):
+        entity_tables(toy_samples, monkeypatch)
+
+def test_chunked_raw_x_matches_dense(toy_samples, monkeypatch, tmp_path):
+
+    dense, drug_lengths, cellline_lengths = dense_first_half(toy_samples, monkeypatch)
+    monkeypatch.setattr(setting, 'factorized_features', False)
+    monkeypatch.setattr(setting, 'raw_x_chunk_size', 3)
+    monkeypatch.setattr(setting, 'raw_x_first_half', str(tmp_path / 'raw_x_first_half.npy'))
+    monkeypatch.setattr(toy_samples, 'drug_features_lengths', [])
+    monkeypatch.setattr(toy_samples, 'cellline_features_lengths', [])
+    raw_x = toy_samples._SamplesDataLoader__construct_whole_raw_X()
+    assert (toy_samples.drug_features_lengths, toy_samples.cellline_features_lengths) == (drug_lengths, cellline_lengths)
+    assert np.allclose(raw_x.base, dense, atol=1e-6)
+    d = sum(drug_lengths)
+    switched = raw_x[np.arange(len(dense), 2 * len(dense))]
+    assert np.allclose(switched, np.concatenate([dense[:, d:2 * d], dense[:, :d], dense[:, 2 * d:]], axis=1), atol=1e-6)
+
+def test_attn_raw_x_stores_one_drug_order(toy_samples, monkeypatch, tmp_path):
+
+    ### 2 drug and 3 cell line feature types of 4 genes, the switched rows swap the drug feature types
+    monkeypatch.setattr(setting, 'add_single_response_to_drug_target', False)
+    monkeypatch.setattr(setting, 'n_feature_type', 5)
+    monkeypatch.setattr(setting, 'factorized_features', False)
+    monkeypatch.setattr(setting, 'raw_x_first_half', str(tmp_path / 'raw_x_first_half.npy'))
+    monkeypatch.setattr(setting, 'raw_x_file', str(tmp_path / 'raw_x.npy'))
+    dense, _, _ = dense_first_half(toy_samples, monkeypatch)
+    monkeypatch.setattr(toy_samples, 'drug_features_lengths', [])
+    monkeypatch.setattr(toy_samples, 'cellline_features_lengths', [])
+    x = toy_samples.Raw_X_features_prep('attn')[0]
+    n = len(dense)
+    assert x.shape == (2 * n, 5, 4) and not (tmp_path / 'raw_x.npy').exists()
+    dense = dense.reshape(n, 5, 4)
+    assert np.allclose(x[np.arange(n)], dense, atol=1e-6)
+    assert np.allclose(x[np.arange(n, 2 * n)], dense[:, [1, 0, 2, 3, 4]], atol=1e-6)
+
+def test_drug_swapped_view_matches_doubled_x():
+
+    ### eager layout: first half, then drug_a and drug_b blocks switched with the same cell line block
+    first_half = np.random.RandomState(0).rand(4, 7)
+    doubled = np.concatenate([first_half, np.concatenate([first_half[:, 2:4], first_half[:, :2], first_half[:, 4:]],
+                                                         axis=1)])
+    view = DrugSwappedView(first_half, 2)
+    assert view.shape == doubled.shape and len(view) == 8
+    assert np.array_equal(view.materialize(), doubled)
+    assert np.array_equal(view[[6, 1, 5]], doubled[[6, 1, 5]])
+    assert np.array_equal(view[5], doubled[5]) and np.array_equal(view[-1], doubled[-1])
+    assert np.array_equal(view[3:7], doubled[3:7])
+    with pytest.raises(AssertionError):
+        view[[8]]
+
+@pytest.mark.parametrize('cellline_features', [['gene_dependence', 'gene_expression'],
+                                               ['gene_dependence', 'combine_drugs_for_cl', 'gene_expression']])
+def test_factorized_rows_match_dense_x(toy_samples, monkeypatch, tmp_path, cellline_features):
+
+    ### both drug orders of the dense raw X (DrugSwappedView) against the entity tables, on numpy and torch
+    monkeypatch.setattr(setting, 'cellline_features', cellline_features)
+    monkeypatch.setattr(setting, 'factorized_features', False)
+    monkeypatch.setattr(setting, 'raw_x_first_half', str(tmp_path / 'raw_x_first_half.npy'))
+    dense = toy_samples._SamplesDataLoader__construct_whole_raw_X()
+    drug_lengths, cellline_lengths = list(toy_samples.drug_features_lengths), list(toy_samples.cellline_features_lengths)
+    tables, factorized_drug_lengths, factorized_cellline_lengths = entity_tables(toy_samples, monkeypatch)
+    assert (factorized_drug_lengths, factorized_cellline_lengths) == (drug_lengths, cellline_lengths)
+    assert tables.shape == dense.shape
+    rows = np.array([7, 0, 4, 2, 5])
+    assert np.allclose(tables[rows], dense[rows], atol=1e-6)
+    assert np.allclose(tables.to(torch.device('cpu'))[rows].numpy(), dense[rows], atol=1e-6)
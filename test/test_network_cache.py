@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src import setting, network_cache
+
+
+@pytest.fixture
+def network_file(monkeypatch, tmp_path):
+
+    monkeypatch.setattr(setting, 'network_cache_dir', str(tmp_path / 'edge_cache'))
+    network = pd.DataFrame({0: [1001, 235, 10001, 1001, 32, 2222, 235],
+                            1: [10001, 1001, 32, 25, 235, 10001, 32],
+                            2: [0.3, 0.2, 0.9, 0.5, 0.7, 0.1, 0.4]})
+    network.to_csv(tmp_path / 'network.tsv', sep='\t', header=False, index=False)
+    return str(tmp_path / 'network.tsv')
+
+def read_network(network_file):
+
+    ### the frame that NetworkDataReader parsed from the file before the cache
+    raw_network = pd.read_csv(network_file, header=None, sep='\t')
+    raw_network.columns = ['entrez_a', 'entrez_b', 'association']
+    return raw_network
+
+def test_edge_frames_match_file(network_file):
+
+    panel = {1001, 10001, 235, 32, 77}
+    adjacency = network_cache.get_adjacency(network_file, panel)
+    raw_network = read_network(network_file)
+    pd.testing.assert_frame_equal(adjacency.to_frame(), raw_network, check_dtype=False, check_index_type=False,
+                                  rtol=1e-6)
+    in_panel = raw_network['entrez_a'].isin(list(panel)) & raw_network['entrez_b'].isin(list(panel))
+    pd.testing.assert_frame_equal(adjacency.to_frame(mask=adjacency.panel_edges()), raw_network[in_panel],
+                                  check_dtype=False, check_index_type=False, rtol=1e-6)
+    ### degree of the panel genes 32, 77, 235, 1001, 10001 inside the panel
+    assert list(adjacency.nodes[:adjacency.n_panel]) == [32, 77, 235, 1001, 10001]
+    assert list(adjacency.panel_degree()) == [3, 0, 3, 2, 2]
+
+def test_cache_is_reused_until_the_file_changes(monkeypatch, network_file):
+
+    panel = {1001, 10001, 235}
+    network_cache.get_adjacency(network_file, panel)
+    with monkeypatch.context() as context:
+        context.setattr(pd, 'read_csv', lambda *args, **kwargs: pytest.fail("network file was parsed again"))
+        assert isinstance(network_cache.get_adjacency(network_file, panel).targets, np.memmap)
+    with open(network_file, 'a') as f:
+        f.write("235\t10001\t0.6\n")
+    adjacency = network_cache.get_adjacency(network_file, panel)
+    pd.testing.assert_frame_equal(adjacency.to_frame(), read_network(network_file), check_dtype=False,
+                                  check_index_type=False, rtol=1e-6)
+    ### another gene panel gets its own entry
+    assert network_cache.get_adjacency(network_file, {32}).n_panel == 1
@@ -0,0 +1,290 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import csr_matrix
+from src import setting, network_propagation, propagation_kernel
+
+
+@pytest.fixture
+def network_files(monkeypatch, tmp_path):
+
+    monkeypatch.setattr(setting, 'network_matrix', str(tmp_path / 'network_matrix'))
+    monkeypatch.setattr(setting, 'network_update', True)
+
+@pytest.fixture
+def kernel_files(monkeypatch, tmp_path):
+    monkeypatch.setattr(setting, 'propagation_kernel_dir', str(tmp_path / 'propagation_kernels'))
+
+def get_network(n_genes=12, n_edges=30, seed=0):
+
+    ### gene-gene network data frame with entrez ids 100, 101, ... and one repeated edge
+    generator = np.random.RandomState(seed)
+    a, b = generator.randint(n_genes, size=n_edges) + 100, generator.randint(n_genes, size=n_edges) + 100
+    kept = a != b
+    network = pd.DataFrame({'entrez_a': a[kept], 'entrez_b': b[kept], 'association': generator.rand(kept.sum())})
+    return pd.concat([network, network.iloc[:1].assign(association=0.99)], ignore_index=True)
+
+def get_network_matrix(n_genes=12, seed=0):
+
+    ### symmetric weighted adjacency matrix, the last gene has no edge
+    generator = np.random.RandomState(seed)
+    matrix = generator.rand(n_genes, n_genes) * (generator.rand(n_genes, n_genes) > 0.6)
+    matrix = np.triu(matrix, 1) + np.triu(matrix, 1).T
+    matrix[-1], matrix[:, -1] = 0, 0
+    return csr_matrix(matrix)
+
+def exact_random_walk(network_matrix, seeds, alpha, symmetric_norm=False):
+
+    ### (1 - alpha) seeds (I - alpha W)^-1 with an explicit inverse
+    normalized = network_propagation.normalize_matrix(network_matrix.toarray(), 'symmetric' if symmetric_norm else 0)
+    return (1 - alpha) * seeds.dot(np.linalg.inv(np.identity(len(normalized)) - alpha * normalized))
+
+def get_drug_target(genes, n_drugs=4, seed=1):
+
+    ### index = genes, columns = drugs, every drug has at least one target
+    targets = (np.random.RandomState(seed).rand(len(genes), n_drugs) > 0.7).astype(float)
+    targets[0] = 1
+    return pd.DataFrame(targets, index=list(genes), columns=['drug_{}'.format(i) for i in range(n_drugs)])
+
+def test_max_probability_matches_loop():
+
+    genes = list(range(100, 112))
+    network = pd.DataFrame(np.random.RandomState(0).rand(12, 12) * (np.random.RandomState(1).rand(12, 12) > 0.6),
+                           index=genes, columns=genes)
+    drug_target = get_drug_target(genes).T
+    expected = np.zeros(drug_target.shape)
+    for i, targets in enumerate(drug_target.values):
+        for gene in range(len(genes)):
+            expected[i, gene] = 1 if targets[gene] == 1 else max(targets * network.values[gene])
+    for matrix in (network, csr_matrix(network.values)):
+        result = network_propagation.get_max_probability(drug_target, matrix)
+        assert np.allclose(result.values, expected)
+        assert list(result.index) == list(drug_target.index) and list(result.columns) == genes
+
+def old_network_matrix(network, entrez_set):
+
+    ### the .loc loop that get_sparse_network replaced
+    network_matrix = pd.DataFrame(np.zeros(shape=(len(entrez_set), len(entrez_set))), columns=list(entrez_set),
+                                  index=list(entrez_set))
+    for row in network.iterrows():
+        a, b = int(row[1]['entrez_a']), int(row[1]['entrez_b'])
+        if a in entrez_set and b in entrez_set:
+            network_matrix.loc[a, b] = row[1]['association']
+            network_matrix.loc[b, a] = row[1]['association']
+    return network_matrix
+
+def test_sparse_network_matches_loop(monkeypatch, network_files):
+
+    network = get_network()
+    genes = [107, 100, 103, 111, 105, 102, 200]
+    network_matrix, matrix_genes = network_propagation.get_sparse_network(network, genes)
+    assert list(matrix_genes) == genes
+    assert np.array_equal(network_matrix.toarray(), old_network_matrix(network, genes).values)
+    ### saved csr arrays are loaded back, in another gene order they are permuted
+    monkeypatch.setattr(setting, 'network_update', False)
+    loaded, _ = network_propagation.get_sparse_network(network, genes)
+    assert np.array_equal(loaded.toarray(), network_matrix.toarray())
+    permuted, _ = network_propagation.get_sparse_network(network, genes[::-1])
+    assert np.array_equal(permuted.toarray(), network_matrix.toarray()[::-1, ::-1])
+
+def test_sparse_network_of_all_genes(network_files):
+
+    network = get_network()
+    network_matrix, genes = network_propagation.get_sparse_network(network)
+    assert set(genes) == set(network['entrez_a']) | set(network['entrez_b'])
+    assert np.array_equal(network_matrix.toarray(), old_network_matrix(network, list(genes)).values)
+
+@pytest.mark.parametrize('symmetric_norm', [False, True])
+@pytest.mark.parametrize('solver', ['power', 'kernel'])
+def test_random_walk_solvers_match_inverse(monkeypatch, kernel_files, solver, symmetric_norm):
+
+    monkeypatch.setattr(setting, 'random_walk_solver', solver)
+    monkeypatch.setattr(setting, 'random_walk_tolerance', 1e-10)
+    network_matrix = get_network_matrix()
+    seeds = get_drug_target(range(12)).values.T
+    alphas = [0.3, 0.8]
+    propagated = network_propagation.random_walk_with_restart(network_matrix, seeds, alphas,
+                                                              symmetric_norm=symmetric_norm)
+    assert propagated.shape == (2, 4, 12) and propagated.dtype == np.float32
+    for i, alpha in enumerate(alphas):
+        assert np.allclose(propagated[i], exact_random_walk(network_matrix, seeds, alpha, symmetric_norm), atol=1e-6)
+
+@pytest.mark.parametrize('dense_genes', [100, 5])
+def test_cached_kernel_matches_inverse(monkeypatch, kernel_files, dense_genes):
+
+    ### the dense kernel for small panels, the sparse LU factors above propagation_kernel_dense_genes
+    monkeypatch.setattr(setting, 'propagation_kernel_dense_genes', dense_genes)
+    network_matrix = get_network_matrix()
+    normalized = network_propagation.normalize_matrix(network_matrix, 0)
+    seeds = get_drug_target(range(12)).values.T
+    genes = np.arange(100, 112)
+    kernel = propagation_kernel.get_kernel(normalized, 0.5, genes)
+    assert kernel.kind == ('dense' if dense_genes == 100 else 'lu')
+    assert np.allclose(kernel.propagate(seeds), exact_random_walk(network_matrix, seeds, 0.5), atol=1e-6)
+    ### the second call loads the kernel from disk
+    monkeypatch.setattr(propagation_kernel, '__factorize', lambda *args: pytest.fail("kernel was computed again"))
+    cached = propagation_kernel.get_kernel(normalized, 0.5, genes)
+    assert np.allclose(cached.propagate(seeds), kernel.propagate(seeds), atol=1e-6)
+
+def test_kernel_cache_key_and_eviction(monkeypatch, kernel_files):
+
+    normalized = network_propagation.normalize_matrix(get_network_matrix(), 0)
+    for alpha, genes in ((0.5, np.arange(12)), (0.3, np.arange(12)), (0.5, np.arange(1, 13))):
+        propagation_kernel.get_kernel(normalized, alpha, genes)
+    assert len(os.listdir(setting.propagation_kernel_dir)) == 3
+    ### only the kernel in use is kept once the cache is over its size limit
+    monkeypatch.setattr(setting, 'propagation_kernel_cache_bytes', 1)
+    propagation_kernel.get_kernel(normalized, 0.8, np.arange(12))
+    assert len(os.listdir(setting.propagation_kernel_dir)) == 1
+
+def old_normalize(raw_matrix, axis):
+
+    ### the per row / per column loop that normalize_matrix replaced
+    def normalize(vector):
+        denominator = sum(vector)
+        return vector / denominator if denominator else vector
+
+    normalized_matrix = pd.DataFrame(np.zeros(shape=raw_matrix.shape), columns=raw_matrix.columns, index=raw_matrix.index)
+    if axis == 0:
+        for i in raw_matrix.index:
+            normalized_matrix.loc[i, :] = normalize(raw_matrix.loc[i, :])
+    else:
+        for i in raw_matrix.columns:
+            normalized_matrix.loc[:, i] = normalize(raw_matrix.loc[:, i])
+    return normalized_matrix
+
+@pytest.mark.parametrize('axis', [0, 'index', 1, 'column'])
+def test_normalize_matrix_matches_loop(axis):
+
+    raw_matrix = pd.DataFrame(get_network_matrix().toarray(), index=range(100, 112), columns=range(100, 112))
+    raw_matrix.iloc[0, 3] = 0.5
+    expected = old_normalize(raw_matrix, 0 if axis in (0, 'index') else 1)
+    normalized = network_propagation.normalize_matrix(raw_matrix, axis)
+    pd.testing.assert_frame_equal(normalized, expected)
+    assert np.allclose(network_propagation.normalize_matrix(raw_matrix.values, axis), expected.values)
+    sparse = network_propagation.normalize_matrix(csr_matrix(raw_matrix.values), axis)
+    assert sparse.format == 'csr' and np.allclose(sparse.toarray(), expected.values)
+
+def test_symmetric_normalize_matrix():
+
+    ### D^-1/2 A D^-1/2, the gene without edges stays 0
+    raw_matrix = get_network_matrix().toarray()
+    degree = raw_matrix.sum(axis=1)
+    inverse = np.zeros(len(degree))
+    inverse[degree > 0] = 1 / np.sqrt(degree[degree > 0])
+    expected = inverse.reshape(-1, 1) * raw_matrix * inverse.reshape(1, -1)
+    assert np.allclose(network_propagation.normalize_matrix(raw_matrix, 'symmetric'), expected)
+    assert np.allclose(network_propagation.normalize_matrix(csr_matrix(raw_matrix), 'symmetric').toarray(), expected)
+
+@pytest.fixture
+def propagation_files(monkeypatch, tmp_path, network_files, kernel_files):
+
+    ### random walk array, manifest and result matrix in tmp_path, propagated in one process
+    monkeypatch.setattr(setting, 'random_walk_result_array', str(tmp_path / 'result_array.npy'))
+    monkeypatch.setattr(setting, 'random_walk_result_array_index', str(tmp_path / 'result_array_index.pkl'))
+    monkeypatch.setattr(setting, 'use_csv_cache', False)
+    monkeypatch.setattr(setting, 'renew', False)
+    monkeypatch.setattr(setting, 'random_walk_alphas', [0.3, 0.5])
+    monkeypatch.setattr(setting, 'random_walk_alpha', 0.3)
+    monkeypatch.setattr(setting, 'random_walk_solver', 'power')
+    monkeypatch.setattr(setting, 'random_walk_tolerance', 1e-10)
+    monkeypatch.setattr(setting, 'propagation_processes', 1)
+    monkeypatch.setattr(setting, 'propagation_chunk_size', 2)
+    propagated_drugs = []
+    chunked_random_walk_with_restart = network_propagation.chunked_random_walk_with_restart
+
+    def counted(network_genes, seeds, *args):
+        propagated_drugs.append(len(seeds))
+        return chunked_random_walk_with_restart(network_genes, seeds, *args)
+
+    monkeypatch.setattr(network_propagation, 'chunked_random_walk_with_restart', counted)
+    return propagated_drugs
+
+def full_propagation(monkeypatch, tmp_path, network, drug_target, genes):
+
+    ### from scratch, with its own array and manifest
+    with monkeypatch.context() as context:
+        context.setattr(setting, 'renew', True)
+        context.setattr(setting, 'random_walk_result_array', str(tmp_path / 'full_array.npy'))
+        context.setattr(setting, 'random_walk_result_array_index', str(tmp_path / 'full_array_index.pkl'))
+        return network_propagation.random_walk_network_propagation(str(tmp_path / 'full.csv'), network, drug_target,
+                                                                   genes)
+
+def test_incremental_propagation_matches_full(monkeypatch, tmp_path, propagation_files):
+
+    network = get_network()
+    genes = [100, 102, 103, 105, 107, 111]
+    network_genes = sorted(set(network['entrez_a']) | set(network['entrez_b']))
+    drug_target = get_drug_target(network_genes)
+    result_file = str(tmp_path / 'result.csv')
+    first = network_propagation.random_walk_network_propagation(result_file, network, drug_target, genes)
+    pd.testing.assert_frame_equal(first, full_propagation(monkeypatch, tmp_path, network, drug_target, genes))
+    assert propagation_files == [4, 4]
+
+    ### one changed and one new drug are propagated, the other rows are reused
+    updated = drug_target.copy()
+    updated['drug_1'] = 1 - updated['drug_1']
+    updated['drug_4'] = drug_target['drug_0'].values[::-1]
+    del propagation_files[:]
+    result = network_propagation.random_walk_network_propagation(result_file, network, updated, genes)
+    assert propagation_files == [2]
+    pd.testing.assert_frame_equal(result, full_propagation(monkeypatch, tmp_path, network, updated, genes),
+                                  atol=1e-6)
+    ### nothing changed, nothing propagated
+    del propagation_files[:]
+    network_propagation.random_walk_network_propagation(result_file, network, updated, genes)
+    assert propagation_files == []
+
+@pytest.mark.parametrize('solver', ['power', 'kernel'])
+def test_process_pool_matches_one_process(monkeypatch, tmp_path, network_files, kernel_files, solver):
+
+    monkeypatch.setattr(setting, 'random_walk_solver', solver)
+    monkeypatch.setattr(setting, 'random_walk_tolerance', 1e-10)
+    monkeypatch.setattr(setting, 'propagation_chunk_size', 2)
+    network_matrix, network_genes = network_propagation.get_sparse_network(get_network())
+    seeds = get_drug_target(network_genes, n_drugs=5).values.T
+    columns = np.array([4, 0, 2])
+    results = []
+    for processes in (1, 2):
+        monkeypatch.setattr(setting, 'propagation_processes', processes)
+        results.append(np.array(network_propagation.chunked_random_walk_with_restart(
+            network_genes, seeds, [0.3, 0.5], columns, str(tmp_path / 'result_{}.npy'.format(processes)))))
+    assert np.array_equal(results[1], results[0])
+    expected = network_propagation.random_walk_with_restart(network_matrix, seeds, [0.3, 0.5])[:, :, columns]
+    assert np.allclose(results[0], expected, atol=1e-6)
+
+@pytest.mark.parametrize('tolerance', [1e-2, 1e-4])
+def test_forward_push_error_bound(tolerance):
+
+    ### the L1 error of every estimate row is at most the L1 norm of its residual row
+    network_matrix = get_network_matrix()
+    seeds = get_drug_target(range(12)).values.T
+    estimate, residual = network_propagation.forward_push(network_matrix, csr_matrix(seeds), 0.5, tolerance)
+    assert residual.max() <= tolerance
+    error = np.abs(exact_random_walk(network_matrix, seeds, 0.5) - estimate.toarray()).sum(axis=1)
+    assert (error <= np.asarray(residual.sum(axis=1)).reshape(-1) + 1e-12).all()
+
+def test_top_k_rows():
+
+    matrix = csr_matrix(np.array([[0.5, 0.1, 0.3, 0.2], [0., 0.4, 0., 0.1], [0.3, 0.3, 0.7, 0.]]))
+    top_k, dropped = network_propagation.top_k_rows(matrix, 2)
+    assert np.allclose(top_k.toarray(), [[0.5, 0., 0.3, 0.], [0., 0.4, 0., 0.1], [0.3, 0., 0.7, 0.]]) or \
+           np.allclose(top_k.toarray(), [[0.5, 0., 0.3, 0.], [0., 0.4, 0., 0.1], [0., 0.3, 0.7, 0.]])
+    assert np.allclose(dropped, [0.3, 0., 0.3])
+
+def test_push_propagation_approaches_random_walk(monkeypatch, network_files):
+
+    ### without truncation and with a small tolerance the pushed profiles are the standardized random walk
+    monkeypatch.setattr(setting, 'random_walk_alpha', 0.5)
+    monkeypatch.setattr(setting, 'push_tolerance', 1e-9)
+    monkeypatch.setattr(setting, 'push_top_k', 100)
+    network = get_network()
+    network_matrix, network_genes = network_propagation.get_sparse_network(network)
+    drug_target = get_drug_target(network_genes)
+    genes = [100, 102, 103, 105, 107, 111]
+    result, error_bounds = network_propagation.push_network_propagation(network, drug_target, genes)
+    columns = network_genes.get_indexer(list(result.columns))
+    exact = exact_random_walk(network_matrix, drug_target.values.T, 0.5)[:, columns]
+    assert set(result.columns) <= set(genes) and (error_bounds < 1e-6).all()
+    assert np.allclose(result.values, (exact - exact.mean()) / exact.std(), atol=1e-4)
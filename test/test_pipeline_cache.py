@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from src import setting
+from src.pipeline_cache import PreprocessingDAG
+
+
+@pytest.fixture
+def dag(monkeypatch, tmp_path):
+
+    ### empty DAG with a toy input file -> scaled -> total chain, every compute call is counted
+    monkeypatch.setattr(PreprocessingDAG, 'stages', {})
+    monkeypatch.setattr(PreprocessingDAG, 'fingerprints', {})
+    monkeypatch.setattr(PreprocessingDAG, 'results', {})
+    monkeypatch.setattr(PreprocessingDAG, 'file_digests', None)
+    monkeypatch.setattr(setting, 'preprocessing_cache_dir', str(tmp_path / 'cache'))
+    input_file = tmp_path / 'toy.csv'
+    input_file.write_text("1,2,3")
+    monkeypatch.setattr(setting, 'toy_file', str(input_file), raising=False)
+    monkeypatch.setattr(setting, 'toy_scale', 2, raising=False)
+    monkeypatch.setattr(setting, 'toy_renew', False, raising=False)
+
+    calls = {'scaled': 0, 'total': 0}
+    restored = []
+
+    def scaled():
+        calls['scaled'] += 1
+        values = np.array([float(x) for x in open(setting.toy_file).read().split(',')])
+        return {'values': values * setting.toy_scale, 'scale': setting.toy_scale}
+
+    def total():
+        calls['total'] += 1
+        return float(PreprocessingDAG.run('scaled')['values'].sum())
+
+    PreprocessingDAG.register('scaled', scaled, restored.append, input_files=['toy_file'], settings=['toy_scale'],
+                              force_flags=['toy_renew'])
+    PreprocessingDAG.register('total', total, deps=['scaled'])
+    return calls, restored, input_file
+
+def new_run(monkeypatch):
+
+    ### the fingerprints and outputs are memoized per process, a new run only finds the cache on disk
+    monkeypatch.setattr(PreprocessingDAG, 'fingerprints', {})
+    monkeypatch.setattr(PreprocessingDAG, 'results', {})
+
+def test_cache_hit(monkeypatch, dag):
+
+    calls, restored, _ = dag
+    assert PreprocessingDAG.run('total') == 12.
+    assert calls == {'scaled': 1, 'total': 1}
+    new_run(monkeypatch)
+    assert PreprocessingDAG.run('total') == 12.
+    assert calls == {'scaled': 1, 'total': 1}
+    ### arrays come back memory mapped, the restore callback gets the cached output
+    output = PreprocessingDAG.run('scaled')
+    assert isinstance(output['values'], np.memmap) and output['scale'] == 2
+    assert len(restored) == 1 and restored[0] is output
+
+def test_setting_change_recomputes_downstream(monkeypatch, dag):
+
+    calls, _, _ = dag
+    PreprocessingDAG.run('total')
+    fingerprints = dict(PreprocessingDAG.fingerprints)
+    new_run(monkeypatch)
+    monkeypatch.setattr(setting, 'toy_scale', 3, raising=False)
+    assert PreprocessingDAG.run('total') == 18.
+    assert calls == {'scaled': 2, 'total': 2}
+    assert all(PreprocessingDAG.fingerprints[name] != fingerprints[name] for name in fingerprints)
+
+def test_input_file_change_recomputes(monkeypatch, dag):
+
+    calls, _, input_file = dag
+    PreprocessingDAG.run('total')
+    new_run(monkeypatch)
+    input_file.write_text("1,2,3,4")
+    assert PreprocessingDAG.run('total') == 20.
+    assert calls == {'scaled': 2, 'total': 2}
+
+def test_force_flag_recomputes(monkeypatch, dag):
+
+    calls, _, _ = dag
+    PreprocessingDAG.run('total')
+    new_run(monkeypatch)
+    monkeypatch.setattr(setting, 'toy_renew', True, raising=False)
+    assert PreprocessingDAG.run('total') == 12.
+    ### the forced stage keeps its fingerprint, so the downstream stage is reused
+    assert calls == {'scaled': 2, 'total': 1}
@@ -0,0 +1,64 @@
+import importlib.util
+import os
+import sys
+import types
+import numpy as np
+import pandas as pd
+import pytest
+import src
+
+pytest.importorskip('seaborn')
+
+
+@pytest.fixture
+def shap_analysis(monkeypatch):
+
+    ### shap_analysis_setting creates its pdf folder on import, the tests only need the catalog file name. The
+    ### module is loaded from its file without being registered, so no stub outlives the test
+    settings = types.ModuleType('src.shap_analysis_setting')
+    settings.id_catalog_file = "id_catalog.pkl"
+    monkeypatch.setitem(sys.modules, 'src.shap_analysis_setting', settings)
+    monkeypatch.delattr(src, 'shap_analysis_setting', raising=False)
+    spec = importlib.util.spec_from_file_location(
+        'shap_analysis', os.path.join(os.path.dirname(src.__file__), 'shap_analysis.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def get_describe(shap_analysis, catalog):
+
+    analysis = shap_analysis.SHAP_ANALYSIS.__new__(shap_analysis.SHAP_ANALYSIS)
+    analysis.catalog = catalog
+    return analysis._SHAP_ANALYSIS__describe
+
+def get_catalog():
+
+    combinations = pd.DataFrame({'drug_a': [0, 1, 2, 0], 'drug_b': [1, 0, 0, 2], 'cell_line': [0, 0, 0, 0],
+                                 'row': [0, 0, 1, 1]}, index=pd.Index(np.arange(4, dtype=np.int64), name='id'))
+    return {'drugs': ['5-FU', 'ABT-888', 'MK_2206'], 'cell_lines': ['A2058'], 'genes': [],
+            'combinations': combinations}
+
+def test_describe_legacy_name_without_catalog(shap_analysis):
+
+    describe = get_describe(shap_analysis, None)
+    assert describe('5-FU_ABT-888_A2058_0') == ('5-FU', 'ABT-888', 'A2058', '5-FU_ABT-888_A2058_0')
+
+def test_describe_legacy_name_with_catalog(shap_analysis):
+
+    ### drug names with '_' are resolved through the catalog
+    describe = get_describe(shap_analysis, get_catalog())
+    assert describe('5-FU_MK_2206_A2058_1') == ('5-FU', 'MK_2206', 'A2058', '5-FU_MK_2206_A2058_1')
+    assert describe('MK_2206_5-FU_A2058_1') == ('MK_2206', '5-FU', 'A2058', 'MK_2206_5-FU_A2058_1')
+    with pytest.raises(AssertionError):
+        describe('5-FU_ABT-888_A2058_1')
+
+def test_describe_combination_id(shap_analysis):
+
+    describe = get_describe(shap_analysis, get_catalog())
+    assert describe(1) == ('ABT-888', '5-FU', 'A2058', 'ABT-888_5-FU_A2058_0')
+    assert describe(np.int64(0)) == ('5-FU', 'ABT-888', 'A2058', '5-FU_ABT-888_A2058_0')
+
+def test_describe_combination_id_without_catalog(shap_analysis):
+
+    with pytest.raises(AssertionError):
+        get_describe(shap_analysis, None)(0)
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.preprocessing import StandardScaler
+from src import setting
+from src.my_data import SingleResponseDataLoader
+
+
+@pytest.fixture
+def single_response(monkeypatch, tmp_path):
+
+    single_response = pd.DataFrame({'cell_line': ['A2058', 'A2058', 'A375', 'A375', 'A2780'],
+                                    'drug': ['5-fu', 'ABT-888', '5-FU', 'MK_2206', 'ABT-888'],
+                                    'pIC50': [2.5, 1.0, 3.0, 0.5, 4.0], 'mean': 0., 'sigma': 1.})
+    single_response.to_csv(tmp_path / 'single_response.csv')
+    monkeypatch.setattr(setting, 'single_response', str(tmp_path / 'single_response.csv'))
+    monkeypatch.setattr(setting, 'use_csv_cache', False)
+    for name in ('pIC50_table', 'pIC50_cell_lines', 'pIC50_drugs'):
+        monkeypatch.setattr(SingleResponseDataLoader, name, None)
+    return single_response
+
+def old_pIC50(single_response, synergy_score, drug_column):
+
+    ### the merge that the table lookup replaced, only defined if every pair was measured
+    single_response = single_response.copy()
+    single_response['pIC50'] = StandardScaler(with_mean=False).fit_transform(single_response[['pIC50']]).reshape(-1)
+    single_response['drug'] = single_response['drug'].str.upper()
+    return single_response.merge(synergy_score, left_on=['drug', 'cell_line'],
+                                 right_on=[drug_column, 'cell_line'])['pIC50'].values
+
+def test_pIC50_matches_merge(single_response):
+
+    synergy_score = pd.DataFrame({'drug_a_name': ['5-FU', 'MK_2206'], 'drug_b_name': ['ABT-888', '5-FU'],
+                                  'cell_line': ['A2058', 'A375']})
+    for drug_column in ('drug_a_name', 'drug_b_name'):
+        pIC50 = SingleResponseDataLoader.get_pIC50(synergy_score[drug_column], synergy_score['cell_line'])
+        assert np.allclose(pIC50, old_pIC50(single_response, synergy_score, drug_column))
+
+def test_unmeasured_pairs_are_nan(single_response):
+
+    pIC50 = SingleResponseDataLoader.get_pIC50(['MK_2206', 'unknown', '5-FU'], ['A2058', 'A375', 'unknown'])
+    assert np.isnan(pIC50).all()
+    table = SingleResponseDataLoader.get_pIC50_table(['A375', 'unknown', 'A2058'], ['MK_2206', '5-FU', 'unknown'])
+    expected = SingleResponseDataLoader.get_pIC50(['MK_2206', '5-FU', 'MK_2206', '5-FU'], ['A375', 'A375', 'A2058', 'A2058'])
+    assert table.shape == (3, 3)
+    assert np.array_equal(table[[0, 0, 2, 2], [0, 1, 0, 1]], expected, equal_nan=True)
+    assert np.isnan(table[1]).all() and np.isnan(table[:, 2]).all() and np.isnan(table[2, 0])
@@ -0,0 +1,19 @@
+import numpy as np
+from src import utils
+from src.my_data import DrugSwappedView
+
+
+def test_streaming_column_variance_matches_numpy():
+
+    x = np.random.RandomState(0).randn(11, 6) * 100 + 1e4
+    for chunk_size in (1, 4, 11, 20):
+        assert np.allclose(utils.streaming_column_variance(x, chunk_size=chunk_size), np.var(x, axis=0))
+
+def test_rows_to_memmap(tmp_path):
+
+    view = DrugSwappedView(np.random.RandomState(0).rand(5, 7).astype(np.float32), 2)
+    columns = np.array([True, False, True, True, False, True, True])
+    out = utils.rows_to_memmap(view, str(tmp_path / 'x.npy'), columns=columns, chunk_size=3)
+    assert np.array_equal(out, view.materialize()[:, columns])
+    first_half = utils.rows_to_memmap(view, str(tmp_path / 'x.npy'), n_rows=5, chunk_size=2)
+    assert np.array_equal(np.load(str(tmp_path / 'x.npy')), view.base) and first_half.shape == (5, 7)